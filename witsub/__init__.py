@@ -1 +1 @@
-from witsub import subDatabase, subTitle
+from .witsub import subDatabase, subTitle, getSubTitles, hashFile, hashFiles
@@ -0,0 +1,470 @@
+# -*- coding: utf-8 -*-
+#
+# Witsub
+# Where Is The (fuck...) Subtitle
+#
+# Asyncio engine (Python 3.7 or higher)
+#
+# Copyright (C) 2016 Nicolargo <nicolas@nicolargo.com>
+#
+# Witsub is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Witsub is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# The video files go through a pipeline of stages connected by queues:
+# hash (threads) => search (XML-RPC) => download (XML-RPC) => write (threads)
+# The search and download requests are sent by batch and at most jobs
+# XML-RPC requests are in flight at the same time.
+
+# Import lib
+import asyncio
+import logging
+import threading
+import time
+import xmlrpc.client
+from concurrent.futures import CancelledError, ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from .witsub import __appname__, __version__
+from .witsub import subTitle, hashFile, videoItem, budgetError
+from .witsub import HASH_SIZE_ERROR, SUB_PENDING
+from .witsub import SEARCH_BATCH_SIZE, DOWNLOAD_BATCH_SIZE, XMLRPC_SERVER
+from .witsub import PRIORITY_DOWNLOAD, PRIORITY_SEARCH, RPC_RETRIES
+from .witsub import STATS_RPC_STAGES, stats
+
+# Global variables
+# Default number of XML-RPC requests in flight
+ASYNC_JOBS = 4
+# Seconds to wait for a batch to be full before sending it
+BATCH_LINGER = 0.2
+
+# Limit import to
+__all__ = ['asyncTransport', 'getSubTitlesAsync']
+
+
+# Classes
+class asyncTransport(object):
+    """
+    Non blocking XML-RPC transport (HTTP/1.1 keep-alive connections)
+    """
+
+    def __init__(self, url=XMLRPC_SERVER, jobs=ASYNC_JOBS):
+        url = urlsplit(url)
+        self.url = url.geturl()
+        self.host = url.hostname
+        self.ssl = (url.scheme == "https")
+        self.port = url.port or (443 if self.ssl else 80)
+        self.path = url.path or "/"
+        # Limit the number of requests in flight
+        self.semaphore = asyncio.Semaphore(jobs)
+        # Idle connections: list of (reader, writer)
+        self.idle = []
+
+    def close(self):
+        for reader, writer in self.idle:
+            writer.close()
+        self.idle = []
+
+    async def call(self, methodname, *params):
+        """
+        Call an XML-RPC method and return its response
+        """
+        body = xmlrpc.client.dumps(params, methodname,
+                                   allow_none=True).encode("utf-8")
+        async with self.semaphore:
+            while True:
+                fresh = not self.idle
+                if fresh:
+                    logging.debug("Open a new connection to %s" % self.url)
+                    reader, writer = await asyncio.open_connection(
+                        self.host, self.port, ssl=self.ssl or None)
+                else:
+                    reader, writer = self.idle.pop()
+                keepalive = False
+                try:
+                    data, keepalive = await self.__request__(reader, writer,
+                                                             body)
+                except (OSError, asyncio.IncompleteReadError):
+                    if fresh:
+                        raise
+                    # Idle connection closed by the server: open a new one
+                    continue
+                finally:
+                    # The connection is closed on any error
+                    if keepalive:
+                        self.idle.append((reader, writer))
+                    else:
+                        writer.close()
+                break
+        return xmlrpc.client.loads(data)[0][0]
+
+    async def __request__(self, reader, writer, body):
+        """
+        Send an HTTP POST request
+        Return the response body and the keep-alive status
+        """
+        headers = ("POST %s HTTP/1.1\r\n"
+                   "Host: %s\r\n"
+                   "User-Agent: %s/%s\r\n"
+                   "Content-Type: text/xml\r\n"
+                   "Content-Length: %d\r\n"
+                   "\r\n" % (self.path, self.host, __appname__, __version__,
+                             len(body)))
+        writer.write(headers.encode("latin-1") + body)
+        await writer.drain()
+
+        status = await reader.readline()
+        if not status:
+            raise ConnectionResetError("Connection closed by the server")
+        code = int(status.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, sep, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        keepalive = headers.get("connection", "").lower() != "close"
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            data = b""
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    # Skip the trailers
+                    while (await reader.readline()) not in (b"\r\n", b"\n",
+                                                            b""):
+                        pass
+                    break
+                data += await reader.readexactly(size)
+                await reader.readline()
+        elif "content-length" in headers:
+            data = await reader.readexactly(int(headers["content-length"]))
+        else:
+            data = await reader.read()
+            keepalive = False
+
+        if code != 200:
+            raise xmlrpc.client.ProtocolError(self.url, code,
+                                              status.decode("latin-1"),
+                                              headers)
+        return data, keepalive
+
+
+async def batches(queue, size):
+    """
+    Async generator: group the items of a queue by batch of size items
+    A batch is sent after BATCH_LINGER seconds even if it is not full
+    None ends the queue
+    """
+    batch = []
+    while True:
+        try:
+            item = await asyncio.wait_for(queue.get(),
+                                          BATCH_LINGER if batch else None)
+        except asyncio.TimeoutError:
+            yield batch
+            batch = []
+            continue
+        if item is None:
+            if batch:
+                yield batch
+            return
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+
+
+async def getSubTitlesAsync(subdatabase, videofilenames, overwrite=False,
+                            jobs=ASYNC_JOBS, batchsize=SEARCH_BATCH_SIZE,
+                            downloadbatchsize=DOWNLOAD_BATCH_SIZE,
+                            callback=None):
+    """
+    Coroutine: get the subtitles for a list of video files
+    (file names or scanVideos items)
+    At most jobs XML-RPC requests are in flight
+    callback is called with each subTitle object as soon as it is done
+    Return the list of subTitle objects (empty with a callback: the
+    objects are not kept)
+    """
+
+    loop = asyncio.get_event_loop()
+    # One thread walks the video files, the others hash and write them
+    executor = ThreadPoolExecutor(max_workers=jobs + 1)
+    transport = asyncTransport(subdatabase.url, jobs=jobs)
+    hashq = asyncio.Queue(jobs * 2)
+    searchq = asyncio.Queue(batchsize * 2)
+    fallbackq = asyncio.Queue(batchsize * 2)
+    downloadq = asyncio.Queue(downloadbatchsize * 2)
+    results = []
+    # Set when the pipeline fails: the walker thread stops
+    stopped = threading.Event()
+    # Puts of the walker thread in progress
+    puts = set()
+    putslock = threading.Lock()
+
+    async def getToken():
+        # Connect and login with the blocking client on the first request
+        return await loop.run_in_executor(None, subdatabase.getToken)
+
+    async def call(method, priority, *params):
+        # Call an XML-RPC method through the subdatabase scheduler
+        scheduler = subdatabase.scheduler
+        attempt = 0
+        relogin = False
+        while True:
+            budget = subdatabase.budget
+            if budget is not None and not budget.take():
+                raise budgetError("Budget reached, %s not sent" % method)
+            await loop.run_in_executor(None, scheduler.acquire, priority)
+            try:
+                with stats.timer(STATS_RPC_STAGES.get(method, method)):
+                    rpc = await transport.call(method, *params)
+            except Exception as msg:
+                if (attempt >= RPC_RETRIES or
+                        not scheduler.retryable(error=msg)):
+                    raise
+                logging.warning("%s error (%s), retry" % (method, msg))
+            else:
+                subdatabase.lastactivity = time.time()
+                if not relogin and str(rpc["status"]).startswith("401"):
+                    # Expired session: login again (only once)
+                    relogin = True
+                    token = await loop.run_in_executor(
+                        None, subdatabase.renewToken, params[0])
+                    if token is None:
+                        return rpc
+                    params = (token,) + params[1:]
+                    continue
+                if (attempt >= RPC_RETRIES or
+                        not scheduler.retryable(rpc=rpc)):
+                    return rpc
+                logging.warning("%s return %s, retry"
+                                % (method, rpc["status"]))
+            stats.count("rpc_retries")
+            await asyncio.sleep(scheduler.delay(attempt))
+            attempt += 1
+
+    def done(subtitle):
+        if callback is None:
+            results.append(subtitle)
+        else:
+            callback(subtitle)
+
+    def put(queue, item):
+        # Put an item in a queue from the walker thread
+        # (raise CancelledError if the pipeline failed)
+        with putslock:
+            if stopped.is_set():
+                raise CancelledError()
+            future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+            puts.add(future)
+        try:
+            future.result()
+        finally:
+            with putslock:
+                puts.discard(future)
+
+    def walk():
+        # Filter the video files without subtitle
+        try:
+            for item in videofilenames:
+                videofilename, filestat, siblings = videoItem(item)
+                put(hashq, subTitle(subdatabase, videofilename,
+                                    overwrite=overwrite, search=False,
+                                    hashing=False, videofilestat=filestat,
+                                    siblings=siblings))
+        finally:
+            if not stopped.is_set():
+                for i in range(jobs):
+                    put(hashq, None)
+
+    def stop():
+        # Stop the walker thread (blocked by a full queue)
+        with putslock:
+            stopped.set()
+            for future in puts:
+                future.cancel()
+        while not hashq.empty():
+            hashq.get_nowait()
+
+    async def hashing():
+        while True:
+            subtitle = await hashq.get()
+            if subtitle is None:
+                return
+            if (subtitle.subtitle == SUB_PENDING and
+                    getattr(subtitle, "hash", None) is None):
+                try:
+                    hash = await loop.run_in_executor(
+                        executor, hashFile, subtitle.videofilename,
+                        subtitle.videofilesize)
+                except (IOError, OSError) as msg:
+                    logging.error("Can not hash %s (error: %s)"
+                                  % (subtitle.videofilename, msg))
+                    hash = HASH_SIZE_ERROR
+                subtitle.setHash(hash)
+            if subtitle.subtitle == SUB_PENDING:
+                await searchq.put(subtitle)
+            else:
+                done(subtitle)
+
+    async def hashingStage():
+        await asyncio.gather(*[hashing() for i in range(jobs)])
+        await searchq.put(None)
+
+    async def searchRequest(searchlist):
+        # Send a SearchSubtitles request (None on error)
+        token = await getToken()
+        if token is None:
+            logging.error("Should be loggedin before searching")
+            return None
+        logging.debug("Search %s criteria in one request" % len(searchlist))
+        try:
+            rpc = await call("SearchSubtitles", PRIORITY_SEARCH, token,
+                             searchlist)
+        except Exception as msg:
+            logging.error("%s" % msg)
+            return None
+        if rpc["status"] != "200 OK":
+            logging.error("Search return an error (error: %s)"
+                          % rpc["status"])
+            return None
+        return rpc
+
+    async def dispatch(subtitle):
+        # Send a searched subtitle to the next stage
+        if subtitle.fallbacklangs:
+            await fallbackq.put(subtitle)
+        elif subtitle.subtitle == SUB_PENDING:
+            await downloadq.put(subtitle)
+        else:
+            done(subtitle)
+
+    async def searchHashes(searchlist):
+        # Search hash/size criteria (again in smaller batches if the
+        # reply is truncated, see splitTruncated)
+        rpc = await searchRequest(searchlist)
+        found = subdatabase.parseSearch(searchlist, rpc)
+        for again in subdatabase.splitTruncated(
+                searchlist, rpc,
+                [c for c in searchlist
+                 if found[subdatabase.searchKey(c["moviehash"],
+                                                c["moviebytesize"])] == []]):
+            found.update(await searchHashes(again))
+        return found
+
+    async def searchQueries(searchlists):
+        # Search tag/query criteria (one list per video file)
+        rpc = await searchRequest([criteria for s in searchlists
+                                   for criteria in s])
+        found = subdatabase.parseQueries(searchlists, rpc)
+        for again in subdatabase.splitTruncated(
+                searchlists, rpc,
+                [i for i, results in enumerate(found) if results == []]):
+            for i, results in zip(again, await searchQueries(
+                    [searchlists[i] for i in again])):
+                found[i] = results
+        return found
+
+    async def search(batch):
+        found, searchlist = subdatabase.planSearch(
+            [s.searchlist[0] for s in batch])
+        if searchlist:
+            found.update(await searchHashes(searchlist))
+        for subtitle in batch:
+            subtitle.setSearchResult(found.get(subtitle.getSearchKey()),
+                                     download=False)
+            await dispatch(subtitle)
+
+    async def fallback(batch):
+        # Search the files not found by hash with their file name/title
+        found = await searchQueries([s.getFallbackSearch() for s in batch])
+        for subtitle, rpcdata in zip(batch, found):
+            subtitle.setFallbackResult(rpcdata, download=False)
+            await dispatch(subtitle)
+
+    async def download(batch):
+        ids = []
+        for subtitle in batch:
+            for winner in subtitle.getWinners():
+                if (str(winner["IDSubtitleFile"]) not in ids and
+                        subdatabase.getWritten(winner["IDSubtitleFile"])
+                        is None):
+                    ids.append(str(winner["IDSubtitleFile"]))
+        payloads = subdatabase.localPayloads(ids)
+        ids = [i for i in ids if i not in payloads]
+        # A batch has several subtitles by file with several languages:
+        # at most downloadbatchsize subtitles by request
+        for i in range(0, len(ids), downloadbatchsize):
+            chunk = ids[i:i + downloadbatchsize]
+            logging.debug("Download %s compressed subtitle files in one "
+                          "request" % len(chunk))
+            try:
+                rpc = await call("DownloadSubtitles", PRIORITY_DOWNLOAD,
+                                 await getToken(), chunk)
+            except Exception as msg:
+                logging.error("%s" % msg)
+            else:
+                payloads.update(subdatabase.parseDownload(rpc))
+        for subtitle in batch:
+            await loop.run_in_executor(executor, subtitle.setDownloadResult,
+                                       payloads)
+            done(subtitle)
+
+    async def requestStage(queue, size, request):
+        # Send the batches, at most jobs requests are in flight
+        running = set()
+        async for batch in batches(queue, size):
+            if len(running) >= jobs:
+                finished, running = await asyncio.wait(
+                    running, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    task.result()
+            running.add(loop.create_task(request(batch)))
+        if running:
+            finished, running = await asyncio.wait(running)
+            for task in finished:
+                task.result()
+
+    async def searchStage():
+        await requestStage(searchq, batchsize, search)
+        await fallbackq.put(None)
+
+    async def fallbackStage():
+        # At most two criteria (tag and query) by file
+        await requestStage(fallbackq, max(1, batchsize // 2), fallback)
+        await downloadq.put(None)
+
+    stages = [loop.run_in_executor(executor, walk),
+              loop.create_task(hashingStage()),
+              loop.create_task(searchStage()),
+              loop.create_task(fallbackStage()),
+              loop.create_task(requestStage(downloadq, downloadbatchsize,
+                                            download))]
+    try:
+        await asyncio.gather(*stages)
+    except BaseException:
+        # A stage (or the callback) failed: stop the other ones and do
+        # not wait for the threads
+        stop()
+        for stage in stages:
+            stage.cancel()
+        executor.shutdown(wait=False)
+        raise
+    else:
+        executor.shutdown()
+    finally:
+        transport.close()
+
+    return results
@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+#
+# Witsub
+# Where Is The (fuck...) Subtitle
+#
+# Local subtitle index (offline lookups by hash, memory-mapped)
+#
+# Copyright (C) 2016 Nicolargo <nicolas@nicolargo.com>
+#
+# Witsub is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Witsub is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# The index file is a header followed by fixed size records sorted by
+# (hash, size, language). The key is packed big-endian so the records
+# are sorted as bytes: a lookup is a binary search on the memory-mapped
+# file (nothing is loaded in memory). The subtitle files (gzip) are
+# stored in a second file (<index>.store) at the offset of their record.
+
+# Import lib
+import base64
+import bisect
+import collections
+import csv
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from .witsub import subDatabase, searchResults, writeAtomic, stats
+from .witsub import DEDUP_SIZE
+
+# Global variables
+# Header: magic, number of records
+INDEX_HEADER = struct.Struct(">8sQ")
+INDEX_MAGIC = b"WITSUBI1"
+# Record: hash, size, language, IDSubtitleFile, downloads, payload
+# offset and length in the store, encoding
+INDEX_RECORD = struct.Struct(">QQ4sQIQI12s")
+# Bytes of the key (hash, size, language) at the start of a record
+INDEX_KEY = struct.Struct(">QQ4s")
+# Extension of the payload store
+STORE_EXT = ".store"
+# Columns of the export (lower case) and their aliases
+EXPORT_COLUMNS = {"moviehash": ("moviehash", "hash"),
+                  "moviebytesize": ("moviebytesize", "size"),
+                  "sublanguageid": ("sublanguageid", "language", "lang"),
+                  "idsubtitlefile": ("idsubtitlefile", "id"),
+                  "subdownloadscnt": ("subdownloadscnt", "downloads"),
+                  "subencoding": ("subencoding", "encoding"),
+                  "subfilepath": ("subfilepath", "path", "file")}
+
+
+def indexKey(moviehash, moviebytesize, lang):
+    """
+    Return the packed key of a record
+    """
+    return INDEX_KEY.pack(int(str(moviehash), 16), int(moviebytesize),
+                          lang.encode("ascii")[:4])
+
+
+def readExport(exportfilename):
+    """
+    Yield the rows (dict of the EXPORT_COLUMNS) of a CSV or JSONL export
+    """
+    with open(exportfilename) as export:
+        if exportfilename.endswith((".jsonl", ".json")):
+            rows = (json.loads(line) for line in export if line.strip())
+        else:
+            rows = csv.DictReader(export)
+        for row in rows:
+            row = dict((str(k).strip().lower(), v) for k, v in row.items())
+            ret = {}
+            for column, aliases in EXPORT_COLUMNS.items():
+                for alias in aliases:
+                    if row.get(alias) not in (None, ""):
+                        ret[column] = row[alias]
+                        break
+            yield ret
+
+
+def readPayload(subfilepath):
+    """
+    Return the gzip data of a subtitle file (.gz files are kept as is)
+    """
+    with open(subfilepath, "rb") as subfile:
+        data = subfile.read()
+    if subfilepath.endswith(".gz"):
+        return data
+    gz = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return gz.compress(data) + gz.flush()
+
+
+def buildIndex(exportfilename, indexfilename):
+    """
+    Build the index (and the payload store) from a CSV/JSONL export with
+    the MovieHash, MovieByteSize, SubLanguageID and IDSubtitleFile
+    columns (SubDownloadsCnt, SubEncoding and SubFilePath, a subtitle
+    file relative to the export, are optional)
+    The records are sorted in memory
+    Return the number of records
+    """
+    folder = os.path.dirname(os.path.abspath(exportfilename))
+    rows = []
+    skipped = 0
+    for row in readExport(exportfilename):
+        try:
+            rows.append((indexKey(row["moviehash"], row["moviebytesize"],
+                                  row["sublanguageid"]),
+                         -int(row.get("subdownloadscnt", 0)),
+                         int(row["idsubtitlefile"]),
+                         row.get("subencoding", ""),
+                         row.get("subfilepath")))
+        except (KeyError, ValueError, UnicodeError, struct.error) as msg:
+            skipped += 1
+            logging.debug("Skip the export row %s (error: %s)" % (row, msg))
+    if skipped:
+        logging.warning("%s rows of %s skipped" % (skipped, exportfilename))
+    rows.sort()
+
+    # Payload store (one copy of each subtitle file)
+    def writeStore(store):
+        payloads = {}
+        for key, downloads, idsubtitlefile, encoding, path in rows:
+            if path is None or idsubtitlefile in payloads:
+                continue
+            try:
+                data = readPayload(os.path.join(folder, path))
+            except (IOError, OSError) as msg:
+                logging.warning("Can not read %s (error: %s)" % (path, msg))
+                continue
+            payloads[idsubtitlefile] = (store.tell(), len(data))
+            store.write(data)
+        return payloads
+    payloads = writeAtomic(indexfilename + STORE_EXT, writeStore)
+
+    def writeRecords(index):
+        index.write(INDEX_HEADER.pack(INDEX_MAGIC, len(rows)))
+        for key, downloads, idsubtitlefile, encoding, path in rows:
+            offset, length = payloads.get(idsubtitlefile, (0, 0))
+            index.write(key + INDEX_RECORD.pack(
+                0, 0, b"", idsubtitlefile, -downloads, offset, length,
+                encoding.encode("ascii")[:12])[INDEX_KEY.size:])
+    writeAtomic(indexfilename, writeRecords)
+    logging.info("%s records written to %s (%s subtitle files)"
+                 % (len(rows), indexfilename, len(payloads)))
+    return len(rows)
+
+
+def openMap(filename):
+    """
+    Memory-map a file (read only), None if empty
+    """
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class recordKeys(object):
+    """
+    Sequence of the record keys of a memory-mapped index (for bisect)
+    """
+
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        offset = INDEX_HEADER.size + i * INDEX_RECORD.size
+        return self.index[offset:offset + INDEX_KEY.size]
+
+
+class subIndex(object):
+    """
+    Local subtitle index built by buildIndex (read only)
+    """
+
+    def __init__(self, indexfilename):
+        self.indexfilename = indexfilename
+        self.index = openMap(indexfilename)
+        if self.index is None:
+            raise ValueError("Empty index %s" % indexfilename)
+        magic, count = INDEX_HEADER.unpack(self.index[:INDEX_HEADER.size])
+        if (magic != INDEX_MAGIC or len(self.index) !=
+                INDEX_HEADER.size + count * INDEX_RECORD.size):
+            raise ValueError("Invalid index %s" % indexfilename)
+        self.keys = recordKeys(self.index, count)
+        try:
+            self.store = openMap(indexfilename + STORE_EXT)
+        except (IOError, OSError):
+            self.store = None
+        # IDSubtitleFile => (offset, length) in the store of the last
+        # subtitles found (see payload)
+        self.located = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def close(self):
+        self.index.close()
+        if self.store is not None:
+            self.store.close()
+
+    def lookup(self, moviehash, moviebytesize, lang):
+        """
+        Return the subtitles of a hash/size and language as search
+        results (the most downloaded first)
+        """
+        key = indexKey(moviehash, moviebytesize, lang)
+        ret = []
+        i = bisect.bisect_left(self.keys, key)
+        while i < len(self.keys) and self.keys[i] == key:
+            offset = INDEX_HEADER.size + i * INDEX_RECORD.size
+            (h, s, l, idsubtitlefile, downloads, payload, length,
+             encoding) = INDEX_RECORD.unpack(
+                self.index[offset:offset + INDEX_RECORD.size])
+            ret.append({'IDSubtitleFile': str(idsubtitlefile),
+                        'SubDownloadLink': "%s#%s" % (self.indexfilename,
+                                                      idsubtitlefile),
+                        'SubFileName': "%s.srt" % idsubtitlefile,
+                        'SubLanguageID': lang,
+                        'LanguageName': lang,
+                        'SubDownloadsCnt': str(downloads),
+                        'SubEncoding': encoding.rstrip(b"\0")
+                        .decode("ascii"),
+                        'MovieHash': moviehash,
+                        'MovieByteSize': str(moviebytesize),
+                        'MatchedBy': "moviehash"})
+            if length:
+                with self.lock:
+                    self.located[str(idsubtitlefile)] = (payload, length)
+                    while len(self.located) > DEDUP_SIZE:
+                        self.located.popitem(last=False)
+            i += 1
+        return ret
+
+    def payload(self, idsubtitlefile):
+        """
+        Return the gzip data of a subtitle found by lookup
+        (None if not in the store)
+        """
+        with self.lock:
+            located = self.located.get(str(idsubtitlefile))
+        if located is None or self.store is None:
+            return None
+        offset, length = located
+        return self.store[offset:offset + length]
+
+
+class indexDatabase(subDatabase):
+    """
+    Subtitle database answered by a local index (subIndex instance)
+    The index misses are searched/downloaded with the XML-RPC database
+    """
+
+    def __init__(self, language="eng", index=None, **kwargs):
+        subDatabase.__init__(self, language, **kwargs)
+        self.index = index
+        # Index results and missing languages of the criteria sent
+        self.partial = {}
+
+    def planSearch(self, searchlist):
+        found, searchlist = subDatabase.planSearch(self, searchlist)
+        remote = []
+        hits = 0
+        for criteria in searchlist:
+            key = self.searchKey(criteria["moviehash"],
+                                 criteria["moviebytesize"])
+            results = []
+            missing = []
+            for lang in criteria["sublanguageid"].split(","):
+                try:
+                    rows = self.index.lookup(criteria["moviehash"],
+                                             criteria["moviebytesize"],
+                                             lang)
+                except (ValueError, UnicodeError, struct.error):
+                    rows = []
+                if rows:
+                    results.extend(rows)
+                else:
+                    missing.append(lang)
+            hits += len(criteria["sublanguageid"].split(",")) - len(missing)
+            if not missing:
+                found[key] = results
+                continue
+            if results:
+                with self.lock:
+                    self.partial[key] = (results, missing)
+            remote.append(dict(criteria, sublanguageid=",".join(missing)))
+        if hits:
+            stats.count("index_hits", hits)
+            logging.debug("%s criteria found in the index, %s searched"
+                          % (len(searchlist) - len(remote), len(remote)))
+        return found, remote
+
+    def parseSearch(self, searchlist, rpc):
+        ret = subDatabase.parseSearch(self, searchlist, rpc)
+        with self.lock:
+            for key in ret:
+                results, missing = self.partial.pop(key, (None, None))
+                if not results:
+                    continue
+                if ret[key] is None:
+                    # Request error: the index results are kept, only the
+                    # missing languages are errors
+                    ret[key] = searchResults(results, failed=missing)
+                else:
+                    ret[key][:0] = results
+        return ret
+
+    def localPayloads(self, ids):
+        ret = {}
+        for idsubtitlefile in ids:
+            data = self.index.payload(idsubtitlefile)
+            if data is not None:
+                ret[str(idsubtitlefile)] = base64.b64encode(data) \
+                    .decode("ascii")
+        return ret
@@ -0,0 +1,412 @@
+# -*- coding: utf-8 -*-
+#
+# Witsub
+# Where Is The (fuck...) Subtitle
+#
+# Caching XML-RPC proxy (one upstream session for many witsub hosts)
+#
+# Copyright (C) 2016 Nicolargo <nicolas@nicolargo.com>
+#
+# Witsub is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Witsub is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# The proxy serves the LogIn, LogOut, SearchSubtitles and
+# DownloadSubtitles methods used by subDatabase. The search results
+# (by criteria) and the subtitle payloads (by IDSubtitleFile) are cached
+# on disk. The misses of all the clients are grouped by batch and sent
+# upstream with the proxy session; a criteria or a subtitle requested by
+# several clients at the same time is sent once.
+
+# Import lib
+import base64
+import binascii
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+try:
+    # Python 2
+    from SimpleXMLRPCServer import SimpleXMLRPCServer
+    from SimpleXMLRPCServer import SimpleXMLRPCRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    # Python 3
+    from xmlrpc.server import SimpleXMLRPCServer
+    from xmlrpc.server import SimpleXMLRPCRequestHandler
+    from socketserver import ThreadingMixIn
+
+from .witsub import getCacheDir
+from .witsub import SEARCH_BATCH_SIZE, DOWNLOAD_BATCH_SIZE, CACHE_COMMIT_SIZE
+from .witsub import PROXY_CACHE_SIZE
+
+# Global variables
+# Proxy cache file (in the user cache folder)
+PROXY_FILENAME = "proxy.db"
+# Seconds before searching again a criteria
+PROXY_SEARCH_TTL = 24 * 3600
+# Number of upstream requests in flight
+PROXY_JOBS = 4
+# Seconds waited to fill a batch
+PROXY_LINGER = 0.05
+# Default port
+PROXY_PORT = 8090
+
+
+class proxyCache(object):
+    """
+    Search results and subtitle payloads of the proxy
+    (SQLite database, the least recently used entries are removed
+    above maxsize bytes)
+    """
+
+    def __init__(self, filename=None, maxsize=PROXY_CACHE_SIZE):
+        if filename is None:
+            filename = os.path.join(getCacheDir(), PROXY_FILENAME)
+        if not os.path.isdir(os.path.dirname(os.path.abspath(filename))):
+            os.makedirs(os.path.dirname(os.path.abspath(filename)))
+        logging.debug("Open the proxy cache %s" % filename)
+        self.maxsize = maxsize
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries "
+                        "(key TEXT PRIMARY KEY, data BLOB, size INTEGER, "
+                        "atime REAL, expires REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_atime "
+                        "ON entries (atime)")
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) "
+                                    "FROM entries").fetchone()[0]
+        self.updates = 0
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.commit()
+                self.db.close()
+                self.db = None
+
+    def __commit__(self):
+        # Commit by batch of CACHE_COMMIT_SIZE updates
+        self.updates += 1
+        if self.updates >= CACHE_COMMIT_SIZE:
+            self.db.commit()
+            self.updates = 0
+
+    def get(self, key):
+        """
+        Return the data of key (None if not in the cache or expired)
+        """
+        with self.lock:
+            row = self.db.execute("SELECT data, expires FROM entries "
+                                  "WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] is not None and row[1] < time.time():
+                self.__delete__(key)
+                return None
+            self.db.execute("UPDATE entries SET atime = ? WHERE key = ?",
+                            (time.time(), key))
+            self.__commit__()
+        return bytes(row[0])
+
+    def set(self, key, data, ttl=None):
+        """
+        Store the data (bytes) of key for ttl seconds (None for ever)
+        """
+        with self.lock:
+            self.__delete__(key)
+            self.db.execute("INSERT INTO entries VALUES (?, ?, ?, ?, ?)",
+                            (key, sqlite3.Binary(data), len(data),
+                             time.time(),
+                             None if ttl is None else time.time() + ttl))
+            self.size += len(data)
+            self.__evict__()
+            self.__commit__()
+
+    def __delete__(self, key):
+        row = self.db.execute("SELECT size FROM entries WHERE key = ?",
+                              (key,)).fetchone()
+        if row is not None:
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            self.size -= row[0]
+
+    def __evict__(self):
+        # Remove the least recently used entries above maxsize
+        while self.size > self.maxsize:
+            rows = self.db.execute("SELECT key, size FROM entries "
+                                   "ORDER BY atime LIMIT 100").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self.size -= size
+                if self.size <= self.maxsize:
+                    break
+
+
+class requestBatcher(object):
+    """
+    Fetch the keys requested by several threads by batch of size keys
+    with fetch(keys) => dict key: value
+    A key requested while it is in flight is fetched once (coalescing)
+    """
+
+    def __init__(self, fetch, size, jobs=PROXY_JOBS, linger=PROXY_LINGER):
+        self.fetch = fetch
+        self.size = size
+        self.linger = linger
+        self.cond = threading.Condition()
+        # Keys waiting for a batch and time of the oldest one
+        self.queue = []
+        self.first = None
+        # Key => [event, value]
+        self.inflight = {}
+        for i in range(jobs):
+            thread = threading.Thread(target=self.__worker__)
+            thread.daemon = True
+            thread.start()
+
+    def get(self, keys):
+        """
+        Return a dict key: value for the keys (None if not fetched)
+        """
+        entries = {}
+        with self.cond:
+            for key in keys:
+                entry = self.inflight.get(key)
+                if entry is None:
+                    entry = self.inflight[key] = [threading.Event(), None]
+                    if not self.queue:
+                        self.first = time.time()
+                    self.queue.append(key)
+                entries[key] = entry
+            self.cond.notify_all()
+        ret = {}
+        for key, entry in entries.items():
+            entry[0].wait()
+            ret[key] = entry[1]
+        return ret
+
+    def __worker__(self):
+        while True:
+            with self.cond:
+                # Wait for a full batch or the linger time
+                while True:
+                    timeout = None
+                    if len(self.queue) >= self.size:
+                        break
+                    if self.queue:
+                        timeout = self.first + self.linger - time.time()
+                        if timeout <= 0:
+                            break
+                    self.cond.wait(timeout)
+                batch = self.queue[:self.size]
+                del self.queue[:self.size]
+                self.first = time.time()
+            try:
+                values = self.fetch(batch)
+            except Exception as msg:
+                logging.error("Proxy upstream error (%s)" % msg)
+                values = {}
+            with self.cond:
+                for key in batch:
+                    entry = self.inflight.pop(key)
+                    entry[1] = values.get(key)
+                    entry[0].set()
+
+
+class proxyRequestHandler(SimpleXMLRPCRequestHandler):
+    """
+    HTTP/1.1 handler: the connections are kept alive
+    """
+    rpc_paths = ("/", "/xml-rpc", "/RPC2")
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.debug("Proxy request from %s: %s"
+                      % (self.address_string(), format % args))
+
+
+class proxyXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class subProxy(object):
+    """
+    Caching XML-RPC proxy of the subtitle database
+    subdatabase: the upstream subDatabase (its session is shared)
+    address: (host, port) of the proxy
+    """
+
+    def __init__(self, subdatabase, address=("127.0.0.1", PROXY_PORT),
+                 cache=None, searchttl=PROXY_SEARCH_TTL, jobs=PROXY_JOBS):
+        self.subdatabase = subdatabase
+        if cache is None:
+            cache = proxyCache()
+        self.cache = cache
+        self.searchttl = searchttl
+        self.searches = requestBatcher(self.__fetchSearches__,
+                                       SEARCH_BATCH_SIZE, jobs=jobs)
+        self.downloads = requestBatcher(self.__fetchDownloads__,
+                                        DOWNLOAD_BATCH_SIZE, jobs=jobs)
+        self.server = proxyXMLRPCServer(address,
+                                        requestHandler=proxyRequestHandler,
+                                        logRequests=True, allow_none=True)
+        for method in ("LogIn", "LogOut", "SearchSubtitles",
+                       "DownloadSubtitles"):
+            self.server.register_function(getattr(self, method), method)
+        self.url = "http://%s:%d/xml-rpc" % self.server.server_address[:2]
+
+    def serve(self):
+        """
+        Serve the requests until interrupted
+        """
+        logging.info("Proxy of %s listening on %s"
+                     % (self.subdatabase.url, self.url))
+        try:
+            self.server.serve_forever()
+        finally:
+            self.close()
+
+    def start(self):
+        """
+        Serve the requests in a background thread
+        """
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.close()
+
+    def close(self):
+        self.server.server_close()
+        self.cache.close()
+
+    def LogIn(self, username, password, language, useragent):
+        # The clients share the upstream session (see subdatabase)
+        return {'status': "200 OK", 'token': "proxy", 'seconds': 0.0}
+
+    def LogOut(self, token):
+        return {'status': "200 OK", 'seconds': 0.0}
+
+    def SearchSubtitles(self, token, searchlist):
+        start = time.time()
+        keys = [json.dumps(criteria, sort_keys=True)
+                for criteria in searchlist]
+        found = {}
+        for key in set(keys):
+            data = self.cache.get("search:" + key)
+            if data is not None:
+                found[key] = json.loads(data.decode("utf-8"))
+        missing = [key for key in set(keys) if key not in found]
+        if missing:
+            logging.debug("Search %s criteria upstream (%s cached)"
+                          % (len(missing), len(keys) - len(missing)))
+            found.update(self.searches.get(missing))
+        if [key for key in keys if found.get(key) is None]:
+            return {'status': "503 Service Unavailable",
+                    'seconds': time.time() - start}
+        # Results numbered as the criteria of the client
+        data = []
+        for number, key in enumerate(keys):
+            for result in found[key]:
+                result = dict(result)
+                result['QueryNumber'] = str(number)
+                data.append(result)
+        return {'status': "200 OK", 'data': data or False,
+                'seconds': time.time() - start}
+
+    def DownloadSubtitles(self, token, ids):
+        start = time.time()
+        ids = [str(idsubtitlefile) for idsubtitlefile in ids]
+        found = {}
+        for idsubtitlefile in set(ids):
+            data = self.cache.get("sub:" + idsubtitlefile)
+            if data is not None:
+                found[idsubtitlefile] = base64.b64encode(data).decode("ascii")
+        missing = [i for i in set(ids) if i not in found]
+        if missing:
+            logging.debug("Download %s subtitles upstream (%s cached)"
+                          % (len(missing), len(set(ids)) - len(missing)))
+            found.update(self.downloads.get(missing))
+        data = []
+        for idsubtitlefile in ids:
+            if found.get(idsubtitlefile) is not None:
+                data.append({'idsubtitlefile': idsubtitlefile,
+                             'data': found.pop(idsubtitlefile)})
+        return {'status': "200 OK", 'data': data,
+                'seconds': time.time() - start}
+
+    def __fetchSearches__(self, keys):
+        # Search a batch of criteria upstream and cache the results
+        searchlist = [json.loads(key) for key in keys]
+        rpc = self.subdatabase.search(searchlist)
+        if rpc is None:
+            return {}
+        ret = dict((key, []) for key in keys)
+        byhash = dict((self.subdatabase.searchKey(c["moviehash"],
+                                                  c["moviebytesize"]), key)
+                      for c, key in zip(searchlist, keys)
+                      if "moviehash" in c)
+        for data in rpc["data"] or []:
+            try:
+                key = keys[int(data["QueryNumber"])]
+            except (KeyError, ValueError, IndexError):
+                # Match the hash criteria without QueryNumber
+                key = byhash.get(self.subdatabase.searchKey(
+                    data.get("MovieHash", "0"),
+                    data.get("MovieByteSize", "0")))
+                if key is None:
+                    continue
+            ret[key].append(data)
+        # The criteria without result of a truncated reply are searched
+        # again (and cached there): never cache them as without result
+        retried = set()
+        for batch in self.subdatabase.splitTruncated(
+                searchlist, rpc, [key for key in keys if not ret[key]]):
+            retried.update(batch)
+            found = self.__fetchSearches__(batch)
+            for key in batch:
+                if key in found:
+                    ret[key] = found[key]
+                else:
+                    del ret[key]
+        for key in keys:
+            if key not in ret or key in retried:
+                continue
+            self.cache.set("search:" + key,
+                           json.dumps(ret[key]).encode("utf-8"),
+                           ttl=self.searchttl)
+        return ret
+
+    def __fetchDownloads__(self, ids):
+        # Download a batch of subtitles upstream and cache the payloads
+        payloads = self.subdatabase.downloadMany(
+            [{"IDSubtitleFile": idsubtitlefile} for idsubtitlefile in ids])
+        for idsubtitlefile, data in payloads.items():
+            self.cache.set("sub:" + idsubtitlefile,
+                           binascii.a2b_base64(data))
+        return payloads
+
+
+def parseAddress(address):
+    """
+    Return (host, port) from a [host:]port string
+    """
+    host, sep, port = address.rpartition(":")
+    return (host or "127.0.0.1", int(port))
@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+#
+# Witsub
+# Where Is The (fuck...) Subtitle
+#
+# Distributed mode (shared work queue with leases)
+#
+# Copyright (C) 2016 Nicolargo <nicolas@nicolargo.com>
+#
+# Witsub is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Witsub is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# The coordinator (witsub --enqueue) adds the video files of a folder tree
+# to a SQLite database, on the share or any path seen by all the hosts.
+# The workers (witsub --worker) lease chunks of files, get their
+# subtitles and commit the outcomes. A lease is renewed each time the
+# worker commits outcomes; the files of an expired lease (dead worker)
+# are leased again by the other workers.
+
+# Import lib
+import logging
+import os
+import socket
+import sqlite3
+import time
+
+from .witsub import videoItem
+from .witsub import GET_SUB_ERROR, GET_DWNL_ERROR, SEARCH_BATCH_SIZE
+
+# Global variables
+# Files by lease
+QUEUE_CHUNK = 100
+# Seconds before a lease expires (renewed by each commit)
+LEASE_TTL = 10 * 60
+# Seconds between two polls when the other workers hold all the files
+QUEUE_POLL = 30.0
+# Seconds to wait for the lock of the database
+QUEUE_TIMEOUT = 60.0
+# Number of tries of a file with a request error
+QUEUE_ATTEMPTS = 3
+# Outcomes tried again by another lease
+QUEUE_RETRY = (GET_SUB_ERROR, GET_DWNL_ERROR)
+# Outcome of a file removed since it was queued
+QUEUE_REMOVED = "Removed"
+# Number of files added by transaction
+QUEUE_COMMIT_SIZE = 1000
+
+# States of a file
+STATE_PENDING = "pending"
+STATE_LEASED = "leased"
+STATE_DONE = "done"
+
+# Limit import to
+__all__ = ['workQueue', 'enqueueVideos', 'runWorker']
+
+
+# Classes
+class workQueue(object):
+    """
+    Class used to share the video files between workers
+    (SQLite database, one row by video file)
+    """
+
+    def __init__(self, filename, ttl=LEASE_TTL, attempts=QUEUE_ATTEMPTS):
+        logging.debug("Open the work queue %s" % filename)
+        self.filename = filename
+        self.ttl = ttl
+        self.attempts = attempts
+        # Transactions are explicit (see __transaction__)
+        self.db = sqlite3.connect(filename, timeout=QUEUE_TIMEOUT,
+                                  isolation_level=None)
+        self.db.execute("CREATE TABLE IF NOT EXISTS files "
+                        "(path TEXT PRIMARY KEY, state TEXT, worker TEXT, "
+                        "expires REAL, attempts INTEGER, outcome TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS files_state "
+                        "ON files (state, expires)")
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def __transaction__(self, statements):
+        # Run (sql, parameters) statements in one write transaction
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            for sql, parameters in statements:
+                self.db.execute(sql, parameters)
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+
+    def add(self, videofilenames):
+        """
+        Add the video files (the ones already in the queue are kept)
+        Return the number of files added
+        """
+        before = self.size()
+        batch = []
+        for videofilename in videofilenames:
+            batch.append(("INSERT OR IGNORE INTO files VALUES "
+                          "(?, ?, NULL, NULL, 0, NULL)",
+                          (os.path.abspath(videofilename), STATE_PENDING)))
+            if len(batch) >= QUEUE_COMMIT_SIZE:
+                self.__transaction__(batch)
+                batch = []
+        if batch:
+            self.__transaction__(batch)
+        return self.size() - before
+
+    def size(self):
+        return self.db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def lease(self, worker, size=QUEUE_CHUNK):
+        """
+        Lease size files (pending or with an expired lease) to worker
+        Return the list of the file names
+        """
+        now = time.time()
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            paths = [row[0] for row in self.db.execute(
+                "SELECT path FROM files WHERE state = ? OR "
+                "(state = ? AND expires < ?) LIMIT ?",
+                (STATE_PENDING, STATE_LEASED, now, size))]
+            for path in paths:
+                self.db.execute("UPDATE files SET state = ?, worker = ?, "
+                                "expires = ? WHERE path = ?",
+                                (STATE_LEASED, worker, now + self.ttl, path))
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+        return paths
+
+    def complete(self, worker, results):
+        """
+        Commit the outcomes of worker (subResult or subTitle objects)
+        and renew its other leases
+        The outcomes of a lease lost (expired and leased again) are ignored
+        """
+        statements = []
+        for result in results:
+            outcome = result.getOutcome()
+            if outcome in QUEUE_RETRY:
+                # Leased again until the maximum number of attempts
+                statements.append((
+                    "UPDATE files SET state = CASE WHEN attempts + 1 < ? "
+                    "THEN ? ELSE ? END, attempts = attempts + 1, "
+                    "worker = NULL, outcome = ? "
+                    "WHERE path = ? AND worker = ?",
+                    (self.attempts, STATE_PENDING, STATE_DONE, outcome,
+                     os.path.abspath(result.getVideoFileName()), worker)))
+            else:
+                statements.append((
+                    "UPDATE files SET state = ?, worker = NULL, outcome = ? "
+                    "WHERE path = ? AND worker = ?",
+                    (STATE_DONE, outcome,
+                     os.path.abspath(result.getVideoFileName()), worker)))
+        statements.append(("UPDATE files SET expires = ? "
+                           "WHERE state = ? AND worker = ?",
+                           (time.time() + self.ttl, STATE_LEASED, worker)))
+        self.__transaction__(statements)
+
+    def release(self, worker):
+        """
+        Give back the files leased by worker (interrupted)
+        """
+        self.__transaction__([("UPDATE files SET state = ?, worker = NULL "
+                               "WHERE state = ? AND worker = ?",
+                               (STATE_PENDING, STATE_LEASED, worker))])
+
+    def getCounts(self):
+        """
+        Return a dict: state => number of files
+        """
+        return dict(self.db.execute("SELECT state, COUNT(*) FROM files "
+                                    "GROUP BY state").fetchall())
+
+
+class removedFile(object):
+    """
+    Outcome of a video file removed since it was queued
+    """
+
+    def __init__(self, videofilename):
+        self.videofilename = videofilename
+
+    def getVideoFileName(self):
+        return self.videofilename
+
+    def getOutcome(self):
+        return QUEUE_REMOVED
+
+
+# Functions
+def getWorkerId():
+    """
+    Return the identifier of this worker (host and process)
+    """
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+def enqueueVideos(queue, videofilenames):
+    """
+    Add the video files (file names or scanVideos items) to the queue
+    Return the number of files added
+    """
+    return queue.add(videoItem(item)[0] for item in videofilenames)
+
+
+def runWorker(subdatabase, queue, worker=None, chunk=QUEUE_CHUNK,
+              overwrite=False, callback=None, poll=QUEUE_POLL):
+    """
+    Lease chunks of files and get their subtitles until the queue is done
+    callback is called with each result (subResult)
+    Return the number of files processed
+    """
+    if worker is None:
+        worker = getWorkerId()
+    logging.info("Worker %s started on %s" % (worker, queue.filename))
+    processed = 0
+    try:
+        while True:
+            paths = queue.lease(worker, chunk)
+            if not paths:
+                if not queue.getCounts().get(STATE_LEASED):
+                    break
+                # Wait for the leases of the other workers (or their
+                # expiration)
+                time.sleep(poll)
+                continue
+            logging.debug("%s files leased by %s" % (len(paths), worker))
+            results = [removedFile(p) for p in paths
+                       if not os.path.exists(p)]
+            for result in subdatabase.fetchMany(
+                    [p for p in paths if os.path.exists(p)],
+                    overwrite=overwrite):
+                if callback is not None:
+                    callback(result)
+                results.append(result)
+                if len(results) >= SEARCH_BATCH_SIZE:
+                    queue.complete(worker, results)
+                    processed += len(results)
+                    results = []
+            queue.complete(worker, results)
+            processed += len(results)
+            if not subdatabase.batchAllowed():
+                # Give back the files not processed
+                queue.release(worker)
+                logging.info("Budget reached, worker %s stopped" % worker)
+                break
+    except:
+        queue.release(worker)
+        raise
+    logging.info("Worker %s done: %s files processed" % (worker, processed))
+    return processed
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+#
+# Witsub
+# Where Is The (fuck...) Subtitle
+#
+# Results report (JSONL) and its summary
+#
+# Copyright (C) 2016 Nicolargo <nicolas@nicolargo.com>
+#
+# Witsub is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Witsub is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# The report has one JSON object by line and by video file. The lines
+# are written by batch of REPORT_BUFFER_SIZE: the memory used does not
+# depend on the number of files.
+
+# Import lib
+import json
+import logging
+import os
+import threading
+
+# Global variables
+# Lines written by batch
+REPORT_BUFFER_SIZE = 1000
+# Directories displayed by the summary (the ones with most files)
+SUMMARY_FOLDERS = 20
+
+# Limit import to
+__all__ = ['reportWriter', 'summarizeReport', 'printSummary']
+
+
+# Classes
+class reportWriter(object):
+    """
+    Class used to write the results (subResult) to a JSONL report
+    """
+
+    def __init__(self, filename, buffersize=REPORT_BUFFER_SIZE):
+        logging.debug("Write the report to %s" % filename)
+        self.filename = filename
+        self.buffersize = buffersize
+        self.report = open(filename, "a")
+        self.lines = []
+        # The results can be written by several threads
+        self.lock = threading.Lock()
+
+    def write(self, result):
+        """
+        Add a result (subResult) to the report
+        """
+        line = json.dumps({"path": result.path,
+                           "size": result.size,
+                           "hash": result.hash,
+                           "language": result.language,
+                           "outcome": result.outcome,
+                           "subtitleid": result.subtitleid,
+                           "downloads": result.downloads,
+                           "match": result.match,
+                           "seconds": round(result.seconds, 6),
+                           "stages": dict((stage, round(seconds, 6))
+                                          for stage, seconds
+                                          in result.timings.items())},
+                          sort_keys=True)
+        with self.lock:
+            self.lines.append(line)
+            if len(self.lines) >= self.buffersize:
+                self.__flush__()
+
+    def __flush__(self):
+        if self.lines:
+            self.report.write("\n".join(self.lines) + "\n")
+            self.report.flush()
+            self.lines = []
+
+    def close(self):
+        with self.lock:
+            self.__flush__()
+            self.report.close()
+
+
+# Functions
+def summarizeReport(filename):
+    """
+    Aggregate a report (read line by line)
+    Return a dict with the number of files and the time by outcome
+    (outcomes) and the number of files by outcome of each directory
+    (folders)
+    """
+    outcomes = {}
+    folders = {}
+    with open(filename) as report:
+        for line in report:
+            if not line.strip():
+                continue
+            try:
+                result = json.loads(line)
+            except ValueError:
+                logging.warning("Invalid report line: %s" % line.strip())
+                continue
+            outcome = result.get("outcome")
+            files, seconds = outcomes.get(outcome, (0, 0.0))
+            outcomes[outcome] = (files + 1,
+                                 seconds + (result.get("seconds") or 0.0))
+            folder = folders.setdefault(
+                os.path.dirname(result.get("path", "")), {})
+            folder[outcome] = folder.get(outcome, 0) + 1
+    return {"outcomes": outcomes, "folders": folders}
+
+
+def printSummary(summary, folders=SUMMARY_FOLDERS):
+    """
+    Display a summary (see summarizeReport)
+    """
+    total = sum(files for files, seconds in summary["outcomes"].values())
+    print("%-20s %10s %8s %12s" % ("Outcome", "Files", "%", "Avg (s)"))
+    for outcome, (files, seconds) in sorted(
+            summary["outcomes"].items(), key=lambda item: -item[1][0]):
+        print("%-20s %10d %7.1f%% %12.3f"
+              % (outcome, files, 100.0 * files / total, seconds / files))
+    print("%-20s %10d" % ("Total", total))
+    print("")
+    print("Folders (the %d with most files)" % folders)
+    for folder, counts in sorted(
+            summary["folders"].items(),
+            key=lambda item: -sum(item[1].values()))[:folders]:
+        print("%8d %s" % (sum(counts.values()), folder))
+        print("         %s" % ", ".join("%s: %d" % (outcome, files)
+                                        for outcome, files
+                                        in sorted(counts.items())))
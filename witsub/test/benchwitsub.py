@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Witsub
+# Where Is The (fuck...) Subtitle
+#
+# Benchmark suite (synthetic video trees and local XML-RPC server)
+#
+# Copyright (C) 2016 Nicolargo <nicolas@nicolargo.com>
+#
+# Witsub is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Witsub is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Syntax
+__doc__ = '''\
+Usage: python -m witsub.test.benchwitsub [options]
+
+Run the witsub benchmarks on a synthetic video tree and a local
+XML-RPC server.
+
+Options:
+    -h: Display this help and exit
+    -V: Switch on debug mode (verbose)
+    -n <files>: Number of video files (default is 1000)
+    -s <scenario>: Run only this scenario (can be used several times)
+                   hash, scan, sync, async or rerun
+    --srt <ratio>: Ratio of video files with a subtitle (default is 0.3)
+    --latency <s>: Latency of the XML-RPC requests (default is 0.05)
+    --errors <ratio>: Ratio of XML-RPC requests failing with a 503
+    --quota <n>: Maximum number of subtitle files downloaded by session
+    --rate <n>: Maximum number of requests per second of the server
+    --client-rate <n>: Maximum number of requests per second of witsub
+                       (default is 0 for no limit)
+    --path <path>: Create the video tree in this folder (kept at exit)
+    --json <path>: Save the results to a JSON file
+'''
+
+# Import lib
+import getopt
+import json
+import logging
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+from witsub.witsub import subDatabase, subCache, getSubTitles, hashFiles
+from witsub.witsub import scanVideos, stats, clock
+from witsub.witsub import HASH_BLOCK_SIZE, HASH_JOBS
+from witsub.test.serverwitsub import subServer
+
+# Global variables
+# Video files by folder and sub-folders by folder of the trees
+TREE_FILES = 20
+TREE_FANOUT = 8
+# Extensions of the video files
+TREE_EXT = (".avi", ".mkv", ".mp4")
+# Size range of the video files (sparse files)
+TREE_MIN_SIZE = 100 * 1024 * 1024
+TREE_MAX_SIZE = 4 * 1024 * 1024 * 1024
+# Scenarios (in this order)
+SCENARIOS = ("hash", "scan", "sync", "async", "rerun")
+# Number of requests in flight of the asyncio engine
+ASYNC_JOBS = 4
+
+
+def makeTree(path, files=1000, srtratio=0.3, minsize=TREE_MIN_SIZE,
+             maxsize=TREE_MAX_SIZE, seed=0):
+    """
+    Create a synthetic video tree in path: files sparse video files
+    (only a random word of the blocks read by the hash is written)
+    and a subtitle for srtratio of them
+    Return the list of the video file names
+    """
+    rand = random.Random(seed)
+    videofilenames = []
+    folders = [path]
+    while len(videofilenames) < files:
+        folder = folders.pop(0)
+        for i in range(TREE_FANOUT):
+            subfolder = os.path.join(folder, "folder%d" % i)
+            os.mkdir(subfolder)
+            folders.append(subfolder)
+        for i in range(min(TREE_FILES, files - len(videofilenames))):
+            videofilename = os.path.join(
+                folder, "video%06d%s" % (len(videofilenames),
+                                         rand.choice(TREE_EXT)))
+            size = rand.randint(minsize, maxsize)
+            with open(videofilename, "wb") as video:
+                video.write(struct.pack("<Q", rand.getrandbits(64)))
+                video.seek(size - 8)
+                video.write(struct.pack("<Q", rand.getrandbits(64)))
+            if rand.random() < srtratio:
+                srt = videofilename[:videofilename.rfind('.')] + ".srt"
+                open(srt, "w").close()
+            videofilenames.append(videofilename)
+    return videofilenames
+
+
+def benchHash(path, videofilenames, server, rate, jobs=HASH_JOBS):
+    """
+    Hash the video files with jobs threads
+    (the blocks are in the page cache after the first run)
+    """
+    size = 0
+    for videofilename, filesize, hash in hashFiles(videofilenames,
+                                                   jobs=jobs):
+        size += 2 * HASH_BLOCK_SIZE
+    return {"bytes": size}
+
+
+def benchScan(path, videofilenames, server, rate):
+    """
+    Scan the video tree
+    """
+    return {"videos": sum(1 for item in scanVideos(path))}
+
+
+def benchSync(path, videofilenames, server, rate, cache=None):
+    """
+    Get the subtitles with the batched engine
+    """
+    subdatabase = subDatabase(cache=cache, rate=rate, url=server.url)
+    outcomes = {}
+    for subtitle in getSubTitles(subdatabase, scanVideos(path)):
+        outcome = subtitle.getOutcome()
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    subdatabase.close()
+    return outcomes
+
+
+def benchAsync(path, videofilenames, server, rate):
+    """
+    Get the subtitles with the asyncio engine
+    """
+    import asyncio
+    from witsub.asyncwitsub import getSubTitlesAsync
+    subdatabase = subDatabase(rate=rate, url=server.url)
+    outcomes = {}
+    loop = asyncio.new_event_loop()
+    try:
+        for subtitle in loop.run_until_complete(
+                getSubTitlesAsync(subdatabase, scanVideos(path),
+                                  jobs=ASYNC_JOBS)):
+            outcome = subtitle.getOutcome()
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    finally:
+        loop.close()
+    subdatabase.close()
+    return outcomes
+
+
+def removeSubtitles(path, keep):
+    """
+    Remove the subtitles written by a scenario (keep the initial ones)
+    """
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            filename = os.path.join(root, name)
+            if name.endswith(".srt") and filename not in keep:
+                os.remove(filename)
+
+
+def runScenarios(path, videofilenames, server, scenarios=SCENARIOS,
+                 rate=0):
+    """
+    Run the scenarios on the video tree
+    Return the list of the results (one dict by scenario)
+    """
+    keep = set(os.path.join(root, name)
+               for root, dirs, files in os.walk(path)
+               for name in files if name.endswith(".srt"))
+    cachedir = tempfile.mkdtemp()
+    results = []
+    try:
+        for scenario in scenarios:
+            removeSubtitles(path, keep)
+            if scenario == "hash":
+                bench = benchHash
+            elif scenario == "scan":
+                bench = benchScan
+            elif scenario == "sync":
+                bench = benchSync
+            elif scenario == "async":
+                if sys.version_info < (3, 7):
+                    logging.warning("Asyncio engine needs Python 3.7")
+                    continue
+                bench = benchAsync
+            elif scenario == "rerun":
+                # Two runs with the cache: the second one (nothing new
+                # to download) is measured
+                cache = subCache(os.path.join(cachedir, "cache.db"))
+                benchSync(path, videofilenames, server, rate, cache=cache)
+
+                def bench(path, videofilenames, server, rate):
+                    return benchSync(path, videofilenames, server, rate,
+                                     cache=cache)
+            else:
+                logging.error("Unknown scenario %s" % scenario)
+                continue
+            stats.reset()
+            server.reset()
+            start = clock()
+            result = bench(path, videofilenames, server, rate)
+            duration = clock() - start
+            if scenario == "rerun":
+                cache.close()
+            result.update(server.getStats())
+            result.update({"scenario": scenario, "duration": duration,
+                           "files": len(videofilenames),
+                           "files/s": len(videofilenames) / duration})
+            for stage, (count, total, maximum, h) in stats.stages.items():
+                if count:
+                    result["%s_seconds" % stage] = total
+            results.append(result)
+    finally:
+        shutil.rmtree(cachedir)
+    return results
+
+
+def printResults(results):
+    """
+    Display the results of the scenarios
+    """
+    print("%-8s %8s %10s %10s %8s %9s %9s"
+          % ("Scenario", "Files", "Time (s)", "Files/s", "Search",
+             "Download", "Errors"))
+    for result in results:
+        print("%-8s %8d %10.2f %10.1f %8d %9d %9d"
+              % (result["scenario"], result["files"], result["duration"],
+                 result["files/s"],
+                 result.get("calls_SearchSubtitles", 0),
+                 result.get("calls_DownloadSubtitles", 0),
+                 result["errors"]))
+
+
+def main():
+    """
+    Main function: manage CLI
+    """
+
+    # Manage args
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hVn:s:",
+                                   ["srt=", "latency=", "errors=", "quota=",
+                                    "rate=", "client-rate=", "path=",
+                                    "json="])
+    except getopt.GetoptError as err:
+        print("Error: " + str(err))
+        print(__doc__)
+        sys.exit(2)
+    arg_files = 1000
+    arg_scenarios = []
+    arg_srt = 0.3
+    arg_latency = 0.05
+    arg_errors = 0.0
+    arg_quota = None
+    arg_rate = None
+    arg_clientrate = 0
+    arg_path = None
+    arg_json = None
+    level = logging.WARNING
+    for opt, arg in opts:
+        if opt == "-h":
+            print(__doc__)
+            sys.exit(0)
+        elif opt == "-V":
+            level = logging.DEBUG
+        elif opt == "-n":
+            arg_files = int(arg)
+        elif opt == "-s":
+            arg_scenarios.append(arg)
+        elif opt == "--srt":
+            arg_srt = float(arg)
+        elif opt == "--latency":
+            arg_latency = float(arg)
+        elif opt == "--errors":
+            arg_errors = float(arg)
+        elif opt == "--quota":
+            arg_quota = int(arg)
+        elif opt == "--rate":
+            arg_rate = int(arg)
+        elif opt == "--client-rate":
+            arg_clientrate = float(arg)
+        elif opt == "--path":
+            arg_path = arg
+        elif opt == "--json":
+            arg_json = arg
+    logging.basicConfig(level=level,
+                        format='%(asctime)s %(levelname)s - %(message)s')
+
+    # Synthetic video tree
+    if arg_path is None:
+        path = tempfile.mkdtemp()
+    else:
+        path = arg_path
+        os.makedirs(path)
+    start = time.time()
+    videofilenames = makeTree(path, files=arg_files, srtratio=arg_srt)
+    logging.warning("%d video files created in %s (%.1f seconds)"
+                    % (len(videofilenames), path, time.time() - start))
+
+    # Local XML-RPC server
+    server = subServer(latency=arg_latency, errorrate=arg_errors,
+                       quota=arg_quota, ratelimit=arg_rate).start()
+    try:
+        results = runScenarios(path, videofilenames, server,
+                               scenarios=arg_scenarios or SCENARIOS,
+                               rate=arg_clientrate)
+    finally:
+        server.stop()
+        if arg_path is None:
+            shutil.rmtree(path)
+
+    printResults(results)
+    if arg_json is not None:
+        with open(arg_json, "w") as output:
+            json.dump(results, output, indent=2)
+
+
+# Main
+#=====
+
+if __name__ == "__main__":
+    main()
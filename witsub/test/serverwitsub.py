@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+#
+# Witsub
+# Where Is The (fuck...) Subtitle
+#
+# Local stand-in of the Opensubtitles XML-RPC API (tests and benchmarks)
+#
+# Copyright (C) 2016 Nicolargo <nicolas@nicolargo.com>
+#
+# Witsub is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Witsub is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# The subtitle database is computed from the criteria: a hash/tag/query
+# has subtitles if its CRC is below the hit rate, so the same tree gives
+# the same results between two runs.
+
+# Import lib
+import base64
+import gzip
+import io
+import random
+import threading
+import time
+import zlib
+try:
+    # Python 2
+    from SimpleXMLRPCServer import SimpleXMLRPCServer
+    from SimpleXMLRPCServer import SimpleXMLRPCRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    # Python 3
+    from xmlrpc.server import SimpleXMLRPCServer
+    from xmlrpc.server import SimpleXMLRPCRequestHandler
+    from socketserver import ThreadingMixIn
+
+# Global variables
+# Subtitles by hash and language (sorted by downloads)
+SUBS_BY_HASH = 3
+# Size of the generated subtitle files
+SUB_SIZE = 32768
+# XML-RPC path of the server
+XMLRPC_PATH = "/xml-rpc"
+# Maximum number of results of a search
+SEARCH_LIMIT = 500
+
+
+class subRequestHandler(SimpleXMLRPCRequestHandler):
+    """
+    HTTP/1.1 handler: the connections are kept alive
+    """
+    rpc_paths = (XMLRPC_PATH,)
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+
+class subXMLRPCServer(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+class subServer(object):
+    """
+    Local stand-in of the Opensubtitles XML-RPC API
+    LogIn, LogOut, SearchSubtitles and DownloadSubtitles are implemented
+
+    latency: seconds added to each request
+    errorrate: ratio of requests answered by "503 Service Unavailable"
+    ratelimit: maximum number of requests per second ("429 Too Many
+               Requests" above, None for no limit)
+    quota: maximum number of subtitle files downloaded by session
+           ("407 Download limit reached" above, None for no limit)
+    sessionttl: seconds before a session token expires
+                ("401 Unauthorized" after, None for no expiration)
+    hitrate: ratio of the hashes (and tags/queries) with subtitles
+    maxresults: maximum number of results of a search (the others are
+                dropped)
+    """
+
+    def __init__(self, latency=0.0, errorrate=0.0, ratelimit=None,
+                 quota=None, sessionttl=None, hitrate=0.8, port=0,
+                 maxresults=SEARCH_LIMIT):
+        self.latency = latency
+        self.errorrate = errorrate
+        self.ratelimit = ratelimit
+        self.quota = quota
+        self.sessionttl = sessionttl
+        self.hitrate = hitrate
+        self.maxresults = maxresults
+        self.lock = threading.Lock()
+        self.random = random.Random(0)
+        # Token => [expiration, number of files downloaded]
+        self.sessions = {}
+        self.window = []
+        self.reset()
+        self.server = subXMLRPCServer(("127.0.0.1", port),
+                                      requestHandler=subRequestHandler,
+                                      logRequests=False, allow_none=True)
+        for method in ("LogIn", "LogOut", "SearchSubtitles",
+                       "DownloadSubtitles"):
+            self.server.register_function(getattr(self, method), method)
+        self.url = "http://127.0.0.1:%d%s" % (self.server.server_address[1],
+                                              XMLRPC_PATH)
+        self.thread = None
+
+    def start(self):
+        """
+        Serve the requests in a background thread
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        """
+        Reset the counters
+        """
+        with self.lock:
+            # Method => number of requests
+            self.calls = {}
+            self.criteria = 0
+            self.downloaded = 0
+            self.errors = 0
+
+    def getStats(self):
+        """
+        Return the counters as a dict
+        """
+        with self.lock:
+            ret = dict(("calls_" + m, n) for m, n in self.calls.items())
+            ret.update({"criteria": self.criteria,
+                        "downloaded": self.downloaded,
+                        "errors": self.errors})
+        return ret
+
+    def __request__(self, method, token=None):
+        # Count the request, wait and return an error status (or None)
+        time.sleep(self.latency)
+        now = time.time()
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if self.ratelimit is not None:
+                self.window = [t for t in self.window if t > now - 1]
+                if len(self.window) >= self.ratelimit:
+                    self.errors += 1
+                    return "429 Too Many Requests"
+                self.window.append(now)
+            if self.random.random() < self.errorrate:
+                self.errors += 1
+                return "503 Service Unavailable"
+            if token is not None:
+                session = self.sessions.get(token)
+                if session is None or (session[0] is not None and
+                                       session[0] < now):
+                    self.sessions.pop(token, None)
+                    return "401 Unauthorized"
+        return None
+
+    def __hit__(self, key):
+        # Deterministic: key has subtitles if its CRC is below the hit rate
+        crc = zlib.crc32(key.encode("utf-8")) & 0xFFFFFFFF
+        return crc < self.hitrate * 0x100000000
+
+    def __subtitle__(self, key, lang, rank, criteria):
+        idsubtitlefile = str(zlib.crc32(("%s:%s:%s" % (key, lang, rank))
+                                        .encode("utf-8")) & 0x7FFFFFFF)
+        return {'IDSubtitleFile': idsubtitlefile,
+                'SubDownloadLink': "%s/download/%s" % (self.url,
+                                                       idsubtitlefile),
+                'SubFileName': "%s.%s.%s.srt" % (key, lang, rank),
+                'SubLanguageID': lang,
+                'LanguageName': lang,
+                'SubDownloadsCnt': str(1000 // (rank + 1)),
+                'SubEncoding': "UTF-8",
+                'MovieHash': criteria.get('moviehash', "0"),
+                'MovieByteSize': criteria.get('moviebytesize', "0")}
+
+    def LogIn(self, username, password, language, useragent):
+        status = self.__request__("LogIn")
+        if status is not None:
+            return {'status': status, 'seconds': self.latency}
+        token = "%032x" % self.random.getrandbits(128)
+        with self.lock:
+            self.sessions[token] = [
+                None if self.sessionttl is None
+                else time.time() + self.sessionttl, 0]
+        return {'status': "200 OK", 'token': token, 'seconds': self.latency}
+
+    def LogOut(self, token):
+        status = self.__request__("LogOut", token)
+        with self.lock:
+            self.sessions.pop(token, None)
+        return {'status': status or "200 OK", 'seconds': self.latency}
+
+    def SearchSubtitles(self, token, searchlist):
+        status = self.__request__("SearchSubtitles", token)
+        if status is not None:
+            return {'status': status, 'seconds': self.latency}
+        data = []
+        with self.lock:
+            self.criteria += len(searchlist)
+        for number, criteria in enumerate(searchlist):
+            key = (criteria.get('moviehash') or criteria.get('tag') or
+                   criteria.get('query'))
+            if not key or not self.__hit__(key):
+                continue
+            for lang in criteria.get('sublanguageid', "eng").split(","):
+                for rank in range(SUBS_BY_HASH):
+                    subtitle = self.__subtitle__(key, lang, rank, criteria)
+                    subtitle['QueryNumber'] = str(number)
+                    subtitle['MatchedBy'] = ("moviehash"
+                                             if 'moviehash' in criteria
+                                             else "tag" if 'tag' in criteria
+                                             else "fulltext")
+                    data.append(subtitle)
+        return {'status': "200 OK", 'data': data[:self.maxresults] or False,
+                'seconds': self.latency}
+
+    def DownloadSubtitles(self, token, ids):
+        status = self.__request__("DownloadSubtitles", token)
+        if status is None and self.quota is not None:
+            with self.lock:
+                session = self.sessions[token]
+                if session[1] + len(ids) > self.quota:
+                    self.errors += 1
+                    status = "407 Download limit reached"
+                else:
+                    session[1] += len(ids)
+        if status is not None:
+            return {'status': status, 'seconds': self.latency}
+        data = []
+        for idsubtitlefile in ids:
+            data.append({'idsubtitlefile': str(idsubtitlefile),
+                         'data': self.__payload__(idsubtitlefile)})
+        with self.lock:
+            self.downloaded += len(ids)
+        return {'status': "200 OK", 'data': data, 'seconds': self.latency}
+
+    def __payload__(self, idsubtitlefile):
+        # A subtitle of SUB_SIZE bytes (gzip, base64)
+        line = ("1\n00:00:01,000 --> 00:00:02,000\nSubtitle %s\n\n"
+                % idsubtitlefile).encode("utf-8")
+        srt = (line * (SUB_SIZE // len(line) + 1))[:SUB_SIZE]
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode="wb") as gz:
+            gz.write(srt)
+        return base64.b64encode(buf.getvalue()).decode("ascii")
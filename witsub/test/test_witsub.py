@@ -21,9 +21,69 @@
 # Sample from the OpenSubtitles wiki
 # http://trac.opensubtitles.org/projects/opensubtitles/wiki/HashSourceCodes
 
-from witsub.witsub import subDatabase, subTitle
+from witsub.witsub import subDatabase, subTitle, subCache
+from witsub.witsub import hashFile, hashFiles, scanVideos, writeSubtitle
+from witsub.witsub import parseVideoName, runStats, getSubTitles, subResult
+from witsub.witsub import runBudget
+from witsub.witsub import RPC_RETRIES, POOL_SIZE, DOWNLOAD_BATCH_SIZE
+from witsub.witsub import GET_DWNL_ERROR, GET_SUB_ERROR
+from witsub.witsub import SUB_DOWNLOADED, MATCH_HASH
+from witsub.proxywitsub import subProxy, proxyCache
+from witsub.indexwitsub import subIndex, indexDatabase, buildIndex
+from witsub.queuewitsub import workQueue, enqueueVideos, runWorker
+from witsub.reportwitsub import reportWriter, summarizeReport
+from witsub.watchwitsub import videoWatcher, watchVideos
+from witsub.test.serverwitsub import subServer
+from witsub.test.benchwitsub import makeTree
 from witsub.witsub import NOT_VIDEO_FILE, GET_SUB_UNKNOWN, SUB_ALREADY_EXIST
+from witsub.witsub import HASH_SIZE_ERROR, SUB_PENDING
+import witsub.witsub
+import os
+import sys
+import base64
+import gzip
+import shutil
+import tempfile
+import threading
 import unittest
+try:
+    import asyncio
+    import xmlrpc.client
+    from witsub.asyncwitsub import asyncTransport, getSubTitlesAsync
+except (ImportError, SyntaxError):
+    # The asyncio engine needs Python 3.7 or higher
+    asyncio = None
+
+
+def zeroInode(filestat):
+    """
+    Return a copy of filestat without inode and device (Windows)
+    """
+    return os.stat_result(
+        (filestat.st_mode, 0, 0) + tuple(filestat)[3:],
+        dict((name, getattr(filestat, name))
+             for name in ("st_atime", "st_mtime", "st_ctime",
+                          "st_atime_ns", "st_mtime_ns", "st_ctime_ns")))
+
+
+class zeroInodeEntry(object):
+    """
+    os.DirEntry with the stat of Windows (no inode, no device)
+    """
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.name = entry.name
+        self.path = entry.path
+
+    def is_dir(self, follow_symlinks=True):
+        return self.entry.is_dir(follow_symlinks=follow_symlinks)
+
+    def is_file(self, follow_symlinks=True):
+        return self.entry.is_file(follow_symlinks=follow_symlinks)
+
+    def stat(self, follow_symlinks=True):
+        return zeroInode(self.entry.stat(follow_symlinks=follow_symlinks))
 
 
 class TestWitsubStat(unittest.TestCase):
@@ -75,5 +135,816 @@ class TestWitsubStat(unittest.TestCase):
         self.assertTrue(subtitle.getSubtitleFileName() == "")
         self.assertTrue(subtitle.subtitle == GET_SUB_UNKNOWN)
 
+
+class TestWitsubHash(unittest.TestCase):
+
+    def test_Witsub_hashFunction(self):
+        input_file = "./testdata/test4hash"
+        hash_file = "d66172821e3b55a1"
+        self.assertTrue(hashFile(input_file) == hash_file)
+
+    def test_Witsub_hashTooSmall(self):
+        input_file = "./testdata/notvideofile"
+        self.assertTrue(hashFile(input_file) == HASH_SIZE_ERROR)
+
+    def test_Witsub_hashFiles(self):
+        input_files = ["./testdata/test4hash", "./testdata/notvideofile"]
+        hashes = sorted(hashFiles(input_files, jobs=2))
+        self.assertTrue(hashes[0] == ("./testdata/notvideofile", 14,
+                                      HASH_SIZE_ERROR))
+        self.assertTrue(hashes[1] == ("./testdata/test4hash", 153600,
+                                      "d66172821e3b55a1"))
+
+
+class TestWitsubCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = subCache(os.path.join(self.tmpdir, "cache.db"))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_Witsub_cacheHash(self):
+        input_file = "./testdata/test4hash"
+        filestat = os.stat(input_file)
+        self.assertTrue(self.cache.getHash(filestat, input_file) is None)
+        self.cache.setHash(filestat, input_file, "d66172821e3b55a1")
+        self.assertTrue(self.cache.getHash(filestat, input_file) ==
+                        "d66172821e3b55a1")
+        self.assertTrue(self.cache.prune() == 0)
+
+    def test_Witsub_cacheHashZeroInode(self):
+        # Two files of the same size and mtime without inode (Windows)
+        input_file = "./testdata/test4hash"
+        filestat = zeroInode(os.stat(input_file))
+        self.cache.setHash(filestat, input_file, "d66172821e3b55a1")
+        self.assertTrue(self.cache.getHash(filestat, input_file) ==
+                        "d66172821e3b55a1")
+        self.assertTrue(self.cache.getHash(filestat, "./testdata/other")
+                        is None)
+
+    def test_Witsub_cacheMiss(self):
+        self.assertFalse(self.cache.isMiss("d66172821e3b55a1", 153600, "eng"))
+        self.cache.setMiss("d66172821e3b55a1", 153600, "eng")
+        self.assertTrue(self.cache.isMiss("d66172821e3b55a1", 153600, "eng"))
+        self.assertFalse(self.cache.isMiss("d66172821e3b55a1", 153600, "fre"))
+        self.cache.retrymisses = True
+        self.assertFalse(self.cache.isMiss("d66172821e3b55a1", 153600, "eng"))
+
+
+class TestWitsubScan(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for folder in ("movies", ".hidden", "excluded"):
+            os.mkdir(os.path.join(self.tmpdir, folder))
+            for name in ("a.avi", "b.MKV", "b.srt", "c.txt"):
+                open(os.path.join(self.tmpdir, folder, name), "w").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_Witsub_scanVideos(self):
+        videos = sorted(scanVideos(self.tmpdir, exclude=["excluded"]))
+        self.assertTrue([os.path.basename(v[0]) for v in videos] ==
+                        ["a.avi", "b.MKV"])
+        self.assertTrue("b.srt" in videos[0][2])
+        self.assertTrue(videos[0][1].st_size == 0)
+
+    def test_Witsub_scanHidden(self):
+        videos = list(scanVideos(self.tmpdir, hidden=True))
+        self.assertTrue(len(videos) == 6)
+
+    def test_Witsub_followLinks(self):
+        os.symlink(self.tmpdir, os.path.join(self.tmpdir, "movies", "loop"))
+        videos = list(scanVideos(self.tmpdir, followlinks=True))
+        self.assertTrue(len(videos) == 4)
+
+    def test_Witsub_followLinksZeroInode(self):
+        # os.DirEntry.stat() on Windows: no inode, no device
+        os.symlink(self.tmpdir, os.path.join(self.tmpdir, "movies", "loop"))
+        scandir = witsub.witsub.scandir
+        witsub.witsub.scandir = lambda path: [zeroInodeEntry(entry)
+                                              for entry in scandir(path)]
+        try:
+            videos = list(scanVideos(self.tmpdir, followlinks=True))
+        finally:
+            witsub.witsub.scandir = scandir
+        self.assertTrue(len(videos) == 4)
+
+    def test_Witsub_scanJournal(self):
+        cachedir = tempfile.mkdtemp()
+        journal = subCache(os.path.join(cachedir, "cache.db"))
+        self.assertTrue(len(list(scanVideos(self.tmpdir, hidden=True,
+                                            journal=journal))) == 6)
+        # The folders not modified are filtered with the current options
+        videos = sorted(scanVideos(self.tmpdir, exclude=["excluded"],
+                                   journal=journal))
+        journal.close()
+        shutil.rmtree(cachedir)
+        self.assertTrue(videos == [os.path.join(self.tmpdir, "movies", name)
+                                   for name in ("a.avi", "b.MKV")])
+
+    def test_Witsub_multiLang(self):
+        subdatabase = subDatabase("eng, fre")
+        self.assertTrue(subdatabase.langs == ["eng", "fre"])
+        videofilename = os.path.join(self.tmpdir, "movies", "a.avi")
+        subtitle = subTitle(subdatabase, videofilename, hashing=False,
+                            siblings=frozenset(["a.eng.srt"]))
+        self.assertTrue(subtitle.getOutcome() == SUB_PENDING)
+        self.assertTrue(subtitle.langs == ["fre"])
+        subtitle = subTitle(subdatabase, videofilename, hashing=False,
+                            siblings=frozenset(["a.eng.srt", "a.fre.srt"]))
+        self.assertTrue(subtitle.getOutcome() == SUB_ALREADY_EXIST)
+
+
+class TestWitsubSearch(unittest.TestCase):
+
+    def test_Witsub_planSearch(self):
+        subdatabase = subDatabase("eng,fre")
+        criteria = {'moviehash': "d66172821e3b55a1", 'moviebytesize': "1000"}
+        found, searchlist = subdatabase.planSearch(
+            [dict(criteria, sublanguageid="eng"),
+             dict(criteria, sublanguageid="fre")])
+        self.assertTrue(found == {})
+        self.assertTrue(searchlist == [dict(criteria,
+                                            sublanguageid="eng,fre")])
+        subdatabase.parseSearch(searchlist, {'data': False})
+        found, searchlist = subdatabase.planSearch(
+            [dict(criteria, sublanguageid="fre")])
+        self.assertTrue(found == {("d66172821e3b55a1", "1000"): []})
+        self.assertTrue(searchlist == [])
+
+    def test_Witsub_parseQueries(self):
+        subdatabase = subDatabase()
+        searchlists = [[{'tag': "a.avi"}, {'query': "a"}], [{'tag': "b.avi"}]]
+        rpc = {'data': [{'QueryNumber': "2", 'IDSubtitleFile': "1"},
+                        {'QueryNumber': "1", 'IDSubtitleFile': "2"},
+                        {'QueryNumber': "0", 'IDSubtitleFile': "3"}]}
+        found = subdatabase.parseQueries(searchlists, rpc)
+        self.assertTrue([[d['IDSubtitleFile'] for d in f] for f in found] ==
+                        [["3", "2"], ["1"]])
+        self.assertTrue(subdatabase.parseQueries(searchlists, None) ==
+                        [None, None])
+
+    def test_Witsub_parseVideoName(self):
+        self.assertTrue(parseVideoName("The.Show.S01E02.720p.HDTV.mkv") ==
+                        ("The Show", 1, 2))
+        self.assertTrue(parseVideoName("/movies/Blade_Runner (1982).avi") ==
+                        ("Blade Runner", None, None))
+
+
+class TestWitsubWrite(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.subtitlefilename = os.path.join(self.tmpdir, "a.srt")
+        data = gzip.GzipFile(os.path.join(self.tmpdir, "a.gz"), "wb")
+        data.write(u"1\nCaf\xe9\n".encode("cp1252"))
+        data.close()
+        with open(os.path.join(self.tmpdir, "a.gz"), "rb") as data:
+            self.data = base64.b64encode(data.read()).decode("ascii")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_Witsub_writeSubtitle(self):
+        writeSubtitle(self.subtitlefilename, self.data)
+        with open(self.subtitlefilename, "rb") as subtitle:
+            self.assertTrue(subtitle.read() == b"1\nCaf\xe9\n")
+
+    def test_Witsub_writeCharset(self):
+        writeSubtitle(self.subtitlefilename, self.data, encoding="CP1252",
+                      charset="utf-8")
+        with open(self.subtitlefilename, "rb") as subtitle:
+            self.assertTrue(subtitle.read() == b"1\nCaf\xc3\xa9\n")
+
+    def test_Witsub_writeCharsetError(self):
+        # Unknown SubEncoding and charset without the replace error
+        # handler: the subtitle is written as is
+        for encoding, charset in (("x-unknown", "utf-8"), ("CP1252", "idna")):
+            writeSubtitle(self.subtitlefilename, self.data,
+                          encoding=encoding, charset=charset)
+            with open(self.subtitlefilename, "rb") as subtitle:
+                self.assertTrue(subtitle.read() == b"1\nCaf\xe9\n")
+
+    def test_Witsub_writeError(self):
+        self.assertRaises(ValueError, writeSubtitle, self.subtitlefilename,
+                          self.data[:-3])
+        self.assertTrue(sorted(os.listdir(self.tmpdir)) == ["a.gz"])
+
+    def test_Witsub_writeMode(self):
+        umask = os.umask(0o027)
+        try:
+            writeSubtitle(self.subtitlefilename, self.data)
+        finally:
+            os.umask(umask)
+        self.assertTrue(os.stat(self.subtitlefilename).st_mode & 0o777 ==
+                        0o640)
+
+
+class TestWitsubMain(unittest.TestCase):
+
+    def setUp(self):
+        self.argv = sys.argv
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.argv = self.argv
+        sys.stdout = self.stdout
+
+    def test_Witsub_numberOption(self):
+        for opts in (["--miss-ttl", "nan"],
+                     ["--jobs", "abc"], ["--jobs", "0"],
+                     ["--rate", "-1"], ["--proxy-size", "1M"],
+                     ["--newest", "1.5"], ["--max-requests", ""],
+                     ["--time-budget", "x"]):
+            sys.argv = ["witsub"] + opts + ["-f", "./testdata"]
+            with self.assertRaises(SystemExit) as exit:
+                witsub.witsub.main()
+            self.assertTrue(exit.exception.code == 2)
+
+    def test_Witsub_reportInterrupted(self):
+        tmpdir = tempfile.mkdtemp()
+        reportfilename = os.path.join(tmpdir, "report.jsonl")
+        fetchMany = subDatabase.fetchMany
+
+        def interrupted(self, *args, **kwargs):
+            for result in fetchMany(self, *args, **kwargs):
+                yield result
+            raise KeyboardInterrupt
+        subDatabase.fetchMany = interrupted
+        sys.argv = ["witsub", "-n", "--report", reportfilename,
+                    "-f", "./testdata/notvideofile"]
+        try:
+            with self.assertRaises(KeyboardInterrupt):
+                witsub.witsub.main()
+        finally:
+            subDatabase.fetchMany = fetchMany
+        # The report is closed (written) on the interrupt
+        outcomes = summarizeReport(reportfilename)["outcomes"]
+        shutil.rmtree(tmpdir)
+        self.assertTrue(list(outcomes) == [NOT_VIDEO_FILE])
+
+
+class TestWitsubIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.videofilename = os.path.join(self.tmpdir, "video.avi")
+        with open(self.videofilename, "wb") as video:
+            video.write(b"witsub")
+            video.seek(1024 * 1024)
+            video.write(b"witsub")
+        size = os.path.getsize(self.videofilename)
+        self.hash = hashFile(self.videofilename)
+        with open(os.path.join(self.tmpdir, "1.srt"), "wb") as srt:
+            srt.write(b"1\nIndex\n")
+        with open(os.path.join(self.tmpdir, "export.csv"), "w") as export:
+            export.write("MovieHash,MovieByteSize,SubLanguageID,"
+                         "IDSubtitleFile,SubDownloadsCnt,SubFilePath\n")
+            export.write("%s,%s,eng,2,10,\n" % (self.hash, size))
+            export.write("%s,%s,eng,1,20,1.srt\n" % (self.hash, size))
+            export.write("%s,%s,fre,3,5,\n" % (self.hash, size + 1))
+        self.indexfilename = os.path.join(self.tmpdir, "subtitles.idx")
+        buildIndex(os.path.join(self.tmpdir, "export.csv"),
+                   self.indexfilename)
+        self.index = subIndex(self.indexfilename)
+        self.size = size
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_Witsub_lookup(self):
+        self.assertTrue(len(self.index) == 3)
+        results = self.index.lookup(self.hash, self.size, "eng")
+        self.assertTrue([r["IDSubtitleFile"] for r in results] == ["1", "2"])
+        self.assertTrue(self.index.lookup(self.hash, self.size, "fre") == [])
+        self.assertTrue(self.index.payload("2") is None)
+
+    def test_Witsub_indexDatabase(self):
+        # Found in the index: the (unreachable) server is not used
+        subdatabase = indexDatabase(index=self.index,
+                                    url="http://127.0.0.1:9/xml-rpc")
+        subtitle = subTitle(subdatabase, self.videofilename)
+        self.assertTrue(subtitle.getOutcome() == SUB_DOWNLOADED)
+        self.assertTrue(subdatabase.rpc_login is None)
+        with open(os.path.join(self.tmpdir, "video.srt"), "rb") as srt:
+            self.assertTrue(srt.read() == b"1\nIndex\n")
+
+    def test_Witsub_indexPartial(self):
+        # The search of the missing language fails: the index result of
+        # the other language is downloaded
+        subdatabase = indexDatabase("eng,fre", index=self.index,
+                                    url="http://127.0.0.1:9/xml-rpc")
+        subdatabase.scheduler.delay = lambda attempt: 0
+        subtitle = subTitle(subdatabase, self.videofilename)
+        self.assertTrue(subtitle.getOutcome() == GET_SUB_ERROR)
+        self.assertTrue(subtitle.subtitles["fre"] == GET_SUB_ERROR)
+        self.assertTrue(os.listdir(self.tmpdir).count("video.eng.srt") == 1)
+
+
+class TestWitsubReport(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.reportfilename = os.path.join(self.tmpdir, "report.jsonl")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_Witsub_report(self):
+        report = reportWriter(self.reportfilename, buffersize=2)
+        report.write(subResult("/a/1.avi", "8e245d9679d31e12",
+                               SUB_DOWNLOADED, "1", "/a/1.srt", MATCH_HASH,
+                               0.5, 1024, "eng", 10, {"hash": 0.1}))
+        report.write(subResult("/a/2.avi", None, HASH_SIZE_ERROR))
+        report.write(subResult("/b/3.avi", None, GET_SUB_UNKNOWN))
+        # Written by batch of 2 lines
+        with open(self.reportfilename) as f:
+            self.assertTrue(len(f.readlines()) == 2)
+        report.close()
+        summary = summarizeReport(self.reportfilename)
+        self.assertTrue(summary["outcomes"][SUB_DOWNLOADED] == (1, 0.5))
+        self.assertTrue(summary["folders"] ==
+                        {"/a": {SUB_DOWNLOADED: 1, HASH_SIZE_ERROR: 1},
+                         "/b": {GET_SUB_UNKNOWN: 1}})
+
+
+class TestWitsubStats(unittest.TestCase):
+
+    def test_Witsub_stats(self):
+        stats = runStats()
+        stats.observe("hash", 0.002)
+        stats.observe("hash", 0.2)
+        stats.count("bytes_read", 131072)
+        stats.outcome(NOT_VIDEO_FILE)
+        text = stats.toPrometheus()
+        self.assertTrue('witsub_stage_seconds_bucket{stage="hash",'
+                        'le="0.005"} 1' in text)
+        self.assertTrue('witsub_stage_seconds_count{stage="hash"} 2' in text)
+        self.assertTrue("witsub_bytes_read_total 131072" in text)
+        self.assertTrue('witsub_outcomes_total{outcome="NotVideoFile"} 1'
+                        in text)
+
+
+class TestWitsubServer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = subServer(hitrate=1.0).start()
+        self.videofilenames = makeTree(self.tmpdir, files=30, srtratio=0.0)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_Witsub_getSubTitles(self):
+        subdatabase = subDatabase(rate=0, url=self.server.url)
+        outcomes = [s.getOutcome() for s in getSubTitles(
+            subdatabase, scanVideos(self.tmpdir), batchsize=20)]
+        subdatabase.close()
+        self.assertTrue(outcomes == [SUB_DOWNLOADED] * 30)
+        self.assertTrue(self.server.calls["SearchSubtitles"] == 2)
+        self.assertTrue(self.server.downloaded == 30)
+
+    def test_Witsub_keepAlive(self):
+        subdatabase = subDatabase(rate=0, url=self.server.url)
+        criteria = {"moviehash": "d66172821e3b55a1",
+                    "moviebytesize": "153600", "sublanguageid": "eng"}
+        for i in range(5):
+            self.assertTrue(subdatabase.search([criteria]) is not None)
+        # One connection for the login and the 5 searches
+        self.assertTrue(subdatabase.transport.opened == 1)
+        self.assertTrue(subdatabase.transport.requests == 6)
+        # The threads share a pool of POOL_SIZE connections
+        list(getSubTitles(subdatabase, self.videofilenames, batchsize=5))
+        self.assertTrue(subdatabase.transport.opened <= POOL_SIZE)
+        self.assertTrue(subdatabase.transport.requests ==
+                        sum(self.server.calls.values()))
+        subdatabase.close()
+
+    def test_Witsub_zeroInode(self):
+        # os.DirEntry.stat() on Windows: no inode, no device
+        items = []
+        for videofilename in self.videofilenames[:5]:
+            filestat = os.stat(videofilename)
+            items.append((videofilename, zeroInode(filestat), None))
+        subdatabase = subDatabase(rate=0, url=self.server.url)
+        subtitles = list(getSubTitles(subdatabase, items))
+        subdatabase.close()
+        self.assertTrue(len(set(s.getHashFile() for s in subtitles)) == 5)
+
+    def test_Witsub_loginFailed(self):
+        for url in (self.server.url, "http://127.0.0.1:1/xml-rpc"):
+            # Server error or connection refused
+            self.server.errorrate = 1.0
+            self.server.reset()
+            subdatabase = subDatabase(rate=0, url=url)
+            subdatabase.scheduler.delay = lambda attempt: 0
+            logins = []
+            login = subdatabase.login
+            subdatabase.login = lambda: logins.append(url) or login()
+            outcomes = [s.getOutcome() for s in getSubTitles(
+                subdatabase, self.videofilenames, batchsize=10)]
+            subdatabase.close()
+            self.assertTrue(len(outcomes) == 30)
+            self.assertTrue(SUB_DOWNLOADED not in outcomes)
+            # One login (and its retries) for the run, not one by batch
+            self.assertTrue(len(logins) == 1)
+            if url == self.server.url:
+                self.assertTrue(self.server.calls ==
+                                {"LogIn": RPC_RETRIES + 1})
+
+    def test_Witsub_logoutOnce(self):
+        subdatabase = subDatabase(rate=0, url=self.server.url)
+        subdatabase.scheduler.delay = lambda attempt: 0
+        self.assertTrue(subdatabase.getToken() is not None)
+        self.server.errorrate = 1.0
+        subdatabase.close()
+        self.assertTrue(self.server.calls["LogOut"] == 1)
+
+    def test_Witsub_session(self):
+        sessionfile = os.path.join(self.tmpdir, "session.json")
+        first = subDatabase(rate=0, url=self.server.url,
+                            sessionfile=sessionfile)
+        token = first.getToken()
+        # Runs sharing the session file
+        threads = [threading.Thread(target=first.saveSession)
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertTrue([name for name in os.listdir(self.tmpdir)
+                         if name.endswith(".tmp")] == [])
+        # The next run reuses the session
+        second = subDatabase(rate=0, url=self.server.url,
+                             sessionfile=sessionfile)
+        self.assertTrue(second.getToken() == token)
+        self.assertTrue(self.server.calls == {"LogIn": 1})
+        second.sessionfile = None
+        # A malformed session file starts a new session
+        for session in ('[]', '{"url": "%s"}' % self.server.url,
+                        '{"url": "%s", "expires": "x", "token": "%s"}'
+                        % (self.server.url, token)):
+            with open(sessionfile, "w") as f:
+                f.write(session)
+            subdatabase = subDatabase(rate=0, url=self.server.url,
+                                      sessionfile=sessionfile)
+            self.assertTrue(subdatabase.getToken() not in (None, token))
+            subdatabase.close()
+        self.assertTrue(self.server.calls["LogIn"] == 4)
+        first.close()
+
+    def test_Witsub_resume(self):
+        smallfilename = os.path.join(self.tmpdir, "small.avi")
+        with open(smallfilename, "wb") as small:
+            small.write(b"small")
+        cachedir = tempfile.mkdtemp()
+        journal = subCache(os.path.join(cachedir, "cache.db"))
+        subdatabase = subDatabase(rate=0, url=self.server.url, cache=journal)
+        for subtitle in getSubTitles(subdatabase,
+                                     scanVideos(self.tmpdir, journal=journal),
+                                     batchsize=10):
+            journal.setOutcome(subtitle)
+        subdatabase.close()
+        self.assertTrue(self.server.downloaded == 30)
+        # The folders with the new subtitle files are not listed again,
+        # the file too small to be hashed is still pending
+        listed = []
+        scandir = witsub.witsub.scandir
+
+        def listing(path):
+            listed.append(path)
+            return scandir(path)
+        witsub.witsub.scandir = listing
+        try:
+            items = list(scanVideos(self.tmpdir, journal=journal))
+        finally:
+            witsub.witsub.scandir = scandir
+        journal.close()
+        shutil.rmtree(cachedir)
+        self.assertTrue(listed == [])
+        self.assertTrue(items == [smallfilename])
+
+    def test_Witsub_resumeNewVideo(self):
+        cachedir = tempfile.mkdtemp()
+        journal = subCache(os.path.join(cachedir, "cache.db"))
+        subdatabase = subDatabase(rate=0, url=self.server.url, cache=journal)
+        newfilename = None
+        for subtitle in getSubTitles(subdatabase,
+                                     scanVideos(self.tmpdir, journal=journal),
+                                     batchsize=10):
+            if newfilename is None:
+                # Video file added during the run, before a subtitle file
+                # is written in its folder
+                newfilename = os.path.join(
+                    os.path.dirname(subtitle.getVideoFileName()), "new.avi")
+                with open(newfilename, "wb") as video:
+                    video.write(b"new")
+            journal.setOutcome(subtitle)
+        subdatabase.close()
+        # The folder of the new video file is listed again
+        items = [item[0] if isinstance(item, tuple) else item
+                 for item in scanVideos(self.tmpdir, journal=journal)]
+        journal.close()
+        shutil.rmtree(cachedir)
+        self.assertTrue(newfilename in items)
+
+    def test_Witsub_fetchMany(self):
+        subdatabase = subDatabase(rate=0, url=self.server.url)
+        results = list(subdatabase.fetchMany(
+            (v for v in self.videofilenames), langs=["eng", "fre"]))
+        # The languages of the database are restored
+        self.assertTrue(subdatabase.langs == ["eng"])
+        results[30:] = subdatabase.fetchMany(self.videofilenames,
+                                             langs="fre", overwrite=True)
+        self.assertTrue(subdatabase.langs == ["eng"])
+        subdatabase.close()
+        self.assertTrue(len(results) == 60)
+        for result in results:
+            self.assertTrue(result.outcome == SUB_DOWNLOADED)
+            self.assertTrue(result.subtitlefilename.endswith(
+                ".eng.srt" if result in results[:30] else ".srt"))
+            self.assertTrue(result.subtitleid is not None)
+            self.assertTrue(result.match == MATCH_HASH)
+            self.assertTrue(sorted(result.timings) ==
+                            ["download", "hash", "search"])
+        # The French subtitles of the second call are the ones written
+        # by the first call (not downloaded again)
+        self.assertTrue(self.server.downloaded == 60)
+
+    def test_Witsub_truncatedSearch(self):
+        # The replies are truncated to 30 results (3 subtitles by hash)
+        self.server.maxresults = 30
+        limit = witsub.witsub.SEARCH_RESULTS_LIMIT
+        witsub.witsub.SEARCH_RESULTS_LIMIT = 30
+        subdatabase = subDatabase(rate=0, url=self.server.url)
+        try:
+            results = list(subdatabase.fetchMany(self.videofilenames,
+                                                 batchsize=20))
+        finally:
+            witsub.witsub.SEARCH_RESULTS_LIMIT = limit
+        subdatabase.close()
+        # The 10 criteria without result of the first reply are searched
+        # again (2 requests), not by file name
+        self.assertTrue([(r.outcome, r.match) for r in results] ==
+                        [(SUB_DOWNLOADED, MATCH_HASH)] * 30)
+        self.assertTrue(self.server.calls["SearchSubtitles"] == 4)
+
+    def test_Witsub_budget(self):
+        for i, videofilename in enumerate(self.videofilenames):
+            os.utime(videofilename, (i, i))
+        # Login, search and download of the 10 newest files
+        subdatabase = subDatabase(rate=0, url=self.server.url,
+                                  budget=runBudget(requests=4))
+        results = list(subdatabase.fetchMany(self.videofilenames,
+                                             newest=10))
+        self.assertTrue(sorted(r.path for r in results) ==
+                        sorted(self.videofilenames[-10:]))
+        # No request left for the next batch
+        self.assertTrue(list(subdatabase.fetchMany(self.videofilenames,
+                                                   overwrite=True)) == [])
+        self.assertTrue(subdatabase.budget.used == 3)
+        self.assertTrue(self.server.downloaded == 10)
+
+    def test_Witsub_budgetLangs(self):
+        # 15 files and 2 languages: 30 subtitles, 2 download requests
+        subdatabase = subDatabase(language="eng,fre", rate=0,
+                                  url=self.server.url,
+                                  budget=runBudget(requests=3))
+        outcomes = [r.outcome for r in subdatabase.fetchMany(
+            self.videofilenames[:15])]
+        self.assertTrue(len(outcomes) == 15)
+        self.assertTrue(GET_DWNL_ERROR in outcomes)
+        self.assertTrue(subdatabase.budget.used == 3)
+        self.assertTrue(sum(self.server.calls.values()) == 3)
+        self.assertTrue(self.server.downloaded == DOWNLOAD_BATCH_SIZE)
+
+    def test_Witsub_budgetTruncated(self):
+        # The searches again of the truncated replies are in the budget
+        self.server.maxresults = 30
+        limit = witsub.witsub.SEARCH_RESULTS_LIMIT
+        witsub.witsub.SEARCH_RESULTS_LIMIT = 30
+        subdatabase = subDatabase(rate=0, url=self.server.url,
+                                  budget=runBudget(requests=3))
+        try:
+            list(subdatabase.fetchMany(self.videofilenames, batchsize=20))
+        finally:
+            witsub.witsub.SEARCH_RESULTS_LIMIT = limit
+        subdatabase.close()
+        self.assertTrue(subdatabase.budget.used == 3)
+        self.assertTrue(sum(self.server.calls.values()) == 3)
+
+    def test_Witsub_worker(self):
+        queue = workQueue(os.path.join(self.tmpdir, "queue.db"), ttl=-1)
+        self.assertTrue(enqueueVideos(queue, scanVideos(self.tmpdir)) == 30)
+        # The lease of a dead worker expires
+        self.assertTrue(len(queue.lease("dead", size=10)) == 10)
+        queue.ttl = 60
+        subdatabase = subDatabase(rate=0, url=self.server.url)
+        self.assertTrue(runWorker(subdatabase, queue, worker="alive") == 30)
+        subdatabase.close()
+        self.assertTrue(queue.getCounts() == {"done": 30})
+        self.assertTrue(self.server.downloaded == 30)
+        queue.close()
+
+    def test_Witsub_workerBudget(self):
+        queue = workQueue(os.path.join(self.tmpdir, "queue.db"))
+        enqueueVideos(queue, self.videofilenames)
+        # Login, search and download of one batch: no batch left
+        subdatabase = subDatabase(rate=0, url=self.server.url,
+                                  budget=runBudget(requests=4))
+        self.assertTrue(runWorker(subdatabase, queue, worker="alive",
+                                  poll=0.01) == 20)
+        # The files not processed are given back
+        self.assertTrue(queue.getCounts() == {"done": 20, "pending": 10})
+        self.assertTrue(subdatabase.budget.used == 3)
+        queue.close()
+
+    def test_Witsub_proxy(self):
+        proxy = subProxy(subDatabase(rate=0, url=self.server.url),
+                         address=("127.0.0.1", 0),
+                         cache=proxyCache(os.path.join(self.tmpdir,
+                                                       "proxy.db"))).start()
+        # The second client is served by the proxy cache
+        for overwrite in (False, True):
+            subdatabase = subDatabase(rate=0, url=proxy.url)
+            outcomes = [s.getOutcome() for s in getSubTitles(
+                subdatabase, scanVideos(self.tmpdir), overwrite=overwrite,
+                batchsize=20)]
+            subdatabase.close()
+            self.assertTrue(outcomes == [SUB_DOWNLOADED] * 30)
+        proxy.stop()
+        self.assertTrue(self.server.calls["SearchSubtitles"] == 2)
+        self.assertTrue(self.server.downloaded == 30)
+
+    def test_Witsub_proxyTruncated(self):
+        # The replies are truncated to 30 results (3 subtitles by hash)
+        self.server.maxresults = 30
+        limit = witsub.witsub.SEARCH_RESULTS_LIMIT
+        witsub.witsub.SEARCH_RESULTS_LIMIT = 30
+        proxy = subProxy(subDatabase(rate=0, url=self.server.url),
+                         address=("127.0.0.1", 0),
+                         cache=proxyCache(os.path.join(self.tmpdir,
+                                                       "proxy.db"))).start()
+        try:
+            subdatabase = subDatabase(rate=0, url=proxy.url)
+            outcomes = [s.getOutcome() for s in getSubTitles(
+                subdatabase, scanVideos(self.tmpdir), batchsize=20)]
+            subdatabase.close()
+        finally:
+            proxy.stop()
+            witsub.witsub.SEARCH_RESULTS_LIMIT = limit
+        # No criteria cached as without result
+        self.assertTrue(outcomes == [SUB_DOWNLOADED] * 30)
+
+
+class stopWatch(Exception):
+    pass
+
+
+@unittest.skipIf(not sys.platform.startswith("linux"), "inotify needs Linux")
+class TestWitsubWatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.watched = os.path.join(self.tmpdir, "watched")
+        os.mkdir(self.watched)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_Witsub_watcher(self):
+        watcher = videoWatcher(self.watched, debounce=0.1)
+        self.assertTrue(watcher.ready(timeout=0.2) == [])
+        videofilename = os.path.join(self.watched, "a.avi")
+        with open(videofilename, "wb") as video:
+            video.write(b"video")
+        open(os.path.join(self.watched, "a.txt"), "w").close()
+        self.assertTrue(watcher.ready(timeout=5) == [videofilename])
+        # A new folder with its video files, the hidden ones are ignored
+        for name in (".hidden", "new"):
+            os.mkdir(os.path.join(self.tmpdir, name))
+            videofilenames = makeTree(os.path.join(self.tmpdir, name),
+                                      files=2, srtratio=0.0)
+            os.rename(os.path.join(self.tmpdir, name),
+                      os.path.join(self.watched, name))
+        self.assertTrue(sorted(watcher.ready(timeout=5)) ==
+                        sorted(v.replace(self.tmpdir, self.watched)
+                               for v in videofilenames))
+        self.assertTrue(watcher.ready(timeout=0.5) == [])
+        watcher.close()
+
+    def test_Witsub_watchVideos(self):
+        server = subServer(hitrate=1.0).start()
+        subdatabase = subDatabase(rate=0, url=server.url)
+        outcomes = []
+
+        def callback(subtitle):
+            outcomes.append(subtitle.getOutcome())
+            raise stopWatch()
+
+        def newVideo():
+            os.mkdir(os.path.join(self.tmpdir, "new"))
+            makeTree(os.path.join(self.tmpdir, "new"), files=1, srtratio=0.0)
+            os.rename(os.path.join(self.tmpdir, "new"),
+                      os.path.join(self.watched, "new"))
+        timer = threading.Timer(0.5, newVideo)
+        timer.start()
+        self.assertRaises(stopWatch, watchVideos, subdatabase, self.watched,
+                          debounce=0.1, callback=callback)
+        timer.join()
+        subdatabase.close()
+        server.stop()
+        self.assertTrue(outcomes == [SUB_DOWNLOADED])
+
+
+@unittest.skipIf(asyncio is None, "asyncio engine not available")
+class TestWitsubAsync(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = subServer(hitrate=1.0).start()
+        self.videofilenames = makeTree(self.tmpdir, files=30, srtratio=0.0)
+        self.subdatabase = subDatabase(rate=0, url=self.server.url)
+
+    def tearDown(self):
+        self.subdatabase.close()
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_Witsub_getSubTitlesAsync(self):
+        subtitles = asyncio.run(getSubTitlesAsync(
+            self.subdatabase, scanVideos(self.tmpdir), jobs=2, batchsize=20))
+        self.assertTrue([s.getOutcome() for s in subtitles] ==
+                        [SUB_DOWNLOADED] * 30)
+        self.assertTrue(self.server.calls["SearchSubtitles"] == 2)
+        self.assertTrue(self.server.downloaded == 30)
+
+    def test_Witsub_asyncTruncatedSearch(self):
+        self.server.maxresults = 30
+        limit = witsub.witsub.SEARCH_RESULTS_LIMIT
+        witsub.witsub.SEARCH_RESULTS_LIMIT = 30
+        try:
+            subtitles = asyncio.run(getSubTitlesAsync(
+                self.subdatabase, self.videofilenames, jobs=2,
+                batchsize=20))
+        finally:
+            witsub.witsub.SEARCH_RESULTS_LIMIT = limit
+        self.assertTrue([s.getResult().match for s in subtitles] ==
+                        [MATCH_HASH] * 30)
+        self.assertTrue(self.server.downloaded == 30)
+
+    def test_Witsub_asyncDownloadLangs(self):
+        # 2 languages: 20 subtitles by batch of 10 files, 2 requests
+        subdatabase = subDatabase(language="eng,fre", rate=0,
+                                  url=self.server.url)
+        subtitles = asyncio.run(getSubTitlesAsync(
+            subdatabase, self.videofilenames, jobs=2, batchsize=10,
+            downloadbatchsize=10))
+        subdatabase.close()
+        self.assertTrue([s.getOutcome() for s in subtitles] ==
+                        [SUB_DOWNLOADED] * 30)
+        self.assertTrue(self.server.calls["DownloadSubtitles"] == 6)
+        self.assertTrue(self.server.downloaded == 60)
+
+    def test_Witsub_asyncCallback(self):
+        outcomes = []
+        subtitles = asyncio.run(getSubTitlesAsync(
+            self.subdatabase, self.videofilenames, jobs=2,
+            callback=lambda s: outcomes.append(s.getOutcome())))
+        # The subtitles are not kept with a callback
+        self.assertTrue(subtitles == [])
+        self.assertTrue(outcomes == [SUB_DOWNLOADED] * 30)
+
+    def test_Witsub_asyncCallbackError(self):
+        # The walker thread is blocked by the full queues
+        def callback(subtitle):
+            raise ValueError("callback error")
+        self.assertRaises(ValueError, asyncio.run, getSubTitlesAsync(
+            self.subdatabase, self.videofilenames * 10, jobs=1,
+            batchsize=1, callback=callback))
+
+    def test_Witsub_asyncProtocolError(self):
+        transport = asyncTransport(self.server.url + "/unknown")
+        writers = []
+        request = transport.__request__
+
+        def spy(reader, writer, body):
+            writers.append(writer)
+            return request(reader, writer, body)
+        transport.__request__ = spy
+        self.assertRaises(xmlrpc.client.ProtocolError, asyncio.run,
+                          transport.call("LogOut", "token"))
+        self.assertTrue(transport.idle == [])
+        self.assertTrue(writers[0].is_closing())
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+#
+# Witsub
+# Where Is The (fuck...) Subtitle
+#
+# Watch mode (Linux inotify)
+#
+# Copyright (C) 2016 Nicolargo <nicolas@nicolargo.com>
+#
+# Witsub is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Witsub is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# The video files written (IN_CLOSE_WRITE) or moved (IN_MOVED_TO) in the
+# watched folder tree go through the getSubTitles flow once their size
+# is stable for WATCH_DEBOUNCE seconds.
+
+# Import lib
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+from .witsub import getSubTitles, isVideoFile, isExcluded
+
+# Global variables
+# Seconds without change before processing a new video file
+WATCH_DEBOUNCE = 5.0
+
+# inotify constants (see linux/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0x00080000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+# struct inotify_event: wd, mask, cookie, len (followed by the name)
+EVENT_FORMAT = "iIII"
+EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+
+# Limit import to
+__all__ = ['videoWatcher', 'watchVideos']
+
+
+# Classes
+class videoWatcher(object):
+    """
+    Class used to watch the new video files of a folder tree (inotify)
+    """
+
+    def __init__(self, path, exclude=(), hidden=False,
+                 debounce=WATCH_DEBOUNCE):
+        self.exclude = exclude
+        self.hidden = hidden
+        self.debounce = debounce
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                                use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, "inotify_init1: %s" % os.strerror(err))
+        # Watched folders: watch descriptor => path
+        self.folders = {}
+        # Video files waiting to be stable: path => (deadline, size)
+        self.pending = {}
+        self.addTree(path)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def addTree(self, path):
+        """
+        Watch a folder tree
+        Return the video files already in the tree
+        """
+        videos = []
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [d for d in dirs
+                       if (self.hidden or not d.startswith(".")) and
+                       not isExcluded(os.path.join(root, d), self.exclude)]
+            wd = self.libc.inotify_add_watch(self.fd, self.__encode__(root),
+                                             WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                logging.error("Can not watch %s (error: %s)"
+                              % (root, os.strerror(err)))
+                if err == errno.ENOSPC:
+                    logging.error("Increase fs.inotify.max_user_watches")
+                continue
+            self.folders[wd] = root
+            videos.extend(os.path.join(root, f) for f in files
+                          if isVideoFile(f))
+        logging.debug("%s folders watched" % len(self.folders))
+        return videos
+
+    def ready(self, timeout=None):
+        """
+        Wait for new video files (at most timeout seconds)
+        Return the list of the video files ready to be processed
+        """
+        end = None if timeout is None else time.time() + timeout
+        while True:
+            now = time.time()
+            videos = []
+            for path, (deadline, size) in list(self.pending.items()):
+                if deadline > now:
+                    continue
+                del self.pending[path]
+                try:
+                    newsize = os.path.getsize(path)
+                except OSError:
+                    # Removed before being processed
+                    continue
+                if newsize != size:
+                    # Still written
+                    self.pending[path] = (now + self.debounce, newsize)
+                else:
+                    videos.append(path)
+            if videos:
+                return videos
+
+            wait = None
+            if self.pending:
+                wait = min(d for d, s in self.pending.values()) - now
+            if end is not None:
+                if end <= now:
+                    return []
+                wait = end - now if wait is None else min(wait, end - now)
+            self.__read__(wait)
+
+    def __read__(self, timeout):
+        # Read and dispatch the inotify events
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return
+        data = os.read(self.fd, 65536)
+        offset = 0
+        while offset + EVENT_SIZE <= len(data):
+            wd, mask, cookie, length = struct.unpack_from(EVENT_FORMAT, data,
+                                                          offset)
+            name = data[offset + EVENT_SIZE:offset + EVENT_SIZE + length]
+            offset += EVENT_SIZE + length
+            if mask & IN_Q_OVERFLOW:
+                logging.warning("Too many inotify events, some are lost")
+                continue
+            if mask & IN_IGNORED:
+                # Folder removed
+                self.folders.pop(wd, None)
+                continue
+            if wd not in self.folders:
+                continue
+            path = os.path.join(self.folders[wd], self.__decode__(name))
+            if isExcluded(path, self.exclude):
+                continue
+            if mask & IN_ISDIR:
+                hidden = os.path.basename(path).startswith(".")
+                if (mask & (IN_CREATE | IN_MOVED_TO) and
+                        (self.hidden or not hidden)):
+                    # New folder: watch it (it can already have videos)
+                    for video in self.addTree(path):
+                        self.__addPending__(video)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and isVideoFile(path):
+                self.__addPending__(path)
+
+    def __addPending__(self, path):
+        # Wait for the video file to be stable
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+        logging.debug("New video file %s" % path)
+        self.pending[path] = (time.time() + self.debounce, size)
+
+    def __encode__(self, path):
+        if isinstance(path, bytes):
+            return path
+        return os.fsencode(path)
+
+    def __decode__(self, name):
+        name = name.rstrip(b"\0")
+        if str is bytes:
+            # Python 2
+            return name
+        return os.fsdecode(name)
+
+
+# Functions
+def watchVideos(subdatabase, path, overwrite=False, exclude=(), hidden=False,
+                debounce=WATCH_DEBOUNCE, callback=None):
+    """
+    Watch a folder tree and get the subtitles of the new video files
+    (one long-lived subdatabase session)
+    callback is called with each subTitle object
+    Run until interrupted
+    """
+    watcher = videoWatcher(path, exclude=exclude, hidden=hidden,
+                           debounce=debounce)
+    logging.info("Watch %s for new video files" % path)
+    try:
+        while True:
+            videos = watcher.ready()
+            for subtitle in getSubTitles(subdatabase, videos,
+                                         overwrite=overwrite):
+                if callback is not None:
+                    callback(subtitle)
+    finally:
+        watcher.close()
@@ -44,7 +44,64 @@ Options:
     -V: Switch on debug mode (verbose)
     -l <lang>: Set the subtitle language search (default is 'eng' for English)
                Use the ISO 639-2 standard (example 'fre' for French)
+               A comma separated list (example 'eng,fre') downloads
+               one <name>.<lang>.srt file per language
     -w: Force download and overwrite of existing subtitle
+    -n: Do not use the local cache (hashes and searches without subtitle)
+    -r: Search again the video files without subtitle in the cache
+    --miss-ttl <days>: Days before searching again a video file without
+                       subtitle (default is 7)
+    --prune-cache: Remove the deleted or modified files from the cache
+    --jobs <n>: Use the asyncio engine with at most n requests in flight
+                (Python 3.7 or higher)
+    --rate <n>: Maximum number of requests per second (default is 4,
+                0 for no limit)
+    --exclude <glob>: Do not scan the files/folders matching the pattern
+                      (can be used several times)
+    --hidden: Scan the hidden folders
+    -L: Follow the symbolic links to folders
+    --resume: Use the scan journal (in the cache): only scan the folders
+              modified since the previous scan and the files not yet
+              processed (not used with -w)
+    --watch: Watch the folder and get the subtitles of the new video
+             files (Linux only, run until interrupted)
+    --charset <name>: Convert the subtitles to this charset
+                      (example 'utf-8', default is the original one)
+    --no-fallback: Do not search by file name/title the video files not
+                   found by hash (lower confidence matches)
+    --stats: Display the statistics of the run at exit (time by stage,
+             counters and outcomes)
+    --stats-file <path>: Save the statistics of the run to a JSON file
+                         (Prometheus textfile if the name ends with .prom)
+    --server <url>: XML-RPC server (default is the Opensubtitles one,
+                    or the URL of a witsub proxy)
+    --serve <[host:]port>: Run a caching XML-RPC proxy of the server for
+                           the other witsub hosts (one session, shared
+                           cache, run until interrupted, -f not needed)
+                           Use 0.0.0.0:<port> to listen on all interfaces
+    --proxy-size <MB>: Maximum size of the proxy cache (default is 1024)
+    --index <path>: Search the video files in a local index first
+                    (the XML-RPC server is used for the index misses)
+    --build-index <export>: Build the --index file from a CSV/JSONL
+                            export and exit (columns MovieHash,
+                            MovieByteSize, SubLanguageID, IDSubtitleFile
+                            and optional SubDownloadsCnt, SubEncoding,
+                            SubFilePath)
+    --enqueue <db>: Add the video files of the -f folder to a shared
+                    work queue (SQLite file seen by all the workers)
+    --worker <db>: Get the subtitles of the files of a work queue
+                   (-f not needed, several workers on several hosts
+                   can share the queue)
+    --report <path>: Append one JSON line by video file to a report
+                     (outcome, subtitle, time by stage...)
+    --summarize <path>: Display the files by outcome and by folder of a
+                        report and exit
+    --newest <n>: Process the n newest (modification time) video files
+                  without subtitle first, the older ones are left for
+                  the next run
+    --max-requests <n>: Stop before sending more than n XML-RPC requests
+    --time-budget <s>: Stop after s seconds (the current batch is
+                       finished)
 '''
 
 # Import lib
@@ -52,21 +109,45 @@ import struct
 import sys
 import os
 import getopt
+import errno
 import logging
-import gzip
-import base64
+import zlib
+import binascii
+import codecs
+import sqlite3
+import time
+import random
+import threading
+import json
+import fnmatch
+import re
+import bisect
+import heapq
+import contextlib
+import shutil
+import collections
 try:
     # Python 2
     import xmlrpclib
+    import httplib
 except:
     # Python 3
     import xmlrpc.client
+    import http.client as httplib
 try:
-    # Python 2
-    import StringIO
-except:
-    # Python 3
-    import io
+    # Python 3.5 or higher
+    from os import scandir
+except ImportError:
+    try:
+        # Python 2 (scandir backport)
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+try:
+    # Python 3 (or the futures backport on Python 2)
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+except ImportError:
+    ThreadPoolExecutor = None
 
 # Global variables
 HASH_SIZE_ERROR = "HashSizeError"
@@ -75,6 +156,56 @@ GET_DWNL_ERROR = "DownloadError"
 GET_SUB_UNKNOWN = "None"
 SUB_ALREADY_EXIST = "SubAlreadyExist"
 NOT_VIDEO_FILE = "NotVideoFile"
+SUB_PENDING = "Pending"
+SUB_DOWNLOADED = "Downloaded"
+
+# How the subtitles match the video files
+MATCH_HASH = "Hash"
+# Search by file name or title (lower confidence)
+MATCH_FALLBACK = "Fallback"
+
+# Opensubtitles XML/RPC API
+XMLRPC_SERVER = "http://api.opensubtitles.org/xml-rpc"
+# Maximum size of the proxy cache (bytes, see --serve)
+PROXY_CACHE_SIZE = 1024 * 1024 * 1024
+# Maximum number of idle HTTP connections kept alive
+POOL_SIZE = 4
+# Maximum number of XML-RPC requests per second (and burst size)
+RATE_LIMIT = 4.0
+RATE_BURST = 10
+# Retries of a throttled or failed XML-RPC request
+RPC_RETRIES = 5
+# XML-RPC methods sent once (the logout at exit does not wait)
+RPC_NO_RETRY = ("LogOut",)
+# Backoff delay before the first retry (doubled for each retry) and maximum
+RETRY_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+# Status (in the response or HTTP errors) worth a retry
+RETRY_STATUS = ("429", "502", "503", "504")
+# Scheduler priorities (the lower first)
+PRIORITY_DOWNLOAD = 0
+PRIORITY_SEARCH = 1
+
+# Number of search criteria sent in one SearchSubtitles request
+SEARCH_BATCH_SIZE = 20
+# Maximum number of results of a SearchSubtitles reply: the criteria
+# without result of a full reply are searched again in smaller batches
+SEARCH_RESULTS_LIMIT = 500
+# Number of subtitle files requested in one DownloadSubtitles request
+DOWNLOAD_BATCH_SIZE = 20
+
+# Number of search results and subtitle files remembered during a run
+# to process the copies of a video file once
+DEDUP_SIZE = 4096
+
+# Season/episode in a video file name (S01E02, s1.e2, 1x02)
+EPISODE_RE = re.compile(r"[Ss](\d{1,2})[ ._-]?[Ee](\d{1,3})|"
+                        r"\b(\d{1,2})x(\d{2,3})\b")
+# Release tags following the title in a video file name
+TITLE_END_RE = re.compile(r"\b((19|20)\d\d|\d{3,4}p|bluray|bdrip|brrip|"
+                          r"dvdrip|hdrip|hdtv|web-?dl|webrip|x26[45]|h26[45]|"
+                          r"xvid|divx|proper|repack|multi|vostfr)\b",
+                          re.IGNORECASE)
 
 # Video extensions list
 VIDEO_EXT = ('.3g2', '.3gp', '.3gp2', '.3gpp', '.60d', '.ajp', '.asf',
@@ -88,51 +219,1263 @@ VIDEO_EXT = ('.3g2', '.3gp', '.3gp2', '.3gpp', '.60d', '.ajp', '.asf',
              '.ps', '.qt', '.ram', '.rm', '.rmvb', '.swf', '.ts', '.vfw',
              '.vid', '.video', '.viv', '.vivo', '.vob', '.vro', '.wm',
              '.wmv', '.wmx', '.wrap', '.wvx', '.wx', '.x264', '.xvid')
+VIDEO_EXT_SET = frozenset(VIDEO_EXT)
+
+# Opensubtitles hash: size of the head and tail blocks
+HASH_BLOCK_SIZE = 65536
+# Sum of the 64 bits little endian words of a block
+HASH_BLOCK_FORMAT = "<%dQ" % (HASH_BLOCK_SIZE // 8)
+# Number of threads used to hash the video files
+HASH_JOBS = 8
+# Number of video files queued before being hashed
+HASH_QUEUE_SIZE = 256
+
+# Number of base64 characters decoded at once (multiple of 4)
+DECODE_CHUNK_SIZE = 65536
+# Encoding of the subtitles without SubEncoding
+DEFAULT_ENCODING = "cp1252"
+# Permissions of the subtitle files (umask applied)
+SUB_FILE_MODE = 0o666
+
+# Cache file (in the user cache folder)
+CACHE_FILENAME = "cache.db"
+# Session file (in the user cache folder)
+SESSION_FILENAME = "session.json"
+# Seconds before an unused session token expires
+SESSION_TTL = 14 * 60
+# Number of cache updates between two commits
+CACHE_COMMIT_SIZE = 100
+# Days before searching again a video file without subtitle
+MISS_TTL = 7
+# Random variation of the miss TTL (+/- 20%) to spread the new searches
+MISS_TTL_JITTER = 0.2
+
+# Stages timed by the run statistics
+STATS_STAGES = ("walk", "hash", "login", "search", "download", "write")
+# Stage of each XML-RPC method
+STATS_RPC_STAGES = {"LogIn": "login", "LogOut": "login",
+                    "SearchSubtitles": "search",
+                    "DownloadSubtitles": "download"}
+# Counters of the run statistics
+STATS_COUNTERS = ("bytes_read", "bytes_written", "hash_cached",
+                  "rpc_retries", "subtitles_linked", "fallback_matches",
+                  "index_hits")
+# Upper bounds (seconds) of the latency histogram buckets
+STATS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                 10.0, 30.0, 60.0)
+
+# Outcomes of the video files not processed again by the next scan
+JOURNAL_DONE = (SUB_DOWNLOADED, SUB_ALREADY_EXIST, NOT_VIDEO_FILE)
+
+# Clock used to measure the latencies
+clock = getattr(time, "perf_counter", time.time)
 
 # Limit import to
-__all__ = ['subDatabase', 'subTitle']
+__all__ = ['subDatabase', 'subTitle', 'subCache', 'getSubTitles',
+           'subResult', 'runBudget', 'hashFile', 'hashFiles', 'scanVideos',
+           'stats']
+
+
+# Functions
+def mtimeNs(filestat):
+    """
+    Return the modification time of a file in nanoseconds
+    """
+    return getattr(filestat, "st_mtime_ns",
+                   int(filestat.st_mtime * 1000000000))
+
+
+def fileId(filestat):
+    """
+    Return (device, inode) identifying a file
+    None if unknown (os.DirEntry.stat() gives a zero inode on Windows)
+    """
+    if not filestat.st_ino:
+        return None
+    return (filestat.st_dev, filestat.st_ino)
+
+
+def isVideoFile(filename):
+    """
+    Return True if filename has a video extension (case insensitive)
+    """
+    return os.path.splitext(filename)[1].lower() in VIDEO_EXT_SET
+
+
+def parseVideoName(videofilename):
+    """
+    Return (title, season, episode) from a video file name like
+    The.Show.S01E02.720p.mkv (season and episode are None for a movie)
+    """
+    name = os.path.splitext(os.path.basename(videofilename))[0]
+    season = episode = None
+    match = EPISODE_RE.search(name)
+    if match:
+        season, episode = [int(g) for g in match.groups() if g is not None]
+        name = name[:match.start()]
+    for match in TITLE_END_RE.finditer(name):
+        # A year can also be the title
+        if match.start() > 0:
+            name = name[:match.start()]
+            break
+    title = " ".join(re.split(r"[\s._\-\[\]()]+", name)).strip()
+    return title, season, episode
+
+
+def scanVideos(path, exclude=(), hidden=False, followlinks=False,
+               journal=None):
+    """
+    Generator: scan recursively a folder
+    Yield (videofilename, filestat, siblings) for each video file
+    where siblings is the set of the file names of its folder
+
+    exclude: list of glob patterns (file/folder names or paths)
+    hidden: scan the hidden folders (starting with a dot)
+    followlinks: follow the symbolic links to folders
+    journal: scan journal (subCache instance), the folders not modified
+             since the previous scan are not listed again and only their
+             unfinished video files are yielded (file names only)
+    """
+    visited = set()
+    if followlinks:
+        visited.add(fileId(os.stat(path)))
+    folders = [path]
+    while folders:
+        folder = folders.pop()
+        if journal is not None:
+            try:
+                mtime = mtimeNs(os.stat(folder))
+            except OSError as msg:
+                logging.error("Can not scan %s (error: %s)" % (folder, msg))
+                continue
+            known = journal.getFolder(folder, mtime)
+            if known is not None:
+                # Folder not modified since the previous scan
+                # The names stored by the previous scan are filtered
+                # again (the options may have changed)
+                subfolders, videos = known
+                for name in subfolders:
+                    subfolder = os.path.join(folder, name)
+                    if (isExcluded(subfolder, exclude) or
+                            (name.startswith(".") and not hidden)):
+                        continue
+                    try:
+                        if not followlinks:
+                            if os.path.islink(subfolder):
+                                continue
+                        else:
+                            folderid = fileId(os.stat(subfolder))
+                            if folderid is not None:
+                                if folderid in visited:
+                                    continue
+                                visited.add(folderid)
+                    except OSError as msg:
+                        logging.error("Can not read %s (error: %s)"
+                                      % (subfolder, msg))
+                        continue
+                    folders.append(subfolder)
+                videos = [os.path.join(folder, name) for name in videos
+                          if not isExcluded(os.path.join(folder, name),
+                                            exclude)]
+                done = journal.getDone(videos)
+                for videofilename in videos:
+                    if videofilename not in done:
+                        yield videofilename
+                continue
+            subfolders = []
+            videos = []
+        try:
+            entries = list(scandir(folder))
+        except OSError as msg:
+            logging.error("Can not scan %s (error: %s)" % (folder, msg))
+            continue
+        siblings = frozenset(entry.name for entry in entries)
+        for entry in entries:
+            if isExcluded(entry.path, exclude):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=followlinks):
+                    if entry.name.startswith(".") and not hidden:
+                        continue
+                    if followlinks:
+                        # Do not scan twice the same folder (loops)
+                        # The inode of os.DirEntry.stat() is 0 on Windows
+                        folderid = (fileId(entry.stat()) or
+                                    fileId(os.stat(entry.path)))
+                        if folderid is not None:
+                            if folderid in visited:
+                                continue
+                            visited.add(folderid)
+                    folders.append(entry.path)
+                    if journal is not None:
+                        subfolders.append(entry.name)
+                elif entry.is_file() and isVideoFile(entry.name):
+                    if journal is not None:
+                        videos.append(entry.name)
+                    yield (entry.path, entry.stat(), siblings)
+            except OSError as msg:
+                logging.error("Can not read %s (error: %s)"
+                              % (entry.path, msg))
+        if journal is not None:
+            journal.setFolder(folder, mtime, subfolders, videos)
+
+
+def isExcluded(path, exclude):
+    """
+    Return True if a file/folder name or path matches an exclude pattern
+    """
+    for pattern in exclude:
+        if (fnmatch.fnmatch(os.path.basename(path), pattern) or
+                fnmatch.fnmatch(path, pattern)):
+            return True
+    return False
+
+
+def videoItem(item):
+    """
+    Return (videofilename, filestat, siblings) for a video file name
+    or a scanVideos item (filestat and siblings are None if unknown)
+    """
+    if isinstance(item, tuple):
+        return item
+    return (item, None, None)
+
+
+def hashFile(videofilename, filesize=None):
+    """
+    Return the Opensubtitles hash code of the given file
+    (or HASH_SIZE_ERROR if the file is too small)
+    """
+
+    logging.debug("Compute hash tag for file %s" % videofilename)
+
+    if filesize is None:
+        filesize = os.path.getsize(videofilename)
+    if filesize < HASH_BLOCK_SIZE * 2:
+        logging.error("Bad file size for %s (%s bytes), can't compute hash"
+                      % (videofilename, filesize))
+        return HASH_SIZE_ERROR
+
+    with stats.timer("hash"):
+        head, tail = readHashBlocks(videofilename, filesize)
+    stats.count("bytes_read", len(head) + len(tail))
+    returnedhash = hashBlocks(filesize, head, tail)
+
+    logging.debug("Hash tag for file %s is %s" % (videofilename,
+                                                  returnedhash))
+
+    return returnedhash
+
+
+def readHashBlocks(videofilename, filesize):
+    """
+    Read the head and tail blocks of a file (positional reads)
+    The kernel is told not to read ahead and not to keep the blocks
+    in the page cache
+    """
+    fd = os.open(videofilename, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_RANDOM)
+        tail_offset = filesize - HASH_BLOCK_SIZE
+        head = readBlock(fd, 0)
+        tail = readBlock(fd, tail_offset)
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, HASH_BLOCK_SIZE, os.POSIX_FADV_DONTNEED)
+            os.posix_fadvise(fd, tail_offset, HASH_BLOCK_SIZE,
+                             os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    return head, tail
+
+
+def readBlock(fd, offset):
+    """
+    Read HASH_BLOCK_SIZE bytes at offset
+    """
+    block = b""
+    while len(block) < HASH_BLOCK_SIZE:
+        if hasattr(os, "pread"):
+            data = os.pread(fd, HASH_BLOCK_SIZE - len(block),
+                            offset + len(block))
+        else:
+            os.lseek(fd, offset + len(block), os.SEEK_SET)
+            data = os.read(fd, HASH_BLOCK_SIZE - len(block))
+        if not data:
+            raise IOError("Unexpected end of file")
+        block += data
+    return block
+
+
+def hashFiles(videofilenames, jobs=HASH_JOBS):
+    """
+    Generator: hash the video files with a pool of jobs threads
+    videofilenames items can also be (videofilename, filesize) tuples
+    Yield (videofilename, filesize, hash) as soon as a hash is computed
+    """
+
+    def hashTuple(videofilename):
+        try:
+            if isinstance(videofilename, tuple):
+                videofilename, filesize = videofilename
+            else:
+                filesize = os.path.getsize(videofilename)
+            hash = hashFile(videofilename, filesize)
+        except (IOError, OSError) as msg:
+            logging.error("Can not hash %s (error: %s)" % (videofilename, msg))
+            return (videofilename, None, HASH_SIZE_ERROR)
+        return (videofilename, filesize, hash)
+
+    if jobs <= 1 or ThreadPoolExecutor is None:
+        for videofilename in videofilenames:
+            yield hashTuple(videofilename)
+        return
+
+    # Keep at most 2 requests by thread in flight
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        running = set()
+        for videofilename in videofilenames:
+            running.add(executor.submit(hashTuple, videofilename))
+            if len(running) >= jobs * 2:
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def getCacheDir():
+    """
+    Return the user cache folder for witsub
+    """
+    if sys.platform.startswith("win"):
+        root = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+    else:
+        root = os.environ.get("XDG_CACHE_HOME",
+                              os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(root, __appname__)
+
+
+def hashBlocks(filesize, head, tail):
+    """
+    Return the Opensubtitles hash code from the file size
+    and its head and tail blocks
+    """
+    hash = filesize
+    hash += sum(struct.unpack(HASH_BLOCK_FORMAT, head))
+    hash += sum(struct.unpack(HASH_BLOCK_FORMAT, tail))
+    hash = hash & 0xFFFFFFFFFFFFFFFF
+
+    return "%016x" % hash
+
+
+def decodeSubtitle(data, fileobj, encoding=None, charset=None):
+    """
+    Decode a base64/gzip subtitle payload and write it to fileobj
+    chunk by chunk (the decoded subtitle is never fully in memory)
+    If charset is set, the subtitle is converted from encoding
+    (the SubEncoding of the search result) to charset
+    The subtitle is written as is if it can not be converted
+    Return the number of bytes written
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    decoder = encoder = None
+    if charset:
+        encoding = encoding or DEFAULT_ENCODING
+        try:
+            if codecs.lookup(encoding).name == "utf-8":
+                # Drop the BOM
+                encoding = "utf-8-sig"
+            decoder = codecs.getincrementaldecoder(encoding)("replace")
+            encoder = codecs.getincrementalencoder(charset)("replace")
+        except (LookupError, UnicodeError) as msg:
+            logging.warning("Can not convert the subtitle from %s to %s "
+                            "(error: %s), keep it as is"
+                            % (encoding, charset, msg))
+            decoder = encoder = None
+
+    def write(chunk, final=False):
+        if decoder is not None:
+            chunk = encoder.encode(decoder.decode(chunk, final), final)
+        fileobj.write(chunk)
+        return len(chunk)
+
+    size = 0
+    rest = data[:0]
+    try:
+        for offset in range(0, len(data), DECODE_CHUNK_SIZE):
+            # Ignore the line breaks and keep the base64 groups of 4
+            # characters together
+            chunk = rest + "".join(data[offset:offset + DECODE_CHUNK_SIZE]
+                                   .split())
+            cut = len(chunk) - len(chunk) % 4
+            rest = chunk[cut:]
+            size += write(decompressor.decompress(
+                binascii.a2b_base64(chunk[:cut])))
+        if rest:
+            raise ValueError("Truncated base64 data")
+        size += write(decompressor.flush(), final=True)
+    except UnicodeError as msg:
+        if decoder is None:
+            raise
+        # The conversion fails (codec without the replace error handler):
+        # write the subtitle again as is
+        logging.warning("Can not convert the subtitle from %s to %s "
+                        "(error: %s), keep it as is"
+                        % (encoding, charset, msg))
+        fileobj.seek(0)
+        fileobj.truncate()
+        return decodeSubtitle(data, fileobj)
+    return size
+
+
+def writeSubtitle(subtitlefilename, data, encoding=None, charset=None):
+    """
+    Decode a base64/gzip subtitle payload to subtitlefilename
+    (see decodeSubtitle and writeAtomic)
+    Return the number of bytes written
+    """
+    return writeAtomic(subtitlefilename,
+                       lambda tmpfile: decodeSubtitle(data, tmpfile,
+                                                      encoding=encoding,
+                                                      charset=charset))
+
+
+def linkSubtitle(source, subtitlefilename):
+    """
+    Hardlink the subtitle file source to subtitlefilename
+    (copy it if the hardlink is not possible)
+    """
+    if (os.path.exists(subtitlefilename) and
+            os.path.samefile(source, subtitlefilename)):
+        return
+    folder = os.path.dirname(os.path.abspath(subtitlefilename))
+    tmpfilename = os.path.join(folder, ".%s-%016x.tmp"
+                               % (__appname__, random.getrandbits(64)))
+    try:
+        os.link(source, tmpfilename)
+    except (OSError, AttributeError):
+        # Another file system (or no hardlink support)
+        with open(source, 'rb') as sourcefile:
+            writeAtomic(subtitlefilename,
+                        lambda tmpfile: shutil.copyfileobj(sourcefile,
+                                                           tmpfile))
+        return
+    try:
+        getattr(os, "replace", os.rename)(tmpfilename, subtitlefilename)
+    except:
+        os.remove(tmpfilename)
+        raise
+    syncFolder(folder)
+
+
+def writeAtomic(filename, write):
+    """
+    Call write(fileobj) on a temporary file of the filename folder,
+    sync and rename it: the readers never see a partial file
+    Return the value returned by write
+    """
+    folder = os.path.dirname(os.path.abspath(filename))
+    fd, tmpfilename = openTemp(folder)
+    try:
+        with os.fdopen(fd, 'wb') as tmpfile:
+            ret = write(tmpfile)
+            tmpfile.flush()
+            os.fsync(tmpfile.fileno())
+        # os.rename does not overwrite an existing file on Windows
+        getattr(os, "replace", os.rename)(tmpfilename, filename)
+    except:
+        os.remove(tmpfilename)
+        raise
+    syncFolder(folder)
+    return ret
+
+
+def openTemp(folder):
+    """
+    Create a new temporary file in folder with the SUB_FILE_MODE
+    permissions (the umask is applied by the system)
+    Return (file descriptor, file name)
+    """
+    while True:
+        tmpfilename = os.path.join(folder, ".%s-%016x.tmp"
+                                   % (__appname__, random.getrandbits(64)))
+        try:
+            return (os.open(tmpfilename, os.O_WRONLY | os.O_CREAT |
+                            os.O_EXCL | getattr(os, "O_BINARY", 0),
+                            SUB_FILE_MODE),
+                    tmpfilename)
+        except OSError as msg:
+            if msg.errno != errno.EEXIST:
+                raise
+
+
+def syncFolder(folder):
+    """
+    Sync the entries (renames) of a folder
+    """
+    try:
+        # Sync the rename
+        dirfd = os.open(folder, os.O_RDONLY)
+    except OSError:
+        # Windows
+        return
+    try:
+        os.fsync(dirfd)
+    except OSError:
+        pass
+    finally:
+        os.close(dirfd)
 
 
 # Classes
+if sys.version_info > (3, 0):
+    xmlrpcTransport = xmlrpc.client.Transport
+else:
+    xmlrpcTransport = xmlrpclib.Transport
+
+
+class keepAliveTransport(xmlrpcTransport):
+    """
+    XML-RPC transport keeping the HTTP/1.1 connections alive
+    The idle connections are shared by the threads (pool)
+    """
+
+    def __init__(self, https=False, poolsize=POOL_SIZE):
+        xmlrpcTransport.__init__(self)
+        self.https = https
+        self.poolsize = poolsize
+        # Idle connections: list of (host, connection)
+        self.pool = []
+        self.lock = threading.Lock()
+        # Connection used by the current thread
+        self.local = threading.local()
+        # Statistics
+        self.opened = 0
+        self.requests = 0
+
+    def make_connection(self, host):
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        connection = None
+        with self.lock:
+            for i in range(len(self.pool)):
+                if self.pool[i][0] == host:
+                    connection = self.pool.pop(i)[1]
+                    break
+            else:
+                self.opened += 1
+        if connection is None:
+            logging.debug("Open a new connection to %s" % chost)
+            if self.https:
+                connection = httplib.HTTPSConnection(chost)
+            else:
+                connection = httplib.HTTPConnection(chost)
+        self.local.connection = (host, connection)
+        return connection
+
+    def request(self, host, handler, request_body, verbose=False):
+        try:
+            response = xmlrpcTransport.request(self, host, handler,
+                                               request_body, verbose)
+        except Exception:
+            # The connection can be in a strange state
+            self.close()
+            raise
+        finally:
+            self.__release__()
+        with self.lock:
+            self.requests += 1
+        return response
+
+    def close(self):
+        """
+        Close the connection of the current thread (on error)
+        The idle connections are probably closed by the server too
+        """
+        current = getattr(self.local, "connection", None)
+        self.local.connection = None
+        if current is not None:
+            current[1].close()
+        self.closeAll()
+
+    def closeAll(self):
+        """
+        Close the idle connections
+        """
+        with self.lock:
+            pool = self.pool
+            self.pool = []
+        for host, connection in pool:
+            connection.close()
+
+    def __release__(self):
+        # Put back the connection of the current thread in the pool
+        current = getattr(self.local, "connection", None)
+        self.local.connection = None
+        if current is None:
+            return
+        with self.lock:
+            if len(self.pool) < self.poolsize:
+                self.pool.append(current)
+                return
+        current[1].close()
+
+
+class rpcScheduler(object):
+    """
+    Class used to schedule the XML-RPC requests
+    Token bucket (rate requests per second) with priorities and
+    exponential backoff
+    """
+
+    def __init__(self, rate=RATE_LIMIT, burst=RATE_BURST):
+        # No limit if rate is None or 0
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.time()
+        # Number of threads waiting for a token, by priority
+        self.waiting = [0, 0]
+        self.condition = threading.Condition()
+
+    def acquire(self, priority=PRIORITY_SEARCH):
+        """
+        Wait for a token
+        The requests with a lower priority value are served first
+        """
+        if not self.rate:
+            return
+        with self.condition:
+            self.waiting[priority] += 1
+            try:
+                while True:
+                    now = time.time()
+                    self.tokens = min(self.burst, self.tokens +
+                                      (now - self.last) * self.rate)
+                    self.last = now
+                    if (self.tokens >= 1 and
+                            not any(self.waiting[:priority])):
+                        self.tokens -= 1
+                        return
+                    self.condition.wait(max((1 - self.tokens) / self.rate,
+                                            0.01))
+            finally:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+
+    def delay(self, attempt):
+        """
+        Return the backoff delay (in seconds) before the given retry
+        (full jitter)
+        """
+        return random.uniform(0, min(RETRY_MAX_DELAY,
+                                     RETRY_DELAY * 2 ** attempt))
+
+    def retryable(self, rpc=None, error=None):
+        """
+        Return True if the request should be retried
+        (throttling, server overload or transport error)
+        """
+        if error is not None:
+            if str(getattr(error, "errcode", "")).startswith(RETRY_STATUS):
+                return True
+            return isinstance(error, (IOError, OSError,
+                                      httplib.HTTPException))
+        try:
+            return str(rpc["status"]).startswith(RETRY_STATUS)
+        except (KeyError, TypeError):
+            return False
+
+
+class budgetError(Exception):
+    """
+    Raised instead of sending a request out of the budget (runBudget)
+    """
+    pass
+
+
+class runBudget(object):
+    """
+    Class used to limit the XML-RPC requests and the time of a run
+    (None for no limit)
+    """
+
+    def __init__(self, requests=None, seconds=None):
+        self.requests = requests
+        self.seconds = seconds
+        self.used = 0
+        self.started = clock()
+        self.lock = threading.Lock()
+
+    def take(self, requests=1):
+        """
+        Count the requests about to be sent
+        Return False (nothing counted) if they are out of the budget
+        """
+        if self.seconds is not None and clock() - self.started >= \
+                self.seconds:
+            return False
+        with self.lock:
+            if self.requests is not None and \
+                    self.used + requests > self.requests:
+                return False
+            self.used += requests
+            return True
+
+    def allows(self, requests=1):
+        """
+        Return True if requests can be sent within the budget
+        """
+        if self.seconds is not None and clock() - self.started >= \
+                self.seconds:
+            return False
+        with self.lock:
+            return self.requests is None or \
+                self.used + requests <= self.requests
+
+
+class runStats(object):
+    """
+    Time by stage (latency histograms) and counters of a run
+    The statistics are shared by the threads (see the stats instance)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Start a new run
+        """
+        with self.lock:
+            self.start = time.time()
+            # Stage => [count, sum, max, histogram]
+            self.stages = collections.OrderedDict()
+            for stage in STATS_STAGES:
+                self.stages[stage] = self.__newStage__()
+            self.counters = collections.OrderedDict(
+                (counter, 0) for counter in STATS_COUNTERS)
+            self.outcomes = collections.OrderedDict()
+
+    def __newStage__(self):
+        return [0, 0.0, 0.0, [0] * (len(STATS_BUCKETS) + 1)]
+
+    def observe(self, stage, seconds):
+        """
+        Add a latency (in seconds) to a stage
+        """
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = self.__newStage__()
+            stat = self.stages[stage]
+            stat[0] += 1
+            stat[1] += seconds
+            stat[2] = max(stat[2], seconds)
+            stat[3][bisect.bisect_left(STATS_BUCKETS, seconds)] += 1
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """
+        Context manager: time the block in a stage
+        """
+        start = clock()
+        try:
+            yield
+        finally:
+            self.observe(stage, clock() - start)
+
+    def timeIter(self, stage, iterable):
+        """
+        Generator: yield the items of iterable, the time spent to get
+        each item is added to a stage
+        """
+        iterator = iter(iterable)
+        while True:
+            start = clock()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.observe(stage, clock() - start)
+                return
+            self.observe(stage, clock() - start)
+            yield item
+
+    def count(self, counter, value=1):
+        """
+        Add value to a counter
+        """
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def outcome(self, outcome):
+        """
+        Count the outcome of a video file
+        """
+        with self.lock:
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    def summary(self):
+        """
+        Return the statistics as a text table
+        """
+        with self.lock:
+            lines = ["Run time: %.2f seconds" % (time.time() - self.start),
+                     "%-10s %8s %10s %10s %10s" % ("Stage", "Calls",
+                                                   "Total (s)", "Mean (ms)",
+                                                   "Max (ms)")]
+            for stage, (count, total, maximum, h) in self.stages.items():
+                lines.append("%-10s %8d %10.2f %10.1f %10.1f"
+                             % (stage, count, total,
+                                total * 1000 / count if count else 0,
+                                maximum * 1000))
+            for counter, value in self.counters.items():
+                lines.append("%-20s %d" % (counter, value))
+            for outcome, value in self.outcomes.items():
+                lines.append("%-20s %d" % (outcome, value))
+        return "\n".join(lines)
+
+    def toJson(self):
+        """
+        Return the statistics as a JSON string
+        """
+        with self.lock:
+            stages = collections.OrderedDict()
+            for stage, (count, total, maximum, h) in self.stages.items():
+                stages[stage] = collections.OrderedDict(
+                    [("count", count), ("sum", total), ("max", maximum),
+                     ("buckets", collections.OrderedDict(
+                         zip([str(b) for b in STATS_BUCKETS] + ["+Inf"],
+                             h)))])
+            ret = collections.OrderedDict(
+                [("start", self.start),
+                 ("duration", time.time() - self.start),
+                 ("stages", stages), ("counters", self.counters),
+                 ("outcomes", self.outcomes)])
+            return json.dumps(ret, indent=2)
+
+    def toPrometheus(self):
+        """
+        Return the statistics in the Prometheus text format
+        (node exporter textfile collector)
+        """
+        name = __appname__
+        with self.lock:
+            lines = ["# HELP %s_stage_seconds Latency of the %s stages"
+                     % (name, name),
+                     "# TYPE %s_stage_seconds histogram" % name]
+            for stage, (count, total, maximum, h) in self.stages.items():
+                cumulative = 0
+                for bucket, value in zip(STATS_BUCKETS + ("+Inf",), h):
+                    cumulative += value
+                    lines.append('%s_stage_seconds_bucket{stage="%s",'
+                                 'le="%s"} %d'
+                                 % (name, stage, bucket, cumulative))
+                lines.append('%s_stage_seconds_sum{stage="%s"} %f'
+                             % (name, stage, total))
+                lines.append('%s_stage_seconds_count{stage="%s"} %d'
+                             % (name, stage, count))
+            for counter, value in self.counters.items():
+                lines.append("# TYPE %s_%s_total counter" % (name, counter))
+                lines.append("%s_%s_total %d" % (name, counter, value))
+            lines.append("# TYPE %s_outcomes_total counter" % name)
+            for outcome, value in self.outcomes.items():
+                lines.append('%s_outcomes_total{outcome="%s"} %d'
+                             % (name, outcome, value))
+            lines.append("# TYPE %s_run_seconds gauge" % name)
+            lines.append("%s_run_seconds %f"
+                         % (name, time.time() - self.start))
+            lines.append("# TYPE %s_last_run_timestamp_seconds gauge" % name)
+            lines.append("%s_last_run_timestamp_seconds %f"
+                         % (name, self.start))
+        return "\n".join(lines) + "\n"
+
+    def save(self, filename):
+        """
+        Save the statistics to filename: Prometheus text format if the
+        file name ends with .prom, else JSON
+        """
+        if filename.endswith(".prom"):
+            text = self.toPrometheus()
+        else:
+            text = self.toJson()
+        writeAtomic(filename, lambda f: f.write(text.encode("utf-8")))
+
+
+# Statistics of the current run
+stats = runStats()
+
+
+class subCache(object):
+    """
+    Class used to store the witsub data between two runs
+    (SQLite database in the user cache folder)
+    """
+
+    def __init__(self, filename=None, missttl=MISS_TTL, retrymisses=False):
+        if filename is None:
+            filename = os.path.join(getCacheDir(), CACHE_FILENAME)
+        if not os.path.isdir(os.path.dirname(os.path.abspath(filename))):
+            os.makedirs(os.path.dirname(os.path.abspath(filename)))
+        logging.debug("Open the cache %s" % filename)
+        self.filename = filename
+        # The cache can be used by several threads
+        self.lock = threading.RLock()
+        self.db = None
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS hashes "
+                        "(key TEXT PRIMARY KEY, path TEXT, hash TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS misses "
+                        "(hash TEXT, size TEXT, lang TEXT, expires REAL, "
+                        "PRIMARY KEY (hash, size, lang))")
+        # Scan journal
+        self.db.execute("CREATE TABLE IF NOT EXISTS folders "
+                        "(path TEXT PRIMARY KEY, mtime INTEGER, "
+                        "subfolders TEXT, videos TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files "
+                        "(path TEXT PRIMARY KEY, outcome TEXT, time REAL)")
+        self.updates = 0
+        # TTL of the searches without subtitle (in days)
+        self.missttl = missttl
+        # Search again the video files without subtitle
+        self.retrymisses = retrymisses
+
+    def __del__(self):
+        if getattr(self, "db", None) is not None:
+            self.close()
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.commit()
+                self.db.close()
+                self.db = None
+
+    def __commit__(self):
+        # Commit by batch of CACHE_COMMIT_SIZE updates
+        self.updates += 1
+        if self.updates >= CACHE_COMMIT_SIZE:
+            self.db.commit()
+            self.updates = 0
+
+    def statKey(self, filestat, path):
+        """
+        Return the cache key of a file: path, device, inode, size and mtime
+        (the inode is 0 on Windows)
+        """
+        return "%s:%d:%d:%d:%d" % (os.path.abspath(path), filestat.st_dev,
+                                   filestat.st_ino, filestat.st_size,
+                                   mtimeNs(filestat))
+
+    def getHash(self, filestat, path):
+        """
+        Return the cached hash of a file (None if not in the cache)
+        """
+        with self.lock:
+            row = self.db.execute("SELECT hash FROM hashes WHERE key = ?",
+                                  (self.statKey(filestat, path),)).fetchone()
+        if row is None:
+            return None
+        return str(row[0])
+
+    def setHash(self, filestat, path, hash):
+        """
+        Store the hash of a file
+        """
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)",
+                            (self.statKey(filestat, path),
+                             os.path.abspath(path), hash))
+            self.__commit__()
+
+    def prune(self):
+        """
+        Remove the cached hashes of the deleted or modified files
+        Return the number of removed entries
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT key, path FROM hashes").fetchall()
+        stale = []
+        for key, path in rows:
+            try:
+                if self.statKey(os.stat(path), path) == key:
+                    continue
+            except OSError:
+                pass
+            stale.append((key,))
+        with self.lock:
+            self.db.executemany("DELETE FROM hashes WHERE key = ?", stale)
+            removed = len(stale)
+            removed += self.db.execute("DELETE FROM misses "
+                                       "WHERE expires <= ?",
+                                       (time.time(),)).rowcount
+            self.db.commit()
+        logging.debug("%s entries removed from the cache" % removed)
+        return removed
+
+    def isMiss(self, moviehash, moviebytesize, lang):
+        """
+        Return True if a previous search found no subtitle
+        (and its TTL is not expired)
+        """
+        if self.retrymisses:
+            return False
+        with self.lock:
+            row = self.db.execute("SELECT expires FROM misses "
+                                  "WHERE hash = ? AND size = ? AND lang = ?",
+                                  (moviehash, str(moviebytesize),
+                                   lang)).fetchone()
+        return row is not None and row[0] > time.time()
+
+    def setMiss(self, moviehash, moviebytesize, lang):
+        """
+        Store a search without subtitle
+        """
+        ttl = self.missttl * 86400
+        ttl *= 1 + random.uniform(-MISS_TTL_JITTER, MISS_TTL_JITTER)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO misses "
+                            "VALUES (?, ?, ?, ?)",
+                            (moviehash, str(moviebytesize), lang,
+                             time.time() + ttl))
+            self.__commit__()
+
+    def getFolder(self, path, mtime):
+        """
+        Return the (subfolders, videos) names of a scanned folder
+        None if the folder was modified since the scan (or never scanned)
+        """
+        with self.lock:
+            row = self.db.execute("SELECT mtime, subfolders, videos "
+                                  "FROM folders WHERE path = ?",
+                                  (os.path.abspath(path),)).fetchone()
+        if row is None or row[0] != mtime:
+            return None
+        return json.loads(row[1]), json.loads(row[2])
+
+    def setFolder(self, path, mtime, subfolders, videos):
+        """
+        Store the subfolders and video names of a scanned folder
+        """
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO folders "
+                            "VALUES (?, ?, ?, ?)",
+                            (os.path.abspath(path), mtime,
+                             json.dumps(subfolders), json.dumps(videos)))
+            self.__commit__()
+
+    def setOutcome(self, subtitle):
+        """
+        Store the outcome of a video file (subTitle or subResult)
+        """
+        path = os.path.abspath(subtitle.getVideoFileName())
+        outcome = subtitle.getOutcome()
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+                            (path, outcome, time.time()))
+            if outcome == SUB_DOWNLOADED:
+                self.__touchFolder__(os.path.dirname(path))
+            self.__commit__()
+
+    def __touchFolder__(self, path):
+        # The subtitle file written in a scanned folder changed its mtime:
+        # store the new one only if the folder still has the subfolders
+        # and video files of the scan (the folder is not listed again by
+        # the next scan for this write, but it is for a new video file)
+        row = self.db.execute("SELECT subfolders, videos FROM folders "
+                              "WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return
+        try:
+            # Stat before the listing: a later change is seen by the scan
+            mtime = mtimeNs(os.stat(path))
+            names = set(entry.name for entry in scandir(path)
+                        if entry.is_dir() or isVideoFile(entry.name))
+        except OSError:
+            return
+        if names == set(json.loads(row[0])) | set(json.loads(row[1])):
+            self.db.execute("UPDATE folders SET mtime = ? WHERE path = ?",
+                            (mtime, path))
+
+    def getDone(self, paths):
+        """
+        Return the set of the video files already processed
+        The files without subtitle are processed again after the miss TTL
+        """
+        done = set()
+        since = time.time() - self.missttl * 86400
+        for i in range(0, len(paths), 500):
+            batch = dict((os.path.abspath(p), p) for p in paths[i:i + 500])
+            with self.lock:
+                rows = self.db.execute(
+                    "SELECT path, outcome, time FROM files WHERE path IN "
+                    "(%s)" % ",".join("?" * len(batch)),
+                    list(batch)).fetchall()
+            for path, outcome, when in rows:
+                if (outcome in JOURNAL_DONE or
+                        (outcome == GET_SUB_UNKNOWN and when > since)):
+                    done.add(batch[path])
+        return done
+
+
+class searchResults(list):
+    """
+    Search results of a video file (list) with the languages not
+    searched because of a request error (failed)
+    """
+
+    def __init__(self, results=(), failed=()):
+        list.__init__(self, results)
+        self.failed = set(failed)
+
+
 class subDatabase(object):
     """
     Class used to configure the access to the subtitle database
     """
 
-    def __init__(self, language="eng"):
-        self.lang = language
+    def __init__(self, language="eng", cache=None, rate=RATE_LIMIT,
+                 sessionfile=None, charset=None, fallback=True, url=None,
+                 budget=None):
+        self.setLang(language)
+        # Requests and time of the run (runBudget instance or None)
+        self.budget = budget
+        # Charset of the subtitle files (None to keep the original one)
+        self.charset = charset
+        # Search by file name/title the video files not found by hash
+        self.fallback = fallback
+        # Search results and subtitle files of this run, to process
+        # the copies of a video file once (see planSearch and getWritten)
+        self.searched = collections.OrderedDict()
+        self.written = collections.OrderedDict()
+        # Local cache (subCache instance or None)
+        self.cache = cache
+        # XML-RPC server (Opensubtitles or a witsub proxy, see --serve)
+        self.url = url or XMLRPC_SERVER
+        self.transport = None
+        self.scheduler = rpcScheduler(rate)
+        # The session token is kept in this file between two runs
+        # (None to logout at the end)
+        self.sessionfile = sessionfile
+        self.lastactivity = None
         self.rpc_server = None
         self.rpc_login = None
-        self.connect()
-        self.login()
+        # Set by a failed login: no other login during the run
+        self.loginfailed = False
+        # Connect and login on the first request (see open)
+        self.lock = threading.RLock()
 
     def __del__(self):
-        self.logout()
+        if self.rpc_login is None:
+            return
+        if self.sessionfile is not None:
+            # Keep the session for the next run
+            self.saveSession()
+        else:
+            self.logout()
 
     def setLang(self, language="eng"):
-        self.lang = language
+        # A comma separated list of languages is searched in one request
+        self.langs = [lang.strip() for lang in language.split(",")
+                      if lang.strip()]
+        self.lang = ",".join(self.langs)
         return self.lang
 
     def open(self):
-        if self.rpc_server is None:
-            self.connect()
-        if self.rpc_login is None:
-            self.login()
+        with self.lock:
+            if self.rpc_server is None:
+                self.connect()
+            if (self.rpc_login is None and not self.loginfailed and
+                    not self.restoreSession()):
+                self.login()
+        return self.rpc_login
 
     def close(self):
         self.logout()
+        if self.sessionfile is not None and os.path.exists(self.sessionfile):
+            os.remove(self.sessionfile)
         self.rpc_server = None
         self.rpc_login = None
 
+    def getToken(self):
+        """
+        Return the session token (connect and login if needed)
+        None if the login fails
+        """
+        if self.open() is None:
+            return None
+        return self.rpc_login["token"]
+
+    def renewToken(self, token):
+        """
+        Login again if token is the current one (expired session)
+        Return the new token (None if the login fails)
+        """
+        with self.lock:
+            if (self.rpc_login is not None and
+                    self.rpc_login["token"] == token):
+                logging.debug("Session expired, login again")
+                self.rpc_login = None
+        return self.getToken()
+
+    def restoreSession(self):
+        """
+        Reuse the session token saved by a previous run
+        Return True if the session is reused
+        """
+        if self.sessionfile is None:
+            return False
+        try:
+            with open(self.sessionfile) as f:
+                session = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False
+        try:
+            if (session.get("url") != self.url or
+                    session["expires"] < time.time()):
+                return False
+            token = str(session["token"])
+        except (KeyError, AttributeError, TypeError):
+            # Malformed session file: start a new session
+            logging.debug("Invalid session file %s" % self.sessionfile)
+            return False
+        logging.debug("Reuse the session of a previous run")
+        self.rpc_login = {"status": "200 OK", "token": token}
+        return True
+
+    def saveSession(self):
+        """
+        Save the session token for the next run
+        """
+        if self.sessionfile is None or self.rpc_login is None:
+            return
+        if self.lastactivity is None:
+            # Restored session never used: keep its expiration
+            return
+        session = {"url": self.url,
+                   "token": self.rpc_login["token"],
+                   "expires": self.lastactivity + SESSION_TTL}
+        try:
+            # Unique temporary file: several runs can share the session
+            writeAtomic(self.sessionfile, lambda f: f.write(
+                json.dumps(session).encode("utf-8")))
+        except (IOError, OSError) as msg:
+            logging.warning("Can not save the session (error: %s)" % msg)
+
     def connect(self):
         # Connect to the Opensubtitles XML/RPC API
-        XMLRPC_SERVER = "http://api.opensubtitles.org/xml-rpc"
-        logging.debug("Connect to XML-RPC server %s" % XMLRPC_SERVER)
+        logging.debug("Connect to XML-RPC server %s" % self.url)
+        self.transport = keepAliveTransport(
+            https=self.url.startswith("https"))
         try:
             if sys.version_info > (3, 0):
-                rpc_server = xmlrpc.client.Server(XMLRPC_SERVER)
+                rpc_server = xmlrpc.client.Server(self.url,
+                                                  transport=self.transport)
             else:
-                rpc_server = xmlrpclib.Server(XMLRPC_SERVER)
+                rpc_server = xmlrpclib.Server(self.url,
+                                              transport=self.transport)
         except Exception as msg:
             logging.error("%s" % msg)
             return None
@@ -140,6 +1483,62 @@ class subDatabase(object):
         self.rpc_server = rpc_server
         return rpc_server
 
+    def __rpc__(self, method, priority, *params):
+        """
+        Call an XML-RPC method through the scheduler
+        Retry (with backoff) on throttling and transport errors
+        """
+        attempt = 0
+        retries = 0 if method in RPC_NO_RETRY else RPC_RETRIES
+        relogin = method in ("LogIn", "LogOut")
+        while True:
+            if self.budget is not None and not self.budget.take():
+                # No request out of the budget (--max-requests and
+                # --time-budget)
+                raise budgetError("Budget reached, %s not sent" % method)
+            self.scheduler.acquire(priority)
+            try:
+                with stats.timer(STATS_RPC_STAGES.get(method, method)):
+                    rpc = getattr(self.rpc_server, method)(*params)
+            except Exception as msg:
+                if (attempt >= retries or
+                        not self.scheduler.retryable(error=msg) or
+                        not self.__retryBudget__()):
+                    raise
+                logging.warning("%s error (%s), retry" % (method, msg))
+            else:
+                self.lastactivity = time.time()
+                if not relogin and str(rpc["status"]).startswith("401"):
+                    # Expired session: login again (only once)
+                    relogin = True
+                    token = self.renewToken(params[0])
+                    if token is None:
+                        return rpc
+                    params = (token,) + params[1:]
+                    continue
+                if (attempt >= retries or
+                        not self.scheduler.retryable(rpc=rpc) or
+                        not self.__retryBudget__()):
+                    return rpc
+                logging.warning("%s return %s, retry"
+                                % (method, rpc["status"]))
+            stats.count("rpc_retries")
+            time.sleep(self.scheduler.delay(attempt))
+            attempt += 1
+
+    def batchAllowed(self):
+        """
+        Return True if the budget allows the requests of a batch of files
+        (search and download, and the login)
+        The other download requests of a batch are checked by downloadMany
+        """
+        return self.budget is None or self.budget.allows(
+            2 + (self.rpc_login is None))
+
+    def __retryBudget__(self):
+        # No retry out of the budget
+        return self.budget is None or self.budget.allows()
+
     def login(self):
         # Check if you are connected/loggedin
         if (self.rpc_server is None):
@@ -149,17 +1548,21 @@ class subDatabase(object):
         # Login to Opensubtitles XML/RPC API
         logging.debug("Login to XML-RPC server %s" % self.rpc_server)
         try:
-            self.rpc_login = self.rpc_server.LogIn("", "",
-                                                   self.lang,
-                                                   __useragent__)
+            self.rpc_login = self.__rpc__("LogIn", PRIORITY_DOWNLOAD,
+                                          "", "", self.langs[0],
+                                          __useragent__)
         except Exception as msg:
             logging.error("%s" % msg)
+            self.rpc_login = None
+            self.loginfailed = True
             return None
         else:
             if (self.rpc_login["status"] != "200 OK"):
                 # Login Error
                 logging.error("Can not login to XML-RPC server (error: %s)"
                               % self.rpc_login["status"])
+                self.rpc_login = None
+                self.loginfailed = True
                 return None
 
         # Login OK
@@ -169,16 +1572,16 @@ class subDatabase(object):
         return self.rpc_login
 
     def search(self, searchlist):
-        # Check if you are connected/loggedin
-        if (self.rpc_login is None):
+        # Connect/login if needed
+        if (self.open() is None):
             logging.error("Should be loggedin before searching")
             return None
 
         # Search in the subtitles database
         logging.debug("Search subtitle in the database")
         try:
-            rpc = self.rpc_server.SearchSubtitles(self.rpc_login["token"],
-                                                  searchlist)
+            rpc = self.__rpc__("SearchSubtitles", PRIORITY_SEARCH,
+                               self.rpc_login["token"], searchlist)
         except Exception as msg:
             logging.error("%s" % msg)
             return None
@@ -193,6 +1596,171 @@ class subDatabase(object):
 
         return rpc
 
+    def searchKey(self, moviehash, moviebytesize):
+        """
+        Return the key used to match a search result with its criteria
+        """
+        return (str(moviehash).lower(), str(int(moviebytesize)))
+
+    def searchMany(self, searchlist, batchsize=SEARCH_BATCH_SIZE):
+        """
+        Search a list of hash/size criteria with one request per batch
+
+        Return a dict: searchKey => list of results (None on request error)
+        """
+        ret, searchlist = self.planSearch(searchlist)
+        for i in range(0, len(searchlist), batchsize):
+            ret.update(self.__searchHashes__(searchlist[i:i + batchsize]))
+        return ret
+
+    def __searchHashes__(self, searchlist):
+        logging.debug("Search %s criteria in one request" % len(searchlist))
+        rpc = self.search(searchlist)
+        ret = self.parseSearch(searchlist, rpc)
+        for batch in self.splitTruncated(
+                searchlist, rpc,
+                [c for c in searchlist
+                 if ret[self.searchKey(c["moviehash"],
+                                       c["moviebytesize"])] == []]):
+            ret.update(self.__searchHashes__(batch))
+        return ret
+
+    def splitTruncated(self, searchlist, rpc, missing):
+        """
+        The server returns at most SEARCH_RESULTS_LIMIT results: the
+        items without result (missing) of a full reply may have some
+        Return the batches of missing items to search again (two smaller
+        batches, none if the reply is complete)
+        """
+        if (rpc is None or not missing or len(searchlist) < 2 or
+                len(rpc["data"] or []) < SEARCH_RESULTS_LIMIT):
+            return []
+        logging.debug("Search reply truncated to %s results, search %s "
+                      "criteria again" % (len(rpc["data"]), len(missing)))
+        half = (len(missing) + 1) // 2
+        return [batch for batch in (missing[:half], missing[half:]) if batch]
+
+    def planSearch(self, searchlist):
+        """
+        Group the criteria of the same hash/size (copies of a video file)
+        and skip the ones already searched during this run
+
+        Return (found, searchlist): a dict searchKey => list of results
+        already known and the list of criteria to search
+        """
+        found = {}
+        criterias = collections.OrderedDict()
+        with self.lock:
+            for criteria in searchlist:
+                key = self.searchKey(criteria["moviehash"],
+                                     criteria["moviebytesize"])
+                langs = criteria["sublanguageid"].split(",")
+                if key in criterias:
+                    merged = criterias[key]["sublanguageid"].split(",")
+                    langs = merged + [lang for lang in langs
+                                      if lang not in merged]
+                elif (key in self.searched and
+                        set(langs) <= self.searched[key][0]):
+                    found[key] = self.searched[key][1]
+                    continue
+                criterias[key] = dict(criteria, sublanguageid=",".join(langs))
+        for key in criterias:
+            found.pop(key, None)
+        if len(searchlist) > len(criterias):
+            logging.debug("%s criteria already searched or duplicated"
+                          % (len(searchlist) - len(criterias)))
+        return found, list(criterias.values())
+
+    def parseSearch(self, searchlist, rpc):
+        """
+        Dispatch the results of a SearchSubtitles request to its criteria
+
+        Return a dict: searchKey => list of results (None on request error)
+        """
+        ret = {}
+        for criteria in searchlist:
+            key = self.searchKey(criteria["moviehash"],
+                                 criteria["moviebytesize"])
+            ret[key] = None if rpc is None else []
+        if rpc is None:
+            return ret
+        # Dispatch the results to their criteria
+        for data in rpc["data"] or []:
+            key = self.searchKey(data["MovieHash"], data["MovieByteSize"])
+            if ret.get(key) is not None:
+                ret[key].append(data)
+        # Remember the results for the copies (see planSearch)
+        with self.lock:
+            for criteria in searchlist:
+                key = self.searchKey(criteria["moviehash"],
+                                     criteria["moviebytesize"])
+                self.searched.pop(key, None)
+                self.searched[key] = (
+                    set(criteria["sublanguageid"].split(",")), ret[key])
+            while len(self.searched) > DEDUP_SIZE:
+                self.searched.popitem(last=False)
+        return ret
+
+    def searchQueries(self, searchlists, batchsize=SEARCH_BATCH_SIZE):
+        """
+        Search lists of tag/query criteria (one list per video file)
+        with one request per batch of at most batchsize criteria
+
+        Return the list of results of each video file
+        (None on request error)
+        """
+        ret = []
+        batch = []
+        size = 0
+        for searchlist in searchlists:
+            if batch and size + len(searchlist) > batchsize:
+                ret.extend(self.__searchQueries__(batch))
+                batch = []
+                size = 0
+            batch.append(searchlist)
+            size += len(searchlist)
+        if batch:
+            ret.extend(self.__searchQueries__(batch))
+        return ret
+
+    def __searchQueries__(self, searchlists):
+        searchlist = [criteria for s in searchlists for criteria in s]
+        logging.debug("Search %s tag/query criteria in one request"
+                      % len(searchlist))
+        rpc = self.search(searchlist)
+        ret = self.parseQueries(searchlists, rpc)
+        for batch in self.splitTruncated(
+                searchlists, rpc,
+                [i for i, results in enumerate(ret) if results == []]):
+            for i, results in zip(batch, self.__searchQueries__(
+                    [searchlists[i] for i in batch])):
+                ret[i] = results
+        return ret
+
+    def parseQueries(self, searchlists, rpc):
+        """
+        Dispatch the results of a SearchSubtitles request of tag/query
+        criteria to their video file (QueryNumber of the results)
+
+        Return the list of results of each video file
+        (None on request error)
+        """
+        if rpc is None:
+            return [None for searchlist in searchlists]
+        owners = [i for i, searchlist in enumerate(searchlists)
+                  for criteria in searchlist]
+        ret = [[] for searchlist in searchlists]
+        for data in rpc["data"] or []:
+            try:
+                ret[owners[int(data["QueryNumber"])]].append(data)
+            except (KeyError, ValueError, IndexError):
+                logging.debug("Result without QueryNumber: %s"
+                              % data.get("SubFileName"))
+        # The results of the first criteria (tag) first
+        for results in ret:
+            results.sort(key=lambda data: int(data["QueryNumber"]))
+        return ret
+
     def download(self, winner):
 
         winner_url = winner["SubDownloadLink"]
@@ -200,9 +1768,12 @@ class subDatabase(object):
 
         logging.debug("Download the compressed subtitle file (id %s): %s"
                       % (winner_id, winner_url))
+        if (self.open() is None):
+            logging.error("Should be loggedin before downloading")
+            return GET_DWNL_ERROR
         try:
-            rpc = self.rpc_server.DownloadSubtitles(self.rpc_login["token"],
-                                                    [winner_id])
+            rpc = self.__rpc__("DownloadSubtitles", PRIORITY_DOWNLOAD,
+                               self.rpc_login["token"], [winner_id])
         except Exception as msg:
             logging.error("%s" % msg)
             return GET_DWNL_ERROR
@@ -218,11 +1789,123 @@ class subDatabase(object):
 
         return rpc
 
+    def downloadMany(self, winners, batchsize=DOWNLOAD_BATCH_SIZE):
+        """
+        Download a list of subtitles with one request per batch
+
+        Return a dict: IDSubtitleFile => base64/gzip data
+        Subtitles not downloaded are not in the dict
+        """
+        ids = []
+        for winner in winners:
+            if (str(winner["IDSubtitleFile"]) not in ids and
+                    self.getWritten(winner["IDSubtitleFile"]) is None):
+                ids.append(str(winner["IDSubtitleFile"]))
+
+        ret = self.localPayloads(ids)
+        ids = [i for i in ids if i not in ret]
+        if ids and self.open() is None:
+            logging.error("Should be loggedin before downloading")
+            return ret
+        for i in range(0, len(ids), batchsize):
+            batch = ids[i:i + batchsize]
+            if self.budget is not None and not self.budget.allows():
+                # A batch of files can need several download requests
+                logging.info("Budget reached: %s subtitle files not "
+                             "downloaded" % (len(ids) - i))
+                break
+            logging.debug("Download %s compressed subtitle files in one "
+                          "request" % len(batch))
+            try:
+                rpc = self.__rpc__("DownloadSubtitles", PRIORITY_DOWNLOAD,
+                                   self.rpc_login["token"], batch)
+            except Exception as msg:
+                logging.error("%s" % msg)
+                continue
+            ret.update(self.parseDownload(rpc))
+        return ret
+
+    def localPayloads(self, ids):
+        """
+        Return the payloads available without request
+        as a dict: IDSubtitleFile => base64/gzip data
+        (none here, see indexDatabase)
+        """
+        return {}
+
+    def parseDownload(self, rpc):
+        """
+        Return the payloads of a DownloadSubtitles request
+        as a dict: IDSubtitleFile => base64/gzip data
+        """
+        if not rpc["status"].startswith("20") or not rpc["data"]:
+            # Download error
+            logging.error("Download error (error: %s)"
+                          % rpc["status"])
+            return {}
+
+        logging.debug("Download processed in %s seconds"
+                      % (rpc["seconds"]))
+
+        ret = {}
+        for data in rpc["data"]:
+            ret[str(data["idsubtitlefile"])] = data["data"]
+        return ret
+
+    def getWritten(self, idsubtitlefile):
+        """
+        Return the subtitle file already written for IDSubtitleFile
+        during this run (None if unknown or removed)
+        """
+        with self.lock:
+            subtitlefilename = self.written.get(str(idsubtitlefile))
+        if subtitlefilename is None or not os.path.exists(subtitlefilename):
+            return None
+        return subtitlefilename
+
+    def setWritten(self, idsubtitlefile, subtitlefilename):
+        """
+        Remember the subtitle file written for IDSubtitleFile
+        """
+        with self.lock:
+            self.written[str(idsubtitlefile)] = subtitlefilename
+            while len(self.written) > DEDUP_SIZE:
+                self.written.popitem(last=False)
+
+    def fetchMany(self, videofilenames, langs=None, overwrite=False,
+                  batchsize=SEARCH_BATCH_SIZE, newest=None):
+        """
+        Generator: get the subtitles of an iterable (can be lazy) of video
+        files (file names or scanVideos items) by batch
+        langs: languages of this call (see setLang), the languages of
+               the database are restored at the end
+        newest: process only the newest video files (see getSubTitles)
+        Yield a subResult as soon as a video file is done
+        The memory used does not depend on the number of video files
+        """
+        previous = self.lang
+        if langs is not None:
+            if isinstance(langs, (list, tuple)):
+                langs = ",".join(langs)
+            self.setLang(langs)
+        try:
+            for subtitle in getSubTitles(self, videofilenames,
+                                         overwrite=overwrite,
+                                         batchsize=batchsize, newest=newest):
+                yield subtitle.getResult()
+        finally:
+            self.setLang(previous)
+
     def logout(self):
+        # Check if you are loggedin
+        if (self.rpc_login is None):
+            return None
+
         # Logout from Opensubtitles XML/RPC API
         try:
             logging.debug("Logout from XML-RPC server %s" % self.rpc_server)
-            rpc = self.rpc_server.LogOut(self.rpc_login["token"])
+            rpc = self.__rpc__("LogOut", PRIORITY_DOWNLOAD,
+                               self.rpc_login["token"])
         except Exception as msg:
             logging.error("%s" % msg)
             return None
@@ -234,8 +1917,14 @@ class subDatabase(object):
             return None
 
         # Logout OK
+        self.rpc_login = None
         logging.debug("Logout successfull with status %s"
                       % rpc["status"])
+        if self.transport is not None:
+            logging.debug("%s requests served with %s connections"
+                          % (self.transport.requests,
+                             self.transport.opened))
+            self.transport.closeAll()
 
 
 class subTitle(object):
@@ -243,30 +1932,62 @@ class subTitle(object):
     Main class to manage subtitle
     """
 
-    def __init__(self, subdatabase, videofilename, overwrite=False):
+    def __init__(self, subdatabase, videofilename, overwrite=False,
+                 search=True, hashing=True, videofilestat=None,
+                 siblings=None):
+        self.started = clock()
+        # Seconds spent by the video file in each stage (see __timing__)
+        self.timings = {}
+        self.lasttiming = self.started
         self.videofilename = videofilename
-        if (not videofilename.endswith(VIDEO_EXT)):
+        if (not isVideoFile(videofilename)):
             # Only manage video file
             logging.debug("%s is not a video file", videofilename)
             self.subtitle = NOT_VIDEO_FILE
             return None
-        self.videofilesize = os.path.getsize(videofilename)
-        self.subtitlefilename = self.__fileBase__(videofilename)
-        # Test if subtitle already exist...
-        if os.path.exists(self.subtitlefilename) and not overwrite:
+        # The stat and the folder file names (siblings) can be given
+        # by the scanner (see scanVideos)
+        if videofilestat is None:
+            videofilestat = os.stat(videofilename)
+        self.videofilestat = videofilestat
+        self.videofilesize = self.videofilestat.st_size
+        self.subdatabase = subdatabase
+        self.subtitlefilenames = self.__subtitleFileNames__(videofilename)
+        self.subtitlefilename = self.subtitlefilenames[subdatabase.langs[0]]
+        # Languages to download and their outcome (or winner)
+        self.langs = []
+        self.subtitles = {}
+        self.winners = {}
+        # Languages to search by file name/title and how they match
+        self.fallbacklangs = []
+        self.matches = {}
+        for lang in subdatabase.langs:
+            subtitlefilename = self.subtitlefilenames[lang]
+            if siblings is None:
+                exist = os.path.exists(subtitlefilename)
+            else:
+                exist = os.path.basename(subtitlefilename) in siblings
+            if exist and not overwrite:
+                logging.debug("Subtitle already exist: %s", subtitlefilename)
+            else:
+                self.langs.append(lang)
+        # Test if subtitles already exist...
+        if not self.langs:
             logging.info("Subtitle already exist: %s", self.subtitlefilename)
             self.subtitle = SUB_ALREADY_EXIST
         else:
-            # No file detected, can start working
-            self.hash = self.__hashFile__()
-            if self.hash != HASH_SIZE_ERROR:
-                self.subdatabase = subdatabase
-                self.searchlist = [({'sublanguageid': self.subdatabase.lang,
-                                    'moviehash': self.hash,
-                                    'moviebytesize': str(self.videofilesize)})]
-                self.subtitle = self.__getSubTitle__()
+            # Missing file(s) detected, can start working
+            self.subtitle = SUB_PENDING
+            if self.__hashFromCache__():
+                # Hash found in the cache: no need to read the file
+                pass
+            elif not hashing:
+                # Hash will be computed later (see setHash)
+                return None
             else:
-                self.subtitle = HASH_SIZE_ERROR
+                self.setHash(self.__hashFile__())
+            if search and self.subtitle == SUB_PENDING:
+                self.subtitle = self.__getSubTitle__()
 
     def getVideoFileName(self):
         '''
@@ -274,6 +1995,44 @@ class subTitle(object):
         '''
         return self.videofilename
 
+    def getOutcome(self):
+        '''
+        Return the outcome of the video file: SUB_DOWNLOADED or
+        an error/status constant
+        '''
+        if (type(self.subtitle) == type(dict())):
+            return SUB_DOWNLOADED
+        return self.subtitle
+
+    def getResult(self):
+        '''
+        Return the result of the video file (subResult)
+        '''
+        winner = self.subtitle if type(self.subtitle) == type(dict()) \
+            else None
+        if winner is None:
+            return subResult(
+                self.videofilename, getattr(self, "hash", None),
+                self.getOutcome(), None, self.getSubtitleFileName() or None,
+                None, clock() - self.started,
+                getattr(self, "videofilesize", None),
+                getattr(self, "subdatabase", None) and self.subdatabase.lang,
+                None, self.timings)
+        return subResult(
+            self.videofilename, self.hash, self.getOutcome(),
+            str(winner["IDSubtitleFile"]), self.getSubtitleFileName(),
+            self.matches.get(winner.get("SubLanguageID"), MATCH_HASH),
+            clock() - self.started, self.videofilesize,
+            winner.get("SubLanguageID") or self.subdatabase.langs[0],
+            int(winner.get("SubDownloadsCnt") or 0), self.timings)
+
+    def __timing__(self, stage):
+        # Time spent by the video file in stage (since the previous one)
+        now = clock()
+        self.timings[stage] = self.timings.get(stage, 0.0) + \
+            now - self.lasttiming
+        self.lasttiming = now
+
     def getHashFile(self):
         '''
         Return the hash of the video file
@@ -285,84 +2044,248 @@ class subTitle(object):
         else:
             return self.hash
 
+    def setHash(self, hash, cached=False):
+        '''
+        Set the hash of the video file and prepare the search
+        '''
+        self.__timing__("hash")
+        self.hash = hash
+        if self.hash == HASH_SIZE_ERROR:
+            self.subtitle = HASH_SIZE_ERROR
+        else:
+            if not cached and self.subdatabase.cache is not None:
+                self.subdatabase.cache.setHash(self.videofilestat,
+                                               self.videofilename, self.hash)
+            for lang in self.langs:
+                if (self.subdatabase.cache is not None and
+                        self.subdatabase.cache.isMiss(self.hash,
+                                                      self.videofilesize,
+                                                      lang)):
+                    # No subtitle found by a previous search
+                    logging.info("No subtitle found for %s (%s, cached)"
+                                 % (self.videofilename, lang))
+                    self.subtitles[lang] = GET_SUB_UNKNOWN
+            # All the missing languages are searched in one criteria
+            langs = [lang for lang in self.langs
+                     if lang not in self.subtitles]
+            self.searchlist = [({'sublanguageid': ",".join(langs),
+                                'moviehash': self.hash,
+                                'moviebytesize': str(self.videofilesize)})]
+            self.subtitle = self.__outcome__()
+        return self.subtitle
+
     def getSubtitleFileName(self):
         '''
         Return the subtile path (output)
+        With more than one language, return the first one available
         '''
-        if (type(self.subtitle) == type(dict())):
-            return self.subtitlefilename
-        elif (self.subtitle == SUB_ALREADY_EXIST):
-            return self.subtitlefilename
+        subtitlefilenames = self.getSubtitleFileNames()
+        if subtitlefilenames:
+            return subtitlefilenames[0]
         else:
             return ""
 
+    def getSubtitleFileNames(self):
+        '''
+        Return the subtile paths (output) of the languages available
+        '''
+        if (self.subtitle == NOT_VIDEO_FILE):
+            return []
+        return [self.subtitlefilenames[lang]
+                for lang in self.subdatabase.langs
+                if (lang not in self.langs or
+                    type(self.subtitles.get(lang)) == type(dict()))]
+
+    def __hashFromCache__(self):
+        """
+        Set the hash from the cache
+        Return True if the hash was in the cache
+        """
+        if self.subdatabase.cache is None:
+            return False
+        hash = self.subdatabase.cache.getHash(self.videofilestat,
+                                              self.videofilename)
+        if hash is None:
+            return False
+        logging.debug("Hash tag for file %s found in cache"
+                      % self.videofilename)
+        stats.count("hash_cached")
+        self.setHash(hash, cached=True)
+        return True
+
     def __hashFile__(self):
         """
         Return the Opensubtitles hash code
         """
+        return hashFile(self.videofilename)
 
-        logging.debug("Compute hash tag for file %s" % self.videofilename)
-
-        longlongformat = 'q'
-        bytesize = struct.calcsize(longlongformat)
+    def __getSubTitle__(self):
+        """
+        Get the subtitle from the Opensubtitles database
+        """
 
-        f = open(self.videofilename, "rb")
+        # Search in the subtitles database
+        rpcdata = self.subdatabase.searchMany(self.searchlist).get(
+            self.getSearchKey())
+        if rpcdata is None:
+            return GET_SUB_ERROR
+
+        self.setSearchResult(rpcdata)
+        if self.fallbacklangs:
+            # Not found by hash: search by file name/title
+            self.setFallbackResult(self.subdatabase.searchQueries(
+                [self.getFallbackSearch()])[0])
+        return self.subtitle
+
+    def getSearchKey(self):
+        '''
+        Return the key matching the search results of the video file
+        '''
+        return self.subdatabase.searchKey(self.hash, self.videofilesize)
 
-        filesize = os.path.getsize(self.videofilename)
-        hash = filesize
+    def setSearchResult(self, rpcdata, download=True):
+        """
+        Choose and download the best subtitle of each language from
+        the search results
+        If download is False, the winners are stored in self.winners and
+        the download should be done later (see setDownloadResult)
+        """
 
-        if filesize < 65536 * 2:
-            logging.error("Bad file size for %s (%s bytes), can't compute hash"
-                          % (self.videofilename, filesize))
-            return HASH_SIZE_ERROR
+        self.__timing__("search")
+        if rpcdata is None:
+            # Search request error
+            self.subtitle = GET_SUB_ERROR
+            return self.subtitle
+
+        # Languages of a partial request error (see searchResults)
+        failed = getattr(rpcdata, "failed", ())
+        for lang in self.langs:
+            if lang in self.subtitles:
+                # Already known (cached miss)
+                continue
+            if lang in failed:
+                self.subtitles[lang] = GET_SUB_ERROR
+                continue
+            self.__setLangResult__(lang, rpcdata, download)
 
-        for x in range(int(65536 / bytesize)):
-            buffer = f.read(bytesize)
-            (l_value,) = struct.unpack(longlongformat, buffer)
-            hash += l_value
-        hash = hash & 0xFFFFFFFFFFFFFFFF
+        # Return the subtitle candidate
+        self.subtitle = self.__outcome__()
+        return self.subtitle
 
-        f.seek(max(0, filesize - 65536), 0)
-        for x in range(int(65536 / bytesize)):
-            buffer = f.read(bytesize)
-            (l_value,) = struct.unpack(longlongformat, buffer)
-            hash += l_value
-            hash = hash & 0xFFFFFFFFFFFFFFFF
+    def getFallbackSearch(self):
+        '''
+        Return the tag/query criteria of the languages not found by hash
+        (see setFallbackResult)
+        '''
+        langs = ",".join(self.fallbacklangs)
+        searchlist = [{'sublanguageid': langs,
+                       'tag': os.path.basename(self.videofilename)}]
+        title, season, episode = parseVideoName(self.videofilename)
+        if title:
+            criteria = {'sublanguageid': langs, 'query': title}
+            if season is not None:
+                criteria['season'] = str(season)
+                criteria['episode'] = str(episode)
+            searchlist.append(criteria)
+        return searchlist
+
+    def setFallbackResult(self, rpcdata, download=True):
+        """
+        Choose and download the best subtitle of each language not found
+        by hash from the tag/query search results (lower confidence
+        matches, see getMatches)
+        """
 
-        f.close()
-        returnedhash = "%016x" % hash
+        self.__timing__("fallback")
+        langs, self.fallbacklangs = self.fallbacklangs, []
+        for lang in langs:
+            if rpcdata is None:
+                # Search request error
+                self.subtitles[lang] = GET_SUB_ERROR
+            else:
+                self.__setLangResult__(lang, rpcdata, download, fallback=True)
 
-        logging.debug("Hash tag for file %s is %s" % (self.videofilename,
-                                                      hex(hash)))
+        self.subtitle = self.__outcome__()
+        return self.subtitle
 
-        return returnedhash
+    def getMatches(self):
+        '''
+        Return how the subtitle of each language matches the video file:
+        MATCH_HASH or MATCH_FALLBACK (lower confidence)
+        '''
+        return self.matches
 
-    def __getSubTitle__(self):
+    def __setLangResult__(self, lang, rpcdata, download, fallback=False):
         """
-        Get the subtitle from the Opensubtitles database
+        Choose and download the best subtitle of a language
         """
 
-        # Search in the subtitles database
-        rpc_search = self.subdatabase.search(self.searchlist)
+        # Split the results by language
+        if len(self.subdatabase.langs) == 1:
+            rpclang = rpcdata
+        else:
+            rpclang = [rpc for rpc in rpcdata
+                       if rpc.get("SubLanguageID") == lang]
 
         # Analyse and download the best subtitle
-        ret_subtitle = self.__chooseSubTitle__(rpc_search["data"])
-        if ret_subtitle != GET_SUB_UNKNOWN:
-            # Download the subtitle
-            ret_subtitle = self.__downloadSubtitle__(ret_subtitle)
+        ret_subtitle = self.__chooseSubTitle__(rpclang)
+        if ret_subtitle == GET_SUB_UNKNOWN:
+            if self.subdatabase.fallback and not fallback:
+                # Search it by file name/title (see setFallbackResult)
+                logging.debug("No subtitle found by hash for %s (%s)"
+                              % (self.videofilename, lang))
+                self.fallbacklangs.append(lang)
+                return
+            logging.info("No subtitle found for %s (%s)"
+                         % (self.videofilename, lang))
+            if self.subdatabase.cache is not None:
+                # Do not search it again before the TTL
+                self.subdatabase.cache.setMiss(self.hash,
+                                               self.videofilesize, lang)
+        else:
+            if fallback:
+                logging.info("Subtitle found by file name/title for %s (%s):"
+                             " lower confidence match"
+                             % (self.videofilename, lang))
+                stats.count("fallback_matches")
+                self.matches[lang] = MATCH_FALLBACK
+            else:
+                self.matches[lang] = MATCH_HASH
+            if download:
+                # Download the subtitle
+                ret_subtitle = self.__downloadSubtitle__(ret_subtitle, lang)
+            else:
+                # Download will be done later (see getSubTitles)
+                self.winners[lang] = ret_subtitle
+                ret_subtitle = SUB_PENDING
+        self.subtitles[lang] = ret_subtitle
 
-        # Return the subtitle candidate
-        return ret_subtitle
+    def getWinners(self):
+        '''
+        Return the subtitles to download (see setDownloadResult)
+        '''
+        return list(self.winners.values())
+
+    def __outcome__(self):
+        """
+        Return the outcome of all the languages: SUB_PENDING or the
+        first error, else the first subtitle downloaded
+        """
+        outcomes = [self.subtitles.get(lang, SUB_PENDING)
+                    for lang in self.langs]
+        for outcome in (SUB_PENDING, HASH_SIZE_ERROR, GET_SUB_ERROR,
+                        GET_DWNL_ERROR, GET_SUB_UNKNOWN):
+            if outcome in outcomes:
+                return outcome
+        return outcomes[0]
 
     def __chooseSubTitle__(self, rpcdata):
         """
         Internal algo to choose "best" subtitle
         """
 
-        # No subtitle found with the first method
+        # No subtitle found
         if not rpcdata:
-            logging.info("No subtitle found for %s" % (self.videofilename))
-            # TODO: If not find, try the 2e method: http://alturl.com/kef8a
             return GET_SUB_UNKNOWN
 
         # One subtitle match: Easy !
@@ -389,53 +2312,296 @@ class subTitle(object):
         # Return the winner
         return rpcdata[0]
 
-    def __downloadSubtitle__(self, rpcwinner):
+    def __downloadSubtitle__(self, rpcwinner, lang):
         """
         Download the subtitle
         """
 
         # Download the subtitle file (compressed in gz)
-        rpc_dwnl = self.subdatabase.download(rpcwinner)
-        try:
-            rpc_dwnl["data"][0]["data"]
-        except:
+        data = self.subdatabase.downloadMany([rpcwinner]).get(
+            str(rpcwinner["IDSubtitleFile"]))
+        if (data is None and
+                self.subdatabase.getWritten(rpcwinner["IDSubtitleFile"])
+                is None):
             logging.error("Download error")
             return GET_DWNL_ERROR
 
-        # Unzip the downloaded file
-        logging.debug("Unzip the compressed subtitle file")
-        subt_str = self.__gunzip__(rpc_dwnl["data"][0]["data"])
+        return self.__writeSubtitle__(rpcwinner, data, lang)
+
+    def setDownloadResult(self, payloads):
+        """
+        Write the subtitles downloaded for self.winners
+        payloads is a dict IDSubtitleFile: base64/gzip payload
+        (a missing payload is a download error, unless the subtitle was
+        already written for a copy of the video file)
+        """
+        self.__timing__("download")
+
+        for lang, winner in self.winners.items():
+            data = payloads.get(str(winner["IDSubtitleFile"]))
+            if (data is None and
+                    self.subdatabase.getWritten(winner["IDSubtitleFile"])
+                    is None):
+                logging.error("Download error")
+                self.subtitles[lang] = GET_DWNL_ERROR
+            else:
+                self.subtitles[lang] = self.__writeSubtitle__(winner, data,
+                                                              lang)
+        self.winners = {}
+        self.subtitle = self.__outcome__()
+        return self.subtitle
+
+    def __writeSubtitle__(self, rpcwinner, data, lang):
+        """
+        Decode and write the subtitle
+        """
+        subtitlefilename = self.subtitlefilenames[lang]
 
         # Put the result in the .str file
-        logging.debug("Write the subtitle to %s"
-                      % self.subtitlefilename)
+        source = self.subdatabase.getWritten(rpcwinner["IDSubtitleFile"])
         try:
-            open(self.subtitlefilename, 'wb').write(subt_str)
+            with stats.timer("write"):
+                if source is not None:
+                    # Already written for a copy of the video file
+                    logging.debug("Link the subtitle %s to %s"
+                                  % (source, subtitlefilename))
+                    linkSubtitle(source, subtitlefilename)
+                    stats.count("subtitles_linked")
+                else:
+                    logging.debug("Write the subtitle to %s"
+                                  % subtitlefilename)
+                    stats.count("bytes_written", writeSubtitle(
+                        subtitlefilename, data,
+                        encoding=rpcwinner.get("SubEncoding"),
+                        charset=self.subdatabase.charset))
         except Exception as msg:
             logging.error("Can not write to %s (error: %s)"
-                          % (self.subtitlefilename, msg))
+                          % (subtitlefilename, msg))
             return GET_DWNL_ERROR
+        self.subdatabase.setWritten(rpcwinner["IDSubtitleFile"],
+                                    subtitlefilename)
 
         # Done
-        logging.info("Download completed: %s"
-                     % self.subtitlefilename)
+        logging.info("Download completed: %s" % subtitlefilename)
 
         return rpcwinner
 
-    def __gunzip__(self, data):
-        data = base64.decodestring(data.encode('ascii'))
-        if sys.version_info > (3, 0):
-            # Python 3
-            ret = gzip.GzipFile(fileobj=io.BytesIO(data)).read()
-        else:
-            # Python 2
-            ret = gzip.GzipFile(fileobj=StringIO.StringIO(data)).read()
-        return ret
+    def __subtitleFileNames__(self, videofilename):
+        """
+        Return the subtitle path of each language:
+        <name>.srt for one language, <name>.<lang>.srt for more
+        """
+        langs = self.subdatabase.langs
+        if len(langs) == 1:
+            return {langs[0]: self.__fileBase__(videofilename)}
+        return dict((lang, self.__fileBase__(videofilename, lang + ".srt"))
+                    for lang in langs)
 
     def __fileBase__(self, filename, newext="srt"):
         return filename[:filename.rfind('.')] + "." + newext
 
 
+class subResult(object):
+    """
+    Result of a video file (see subDatabase.fetchMany)
+    path: video file name
+    hash: Opensubtitles hash (None if not computed)
+    outcome: SUB_DOWNLOADED or an error/status constant
+    subtitleid: IDSubtitleFile of the subtitle downloaded (or None)
+    subtitlefilename: subtitle file (None if not available)
+    match: MATCH_HASH, MATCH_FALLBACK or None
+    seconds: time spent from the scan of the file to its outcome
+    size: video file size (None if not known)
+    language: language of the subtitle downloaded (or the languages
+              searched)
+    downloads: download count of the subtitle downloaded (or None)
+    timings: dict stage => seconds spent by the file in the stage
+             (hash, search, fallback, download)
+    """
+    __slots__ = ("path", "hash", "outcome", "subtitleid", "subtitlefilename",
+                 "match", "seconds", "size", "language", "downloads",
+                 "timings")
+
+    def __init__(self, path, hash, outcome, subtitleid=None,
+                 subtitlefilename=None, match=None, seconds=0.0, size=None,
+                 language=None, downloads=None, timings=None):
+        self.path = path
+        self.hash = hash
+        self.outcome = outcome
+        self.subtitleid = subtitleid
+        self.subtitlefilename = subtitlefilename
+        self.match = match
+        self.seconds = seconds
+        self.size = size
+        self.language = language
+        self.downloads = downloads
+        self.timings = timings or {}
+
+    def __repr__(self):
+        return "subResult(%r, %r, %r)" % (self.path, self.hash, self.outcome)
+
+    def getVideoFileName(self):
+        return self.path
+
+    def getOutcome(self):
+        return self.outcome
+
+    def getResult(self):
+        return self
+
+
+def getSubTitles(subdatabase, videofilenames, overwrite=False,
+                 batchsize=SEARCH_BATCH_SIZE,
+                 downloadbatchsize=DOWNLOAD_BATCH_SIZE,
+                 jobs=HASH_JOBS, newest=None):
+    """
+    Generator: get the subtitles for a list of video files
+    (file names or scanVideos items)
+    The files are hashed by a pool of jobs threads, the search requests
+    are grouped by batch of batchsize files and the downloads by batch
+    of downloadbatchsize subtitles
+    The files not found by hash are searched again by file name/title
+    (batch of batchsize criteria)
+    If newest is set, only the newest (modification time) video files
+    without subtitle are processed, newest first
+    The run stops when the budget of subdatabase is reached
+    Yield the subTitle objects
+    """
+
+    def hashed(subtitles):
+        # Hash the files in parallel and yield them as soon as possible
+        # The hardlinks of a file (same device and inode) are hashed once
+        # (the files without inode are hashed one by one)
+        byinode = collections.OrderedDict()
+        for subtitle in subtitles:
+            key = (fileId(subtitle.videofilestat) or
+                   subtitle.videofilename)
+            byinode.setdefault(key, []).append(subtitle)
+        tohash = dict((s[0].videofilename, (s[0].videofilesize, key))
+                      for key, s in byinode.items())
+        for videofilename, filesize, hash in hashFiles(
+                [(n, tohash[n][0]) for n in tohash], jobs=jobs):
+            for subtitle in byinode.pop(tohash[videofilename][1]):
+                subtitle.setHash(hash)
+                yield subtitle
+
+    def created():
+        # Check the existing subtitles (and the hash cache)
+        for item in videofilenames:
+            videofilename, filestat, siblings = videoItem(item)
+            yield subTitle(subdatabase, videofilename, overwrite=overwrite,
+                           search=False, hashing=False,
+                           videofilestat=filestat, siblings=siblings)
+
+    def scheduled(subtitles):
+        # Keep the newest video files without subtitle (bounded heap)
+        heap = []
+        older = 0
+        for i, subtitle in enumerate(subtitles):
+            if subtitle.subtitle != SUB_PENDING:
+                yield subtitle
+                continue
+            entry = (subtitle.videofilestat.st_mtime, i, subtitle)
+            if len(heap) < newest:
+                heapq.heappush(heap, entry)
+            else:
+                heapq.heappushpop(heap, entry)
+                older += 1
+        if older:
+            logging.info("%s older video files left for the next run"
+                         % older)
+        for entry in sorted(heap, reverse=True):
+            yield entry[2]
+
+    def candidates():
+        # Filter the video files without subtitle and hash them
+        tohash = []
+        subtitles = created()
+        if newest is not None:
+            subtitles = scheduled(subtitles)
+        for subtitle in subtitles:
+            if (subtitle.subtitle != SUB_PENDING or
+                    hasattr(subtitle, "hash")):
+                # Done or hash found in the cache
+                yield subtitle
+                continue
+            tohash.append(subtitle)
+            if len(tohash) >= HASH_QUEUE_SIZE:
+                for subtitle in hashed(tohash):
+                    yield subtitle
+                tohash = []
+        for subtitle in hashed(tohash):
+            yield subtitle
+
+    def download(pending):
+        # Download the winners and write them
+        winners = [s for s in pending if s.subtitle == SUB_PENDING]
+        payloads = subdatabase.downloadMany([w for s in winners
+                                             for w in s.getWinners()],
+                                            batchsize=downloadbatchsize)
+        for subtitle in winners:
+            subtitle.setDownloadResult(payloads)
+        return pending
+
+    def flush(pending):
+        # Search the pending subtitles and dispatch the results
+        results = subdatabase.searchMany([s.searchlist[0] for s in pending],
+                                         batchsize=batchsize)
+        for subtitle in pending:
+            subtitle.setSearchResult(results.get(subtitle.getSearchKey()),
+                                     download=False)
+        # The files not found by hash wait for the fallback search
+        misses.extend(s for s in pending if s.fallbacklangs)
+        return download([s for s in pending if not s.fallbacklangs])
+
+    def flushMisses():
+        # Search the files not found by hash with their file name/title
+        pending = misses[:]
+        del misses[:]
+        results = subdatabase.searchQueries([s.getFallbackSearch()
+                                             for s in pending],
+                                            batchsize=batchsize)
+        for subtitle, rpcdata in zip(pending, results):
+            subtitle.setFallbackResult(rpcdata, download=False)
+        return download(pending)
+
+    def allowed():
+        if subdatabase.batchAllowed():
+            return True
+        logging.info("Budget reached: the remaining video files are left "
+                     "for the next run")
+        return False
+
+    pending = []
+    misses = []
+    for subtitle in candidates():
+        if subtitle.subtitle != SUB_PENDING:
+            yield subtitle
+            continue
+        pending.append(subtitle)
+        if len(pending) >= batchsize:
+            if not allowed():
+                return
+            for subtitle in flush(pending):
+                yield subtitle
+            pending = []
+        if len(misses) >= batchsize:
+            if not allowed():
+                return
+            for subtitle in flushMisses():
+                yield subtitle
+    if pending:
+        if not allowed():
+            return
+        for subtitle in flush(pending):
+            yield subtitle
+    if misses:
+        if not allowed():
+            return
+        for subtitle in flushMisses():
+            yield subtitle
+
+
 def printSyntax():
     """
     Display the syntax of the command line
@@ -450,6 +2616,23 @@ def printVersion():
     print(__appname__ + " version " + __version__)
 
 
+def numberArg(opt, arg, cast=int, minimum=0):
+    """
+    Return the numeric value of a command line option
+    Display the syntax and exit if it is not a number >= minimum
+    """
+    try:
+        value = cast(arg)
+    except ValueError:
+        value = None
+    if value is None or not value >= minimum:
+        print("Error: option %s requires a number >= %s (not %s)"
+              % (opt, minimum, arg))
+        printSyntax()
+        sys.exit(2)
+    return value
+
+
 def main():
     """
     Main function: manage CLI
@@ -460,12 +2643,22 @@ def main():
 
     # Manage args
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "vhVwf:l:")
+        opts, args = getopt.getopt(sys.argv[1:], "vhVwnrLf:l:",
+                                   ["prune-cache", "miss-ttl=", "jobs=",
+                                    "rate=", "exclude=", "hidden",
+                                    "resume", "watch", "charset=",
+                                    "no-fallback", "stats", "stats-file=",
+                                    "server=", "serve=", "proxy-size=",
+                                    "index=", "build-index=", "enqueue=",
+                                    "worker=", "report=", "summarize=",
+                                    "newest=", "max-requests=",
+                                    "time-budget="])
     except getopt.GetoptError as err:
         # Print help information and exit:
         print("Error: " + str(err))
         printSyntax()
         sys.exit(2)
+    arg_exclude = []
     for opt, arg in opts:
         if opt in ("-v"):
             printVersion()
@@ -484,6 +2677,60 @@ def main():
             )
         elif opt in ("-w"):
             arg_overwrite = True
+        elif opt in ("-n"):
+            arg_nocache = True
+        elif opt in ("-r"):
+            arg_retrymisses = True
+        elif opt in ("--miss-ttl"):
+            arg_missttl = numberArg(opt, arg, float)
+        elif opt in ("--prune-cache"):
+            arg_prunecache = True
+        elif opt in ("--jobs"):
+            arg_jobs = numberArg(opt, arg, minimum=1)
+        elif opt in ("--rate"):
+            arg_rate = numberArg(opt, arg, float)
+        elif opt in ("--exclude"):
+            arg_exclude.append(arg)
+        elif opt in ("--hidden"):
+            arg_hidden = True
+        elif opt in ("-L"):
+            arg_followlinks = True
+        elif opt in ("--resume"):
+            arg_resume = True
+        elif opt in ("--watch"):
+            arg_watch = True
+        elif opt in ("--charset"):
+            arg_charset = arg
+        elif opt == "--no-fallback":
+            arg_fallback = False
+        elif opt in ("--stats"):
+            arg_stats = True
+        elif opt == "--stats-file":
+            arg_statsfile = arg
+        elif opt == "--server":
+            arg_server = arg
+        elif opt == "--serve":
+            arg_serve = arg
+        elif opt == "--proxy-size":
+            arg_proxysize = numberArg(opt, arg, float)
+        elif opt == "--index":
+            arg_index = arg
+        elif opt == "--build-index":
+            arg_buildindex = arg
+        elif opt == "--enqueue":
+            arg_enqueue = arg
+        elif opt == "--worker":
+            arg_worker = arg
+        elif opt == "--report":
+            arg_report = arg
+        elif opt == "--summarize":
+            arg_summarize = arg
+        elif opt == "--newest":
+            arg_newest = numberArg(opt, arg)
+        elif opt == "--max-requests":
+            arg_maxrequests = numberArg(opt, arg)
+        elif opt == "--time-budget":
+            arg_timebudget = numberArg(opt, arg, float)
         elif opt in ("-f"):
             arg_file = arg
         elif opt in ("-l"):
@@ -520,41 +2767,405 @@ def main():
 
     logging.debug("Subtitle language search set to %s" % arg_lang)
 
+    try:
+        # Test cache
+        arg_nocache
+    except:
+        arg_nocache = False
+
+    try:
+        # Test retry misses
+        arg_retrymisses
+    except:
+        arg_retrymisses = False
+
+    try:
+        # Test miss TTL
+        arg_missttl
+    except:
+        arg_missttl = MISS_TTL
+
+    # Open the local cache
+    cache = None
+    if not arg_nocache:
+        try:
+            cache = subCache(missttl=arg_missttl,
+                             retrymisses=arg_retrymisses)
+        except Exception as msg:
+            logging.warning("Can not open the cache (error: %s)" % msg)
+
+    try:
+        # Prune the cache
+        arg_prunecache
+    except:
+        pass
+    else:
+        if cache is not None:
+            logging.info("%s entries removed from the cache"
+                         % cache.prune())
+        try:
+            arg_file
+        except:
+            sys.exit(0)
+
+    try:
+        # Summarize a report
+        arg_summarize
+    except:
+        pass
+    else:
+        from .reportwitsub import summarizeReport, printSummary
+        try:
+            printSummary(summarizeReport(arg_summarize))
+        except (IOError, OSError) as msg:
+            logging.critical("Can not read the report %s (error: %s)"
+                             % (arg_summarize, msg))
+            sys.exit(2)
+        sys.exit(0)
+
+    try:
+        # Build the local index
+        arg_buildindex
+    except:
+        pass
+    else:
+        try:
+            arg_index
+        except:
+            logging.critical("Need the index file (use the --index <path>)")
+            sys.exit(2)
+        from .indexwitsub import buildIndex
+        try:
+            buildIndex(arg_buildindex, arg_index)
+        except (IOError, OSError, ValueError) as msg:
+            logging.critical("Can not build the index from %s (error: %s)"
+                             % (arg_buildindex, msg))
+            sys.exit(2)
+        sys.exit(0)
+
+    try:
+        # Test rate limit
+        arg_rate
+    except:
+        arg_rate = RATE_LIMIT
+
+    try:
+        # Test XML-RPC server
+        arg_server
+    except:
+        arg_server = XMLRPC_SERVER
+
+    try:
+        # Test newest first scheduling
+        arg_newest
+    except:
+        arg_newest = None
+
+    try:
+        # Test request budget
+        arg_maxrequests
+    except:
+        arg_maxrequests = None
+
+    try:
+        # Test time budget
+        arg_timebudget
+    except:
+        arg_timebudget = None
+    if arg_maxrequests is None and arg_timebudget is None:
+        budget = None
+    else:
+        budget = runBudget(requests=arg_maxrequests, seconds=arg_timebudget)
+
+    # Session token file (kept for the next run if the cache is used)
+    if arg_nocache:
+        sessionfile = None
+    else:
+        sessionfile = os.path.join(getCacheDir(), SESSION_FILENAME)
+
+    try:
+        # Test local index
+        arg_index
+    except:
+        database = subDatabase
+    else:
+        from .indexwitsub import subIndex, indexDatabase
+        try:
+            index = subIndex(arg_index)
+        except (IOError, OSError, ValueError) as msg:
+            logging.critical("Can not open the index %s (error: %s)"
+                             % (arg_index, msg))
+            sys.exit(2)
+        logging.debug("%s records in the index %s" % (len(index), arg_index))
+
+        def database(*args, **kwargs):
+            # Search in the index first
+            return indexDatabase(*args, index=index, **kwargs)
+
+    try:
+        # Test proxy mode
+        arg_serve
+    except:
+        pass
+    else:
+        try:
+            arg_proxysize
+        except:
+            arg_proxysize = PROXY_CACHE_SIZE / (1024.0 * 1024)
+        from .proxywitsub import subProxy, proxyCache, parseAddress
+        try:
+            proxy = subProxy(
+                database(arg_lang, rate=arg_rate, sessionfile=sessionfile,
+                         url=arg_server),
+                address=parseAddress(arg_serve),
+                cache=proxyCache(maxsize=int(arg_proxysize * 1024 * 1024)))
+        except (ValueError, IOError, OSError, sqlite3.Error) as msg:
+            logging.critical("Can not start the proxy on %s (error: %s)"
+                             % (arg_serve, msg))
+            sys.exit(2)
+        try:
+            proxy.serve()
+        except KeyboardInterrupt:
+            logging.info("Stop the proxy")
+        sys.exit(0)
+
+    try:
+        # Test worker mode
+        arg_worker
+    except:
+        arg_worker = None
+
     try:
         # Test input video file or folder
         arg_file
     except:
-        logging.critical("Need an input file or folder (use the -f <path>)")
-        printSyntax()
-        sys.exit(2)
+        if arg_worker is None:
+            logging.critical("Need an input file or folder "
+                             "(use the -f <path>)")
+            printSyntax()
+            sys.exit(2)
+        arg_file = None
+
+    try:
+        # Test coordinator mode
+        arg_enqueue
+    except:
+        arg_enqueue = None
+
+    try:
+        # Test hidden folders
+        arg_hidden
+    except:
+        arg_hidden = False
 
-    # Create the connection with the subtitle database
-    # Only one connection for all the request
-    subdatabase = subDatabase(arg_lang)
-
-    # Get the subtitle for each video file
-    arg_file = os.path.normpath(arg_file)
-    if os.path.isdir(arg_file):
-        # User provides a folder
-        logging.debug("%s is a folder. Scan into." % arg_file)
-
-        # Recursive scan
-        for root, dirs, files in os.walk(arg_file):
-            for input_file in files:
-                input_file = root + os.sep + input_file
-                # Let's go...
-                subTitle(subdatabase, input_file, overwrite=arg_overwrite)
+    try:
+        # Test symbolic links
+        arg_followlinks
+    except:
+        arg_followlinks = False
+
+    try:
+        # Test scan journal
+        arg_resume
+    except:
+        arg_resume = False
+    if arg_resume and cache is None:
+        logging.warning("The scan journal needs the cache")
+    if arg_resume and arg_overwrite:
+        # All the files are processed again: the journal would skip them
+        logging.warning("The scan journal is not used with -w")
+        arg_resume = False
+    journal = cache if arg_resume else None
+
+    try:
+        # Test asyncio engine
+        arg_jobs
+    except:
+        arg_jobs = None
+
+    try:
+        # Test watch mode
+        arg_watch
+    except:
+        arg_watch = False
+
+    try:
+        # Test subtitle charset
+        arg_charset
+    except:
+        arg_charset = None
     else:
-        # User provides a single file
         try:
-            with open(arg_file):
-                pass
-        except IOError:
-            logging.critical("Can not read input file or folder %s" % arg_file)
+            codecs.lookup(arg_charset)
+        except LookupError:
+            logging.critical("Unknown charset %s" % arg_charset)
             sys.exit(2)
 
-        # Let's go...
-        subTitle(subdatabase, arg_file, overwrite=arg_overwrite)
+    try:
+        # Test fallback search
+        arg_fallback
+    except:
+        arg_fallback = True
+
+    try:
+        # Test statistics
+        arg_stats
+    except:
+        arg_stats = False
+
+    try:
+        # Test statistics file
+        arg_statsfile
+    except:
+        arg_statsfile = None
+
+    try:
+        # Test results report
+        arg_report
+    except:
+        report = None
+    else:
+        from .reportwitsub import reportWriter
+        try:
+            report = reportWriter(arg_report)
+        except (IOError, OSError) as msg:
+            logging.critical("Can not write the report %s (error: %s)"
+                             % (arg_report, msg))
+            sys.exit(2)
+
+    def done(subtitle):
+        # Count the outcome (subResult or subTitle), store it in the
+        # scan journal and the report
+        stats.outcome(subtitle.getOutcome())
+        if journal is not None:
+            journal.setOutcome(subtitle)
+        if report is not None:
+            report.write(subtitle.getResult())
+
+    try:
+        # Create the connection with the subtitle database
+        # Only one connection for all the request
+        # The connection is opened on the first search and the session
+        # is kept for the next run (if the cache is used)
+        subdatabase = database(arg_lang, cache=cache, rate=arg_rate,
+                               sessionfile=sessionfile, charset=arg_charset,
+                               fallback=arg_fallback, url=arg_server,
+                               budget=budget)
+
+        # Get the subtitle for each video file
+        if arg_file is not None:
+            arg_file = os.path.normpath(arg_file)
+        if arg_worker is not None:
+            # Distributed mode: process the files of the work queue
+            from .queuewitsub import workQueue, runWorker
+            try:
+                queue = workQueue(arg_worker)
+            except sqlite3.Error as msg:
+                logging.critical("Can not open the work queue %s (error: %s)"
+                                 % (arg_worker, msg))
+                sys.exit(2)
+            try:
+                runWorker(subdatabase, queue, overwrite=arg_overwrite,
+                          callback=done)
+            except KeyboardInterrupt:
+                logging.info("Stop the worker (leases released)")
+            queue.close()
+        elif arg_enqueue is not None:
+            # Distributed mode: add the files to the work queue
+            from .queuewitsub import workQueue, enqueueVideos
+            queue = workQueue(arg_enqueue)
+            logging.info("%s video files added to %s"
+                         % (enqueueVideos(queue, scanVideos(
+                             arg_file, exclude=arg_exclude, hidden=arg_hidden,
+                             followlinks=arg_followlinks)
+                             if os.path.isdir(arg_file) else [arg_file]),
+                            arg_enqueue))
+            queue.close()
+        elif os.path.isdir(arg_file):
+            # User provides a folder
+            logging.debug("%s is a folder. Scan into." % arg_file)
+
+            # Recursive scan (timed)
+            def walk(path):
+                if scandir is not None:
+                    return stats.timeIter("walk", scanVideos(
+                        path, exclude=arg_exclude, hidden=arg_hidden,
+                        followlinks=arg_followlinks, journal=journal))
+                return stats.timeIter("walk", (root + os.sep + input_file
+                                               for root, dirs, files
+                                               in os.walk(path)
+                                               for input_file in files))
+
+            # Let's go...
+            if arg_watch:
+                try:
+                    from .watchwitsub import watchVideos
+                    watchVideos(subdatabase, arg_file, overwrite=arg_overwrite,
+                                exclude=arg_exclude, hidden=arg_hidden,
+                                callback=done)
+                except (ImportError, ValueError, OSError,
+                        AttributeError) as msg:
+                    logging.critical("Watch mode not available (error: %s)"
+                                     % msg)
+                    sys.exit(2)
+                except KeyboardInterrupt:
+                    logging.info("Stop watching %s" % arg_file)
+            elif arg_jobs is None:
+                for result in subdatabase.fetchMany(walk(arg_file),
+                                                    overwrite=arg_overwrite,
+                                                    newest=arg_newest):
+                    done(result)
+            else:
+                # Asyncio engine
+                if arg_newest is not None:
+                    logging.warning("--newest is not used by the asyncio "
+                                    "engine")
+                if budget is not None:
+                    # Checked by request only (see asyncwitsub)
+                    logging.warning("The files out of the budget are "
+                                    "request errors with the asyncio "
+                                    "engine")
+                try:
+                    import asyncio
+                    from .asyncwitsub import getSubTitlesAsync
+                except (ImportError, SyntaxError, ValueError) as msg:
+                    logging.critical("Asyncio engine not available (error: %s)"
+                                     % msg)
+                    sys.exit(2)
+                asyncio.run(getSubTitlesAsync(subdatabase, walk(arg_file),
+                                              overwrite=arg_overwrite,
+                                              jobs=arg_jobs, callback=done))
+        else:
+            # User provides a single file
+            try:
+                with open(arg_file):
+                    pass
+            except IOError:
+                logging.critical("Can not read input file or folder %s"
+                                 % arg_file)
+                sys.exit(2)
+
+            # Let's go...
+            for result in subdatabase.fetchMany([arg_file],
+                                                overwrite=arg_overwrite):
+                done(result)
+    finally:
+        # Also on errors and interrupts: the journal and the report keep
+        # the outcomes of the files already processed
+        if cache is not None:
+            cache.close()
+        if report is not None:
+            report.close()
+
+    # Statistics of the run
+    if arg_stats:
+        print(stats.summary())
+    if arg_statsfile is not None:
+        try:
+            stats.save(arg_statsfile)
+        except (IOError, OSError) as msg:
+            logging.error("Can not save the statistics to %s (error: %s)"
+                          % (arg_statsfile, msg))
 
 # Main
 #=====